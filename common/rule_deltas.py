@@ -0,0 +1,65 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Deltas between the ordered rule lists of a firewall policy revision
+
+A rule list delta is a dict of:
+  - base_revision_number: revision of the policy the delta applies to
+  - removed: ids of the rules removed from the list
+  - changed: rules of the list whose attributes changed
+  - added: [previous rule id, rule] pairs of the rules added to the list, in
+    list order, the previous rule id being None for the first rule
+  - order: ids of the rules of the new list, only given if rules moved
+"""
+
+
+def make_rule_list_delta(base_revision_number, old_rules, new_rules):
+    """Return the delta turning a rule list into another one."""
+    old_rules_by_id = dict((rule['id'], rule) for rule in old_rules)
+    new_rule_ids = [rule['id'] for rule in new_rules]
+    kept_rule_ids = set(new_rule_ids) & set(old_rules_by_id)
+    delta = {'base_revision_number': base_revision_number,
+             'removed': [rule['id'] for rule in old_rules
+                         if rule['id'] not in kept_rule_ids],
+             'changed': [rule for rule in new_rules
+                         if rule['id'] in kept_rule_ids and
+                         rule != old_rules_by_id[rule['id']]],
+             'added': []}
+    previous_rule_id = None
+    for rule in new_rules:
+        if rule['id'] not in kept_rule_ids:
+            delta['added'].append([previous_rule_id, rule])
+        previous_rule_id = rule['id']
+    if ([rule['id'] for rule in old_rules if rule['id'] in kept_rule_ids] !=
+            [rule_id for rule_id in new_rule_ids if rule_id in kept_rule_ids]):
+        delta['order'] = new_rule_ids
+    return delta
+
+
+def apply_rule_list_delta(rules, delta):
+    """Return the rule list resulting from a delta, rules being unchanged."""
+    rules_by_id = dict((rule['id'], rule) for rule in rules)
+    for rule in delta['changed']:
+        rules_by_id[rule['id']] = rule
+    for rule_id in delta['removed']:
+        del rules_by_id[rule_id]
+    for previous_rule_id, rule in delta['added']:
+        rules_by_id[rule['id']] = rule
+    rule_ids = delta.get('order')
+    if rule_ids is None:
+        rule_ids = [rule['id'] for rule in rules
+                    if rule['id'] in rules_by_id]
+        for previous_rule_id, rule in delta['added']:
+            index = (rule_ids.index(previous_rule_id) + 1
+                     if previous_rule_id else 0)
+            rule_ids.insert(index, rule['id'])
+    return [rules_by_id[rule_id] for rule_id in rule_ids]
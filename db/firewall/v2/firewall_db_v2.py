@@ -19,6 +19,10 @@ import re
 import netaddr
 from neutron.db import api as db_api
 from neutron.db import common_db_mixin as base_db
+from neutron.db.models import agent as agent_model
+from neutron.db.models import l3_attrs
+from neutron.db.models import l3agent as l3agent_model
+from neutron.db import models_v2
 from neutron_lib.api.definitions import constants as fw_const
 from neutron_lib.api import validators
 from neutron_lib import constants as nl_constants
@@ -36,12 +40,25 @@ from sqlalchemy import or_
 from sqlalchemy import orm
 from sqlalchemy.orm import exc
 
+from neutron_fwaas._i18n import _
 from neutron_fwaas.common import fwaas_constants as const
+from neutron_fwaas.db.firewall.v2 import policy_rules_cache
 from neutron_fwaas.extensions import firewall_v2 as fw_ext
 
 
 LOG = logging.getLogger(__name__)
 
+firewall_db_v2_opts = [
+    cfg.IntOpt('policy_rules_cache_size',
+               default=1000,
+               min=0,
+               help=_("Number of firewall policies whose ordered rule lists "
+                      "are cached by the server for the agents, least "
+                      "recently used entries being evicted first. "
+                      "0 disables the cache")),
+]
+cfg.CONF.register_opts(firewall_db_v2_opts, 'fwaas')
+
 
 class FirewallDefaultParameterExists(exceptions.InUse):
     """Default Firewall Parameter conflict exception
@@ -131,6 +148,18 @@ class RuleV2DestinationAddressGroupAssociation(model_base.BASEV2, model_base.Has
                                  nullable=False)
 
 
+class RuleV2ServiceGroupAssociation(model_base.BASEV2, model_base.HasId):
+    __tablename__ = "firewall_rule_service_group_associations_v2"
+    service_group_id = sa.Column(sa.String(db_constants.UUID_FIELD_SIZE),
+                                 sa.ForeignKey('service_groups.id',
+                                               ondelete="CASCADE"),
+                                 nullable=False)
+    firewall_rule_id = sa.Column(sa.String(db_constants.UUID_FIELD_SIZE),
+                                 sa.ForeignKey('firewall_rules_v2.id',
+                                               ondelete="CASCADE"),
+                                 nullable=False)
+
+
 class FirewallRuleV2(model_base.BASEV2, model_base.HasId, HasName,
                      HasDescription, model_base.HasProject):
     __tablename__ = "firewall_rules_v2"
@@ -156,6 +185,11 @@ class FirewallRuleV2(model_base.BASEV2, model_base.HasId, HasName,
         foreign_keys='RuleV2DestinationAddressGroupAssociation.firewall_rule_id',
         backref=orm.backref('firewall_rules_v2', cascade='all, delete')
     )
+    service_groups = orm.relationship(
+        RuleV2ServiceGroupAssociation,
+        foreign_keys='RuleV2ServiceGroupAssociation.firewall_rule_id',
+        backref=orm.backref('firewall_rules_v2', cascade='all, delete')
+    )
 
 
 class FirewallGroup(model_base.BASEV2, model_base.HasId, HasName,
@@ -177,6 +211,9 @@ class FirewallGroup(model_base.BASEV2, model_base.HasId, HasName,
     admin_state_up = sa.Column(sa.Boolean)
     status = sa.Column(sa.String(db_constants.STATUS_FIELD_SIZE))
     shared = sa.Column(sa.Boolean)
+    # bumped by each update of the group, its status reports excepted
+    revision_number = sa.Column(sa.BigInteger, nullable=False,
+                                server_default='0', default=0)
 
 
 class DefaultFirewallGroup(model_base.BASEV2, model_base.HasProjectPrimaryKey):
@@ -229,6 +266,9 @@ class FirewallPolicy(model_base.BASEV2, model_base.HasId, HasName,
         sa.String(db_constants.LONG_DESCRIPTION_FIELD_SIZE))
     rule_count = sa.Column(sa.Integer)
     audited = sa.Column(sa.Boolean)
+    # bumped by each change of the rule list of the policy
+    revision_number = sa.Column(sa.BigInteger, nullable=False,
+                                server_default='0', default=0)
     rule_associations = orm.relationship(
         FirewallPolicyRuleAssociation,
         backref=orm.backref('firewall_policies_v2', cascade='all, delete'),
@@ -239,6 +279,15 @@ class FirewallPolicy(model_base.BASEV2, model_base.HasId, HasName,
 
 class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
 
+    _policy_rules_cache = None
+
+    @property
+    def policy_rules_cache(self):
+        if self._policy_rules_cache is None:
+            self._policy_rules_cache = policy_rules_cache.PolicyRulesCache(
+                cfg.CONF.fwaas.policy_rules_cache_size)
+        return self._policy_rules_cache
+
     def _get_firewall_group(self, context, id):
         try:
             return self._get_by_id(context, FirewallGroup, id)
@@ -364,6 +413,9 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
         fw_dags = [
             destination_address_group.address_group_id
             for destination_address_group in firewall_rule['destination_address_groups']]
+        fw_sgs = [
+            service_group.service_group_id
+            for service_group in firewall_rule['service_groups']]
         res = {'id': firewall_rule['id'],
                'tenant_id': firewall_rule['tenant_id'],
                'name': firewall_rule['name'],
@@ -378,6 +430,7 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
                'destination_port': dst_port_range,
                'source_address_group_ids': fw_sags,
                'destination_address_group_ids': fw_dags,
+               'service_group_ids': fw_sgs,
                'action': firewall_rule['action'],
                'enabled': firewall_rule['enabled'],
                'shared': firewall_rule['shared']}
@@ -411,41 +464,171 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
                'admin_state_up': firewall_group['admin_state_up'],
                'ports': fwg_ports,
                'status': firewall_group['status'],
-               'shared': firewall_group['shared']}
+               'shared': firewall_group['shared'],
+               'revision_number': firewall_group['revision_number']}
         return self._fields(res, fields)
 
+    def _get_address_groups_by_id(self, context, ids, fields=None):
+        """Get the dicts of address groups, keyed by id, in one query"""
+        if not ids:
+            return {}
+        query = (self._model_query(context, AddressGroup)
+                 .options(orm.subqueryload(AddressGroup.ip_addresses))
+                 .filter(AddressGroup.id.in_(ids)))
+        address_groups = {
+            address_group.id: self._make_address_group_dict(address_group,
+                                                            fields)
+            for address_group in query}
+        missing_ids = set(ids) - set(address_groups)
+        if missing_ids:
+            raise f_exc.AddressGroupNotFound(
+                address_group_id=missing_ids.pop())
+        return address_groups
+
+    def _get_service_groups_by_id(self, context, ids, fields=None):
+        """Get the dicts of service groups, keyed by id, in one query"""
+        if not ids:
+            return {}
+        query = (self._model_query(context, ServiceGroup)
+                 .options(orm.subqueryload(ServiceGroup.ports))
+                 .filter(ServiceGroup.id.in_(ids)))
+        service_groups = {
+            service_group.id: self._make_service_group_dict(service_group,
+                                                            fields)
+            for service_group in query}
+        missing_ids = set(ids) - set(service_groups)
+        if missing_ids:
+            raise f_exc.ServiceGroupNotFound(
+                service_group_id=missing_ids.pop())
+        return service_groups
+
     def _get_policy_ordered_rules(self, context, policy_id):
+        """Get the rules of a policy in order, with their groups
+
+        The group associations of the rules are eager loaded and the groups
+        fetched once, rules referencing the same group sharing its dict.
+        """
         query = (context.session.query(FirewallRuleV2)
+                 .options(
+                     orm.subqueryload(FirewallRuleV2.source_address_groups),
+                     orm.subqueryload(
+                         FirewallRuleV2.destination_address_groups),
+                     orm.subqueryload(FirewallRuleV2.service_groups))
                  .join(FirewallPolicyRuleAssociation)
                  .filter_by(firewall_policy_id=policy_id)
                  .order_by(FirewallPolicyRuleAssociation.position))
-        rules = []
-        for rule in query:
-            rule_dict = self._make_firewall_rule_dict(rule)
-            rule_dict['source_address_groups'] = []
-            rule_dict['destination_address_groups'] = []
-            fields = ['id', 'name', 'ip_addresses']
-            for id in rule_dict['source_address_group_ids']:
-                rule_dict['source_address_groups'] += [self.get_address_group(context, id, fields)]
-            for id in rule_dict['destination_address_group_ids']:
-                rule_dict['destination_address_groups'] += [self.get_address_group(context, id, fields)]
-            rules += [rule_dict]
+        rules = [self._make_firewall_rule_dict(rule) for rule in query]
+        address_group_ids = set()
+        service_group_ids = set()
+        for rule_dict in rules:
+            address_group_ids.update(rule_dict['source_address_group_ids'])
+            address_group_ids.update(
+                rule_dict['destination_address_group_ids'])
+            service_group_ids.update(rule_dict['service_group_ids'])
+        address_groups = self._get_address_groups_by_id(
+            context, address_group_ids, ['id', 'name', 'ip_addresses'])
+        service_groups = self._get_service_groups_by_id(
+            context, service_group_ids, ['id', 'name', 'ports'])
+        for rule_dict in rules:
+            rule_dict['source_address_groups'] = [
+                address_groups[id]
+                for id in rule_dict['source_address_group_ids']]
+            rule_dict['destination_address_groups'] = [
+                address_groups[id]
+                for id in rule_dict['destination_address_group_ids']]
+            rule_dict['service_groups'] = [
+                service_groups[id] for id in rule_dict['service_group_ids']]
         return rules
 
+    def _get_policy_rule_list(self, context, policy_id):
+        """Get the revision and ordered rules of a policy
+
+        Rules are taken from the cache if up to date. The revision and the
+        rules are read within one transaction, so that the rules are the
+        ones of the revision. Rules read within a caller's transaction
+        aren't cached, as the policy revision they were read at could be
+        rolled back.
+
+        :returns: (revision number, rules) tuple
+        """
+        cache = self.policy_rules_cache
+        in_transaction = context.session.is_active
+        with context.session.begin(subtransactions=True):
+            revision_number = context.session.query(
+                FirewallPolicy.revision_number).filter_by(
+                    id=policy_id).scalar()
+            if not cache.size:
+                return (revision_number,
+                        self._get_policy_ordered_rules(context, policy_id))
+            rules = cache.get(policy_id, revision_number)
+            if rules is not None:
+                return revision_number, rules
+            rules = self._get_policy_ordered_rules(context, policy_id)
+        if not in_transaction:
+            cache.set(policy_id, revision_number, rules)
+        LOG.debug("Firewall policy rules cache: %(size)d entries, "
+                  "%(hits)d hits, %(misses)d misses, "
+                  "hit rate %(hit_rate).2f", cache.stats)
+        return revision_number, rules
+
+    def _bump_firewall_policy_revision(self, fwp_db):
+        # incremented by the database so that concurrent changes all count
+        fwp_db.revision_number = FirewallPolicy.revision_number + 1
+
+    def _bump_revision_of_policies_with_group(self, context, group_rules):
+        """Bump the revision of the policies with rules matching a group
+
+        :param group_rules: query of the ids of the rules using the group
+        """
+        query = context.session.query(FirewallPolicy)
+        query = query.join(FirewallPolicyRuleAssociation)
+        query = query.filter(
+            FirewallPolicyRuleAssociation.firewall_rule_id.in_(
+                group_rules.subquery()))
+        for fwp_db in query.distinct():
+            self._bump_firewall_policy_revision(fwp_db)
+
+    def _bump_revision_of_policies_with_address_group(self, context, id):
+        source_rules = context.session.query(
+            RuleV2SourceAddressGroupAssociation.firewall_rule_id).filter_by(
+            address_group_id=id)
+        destination_rules = context.session.query(
+            RuleV2DestinationAddressGroupAssociation.firewall_rule_id
+        ).filter_by(address_group_id=id)
+        self._bump_revision_of_policies_with_group(
+            context, source_rules.union(destination_rules))
+
+    def _bump_revision_of_policies_with_service_group(self, context, id):
+        self._bump_revision_of_policies_with_group(
+            context, context.session.query(
+                RuleV2ServiceGroupAssociation.firewall_rule_id).filter_by(
+                service_group_id=id))
+
     def _make_firewall_group_dict_with_rules(self, context, firewall_group_id):
         firewall_group = self.get_firewall_group(context, firewall_group_id)
+        return self._add_firewall_group_rule_lists(context, firewall_group)
+
+    def _add_firewall_group_rule_lists(self, context, firewall_group):
+        """Add the ordered rules of its policies to a firewall group dict
+
+        The revisions of the policies the rules were read at are added too.
+        """
         ingress_policy_id = firewall_group['ingress_firewall_policy_id']
         if ingress_policy_id:
-            firewall_group['ingress_rule_list'] = (
-                self._get_policy_ordered_rules(context, ingress_policy_id))
+            (firewall_group['ingress_firewall_policy_revision_number'],
+             firewall_group['ingress_rule_list']) = (
+                self._get_policy_rule_list(context, ingress_policy_id))
         else:
+            firewall_group['ingress_firewall_policy_revision_number'] = None
             firewall_group['ingress_rule_list'] = []
 
         egress_policy_id = firewall_group['egress_firewall_policy_id']
         if egress_policy_id:
-            firewall_group['egress_rule_list'] = (
-                self._get_policy_ordered_rules(context, egress_policy_id))
+            (firewall_group['egress_firewall_policy_revision_number'],
+             firewall_group['egress_rule_list']) = (
+                self._get_policy_rule_list(context, egress_policy_id))
         else:
+            firewall_group['egress_firewall_policy_revision_number'] = None
             firewall_group['egress_rule_list'] = []
         return firewall_group
 
@@ -474,6 +657,7 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
                 context.session.delete(association_db)
             fwp_db.rule_associations.reorder()
             fwp_db.audited = False
+            self._bump_firewall_policy_revision(fwp_db)
         return self._make_firewall_policy_dict(fwp_db)
 
     def _get_policy_rule_association_query(self, context, firewall_policy_id,
@@ -598,13 +782,15 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
     def update_address_group(self, context, id, address_group):
         LOG.debug("update_address_group() called")
         fwag = address_group['address_group']
-        self._update_address_association(context, id, fwag['ip_addresses'])
-        del fwag['ip_addresses']
         # self._validate_fwr_protocol_parameters(fwr)
         # self._validate_fwr_src_dst_ip_version(fwr)
         with context.session.begin(subtransactions=True):
+            self._update_address_association(context, id,
+                                             fwag['ip_addresses'])
+            del fwag['ip_addresses']
             fwag_db = self._get_address_group(context, id)
             fwag_db.update(fwag)
+            self._bump_revision_of_policies_with_address_group(context, id)
         return self._make_address_group_dict(fwag_db)
 
     def delete_address_group(self, context, id):
@@ -612,6 +798,7 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
         with context.session.begin(subtransactions=True):
             # if self._get_address_group_with_address(context, id):
             #     raise f_exc.AddressGroupInUse(address_group_id=id)
+            self._bump_revision_of_policies_with_address_group(context, id)
             context.session.query(AddressGroup).filter_by(id=id).delete()
 
     def get_address_group(self, context, id, fields=None):
@@ -668,13 +855,14 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
     def update_service_group(self, context, id, service_group):
         LOG.debug("update_service_group() called")
         fwsg = service_group['service_group']
-        self._update_service_association(context, id, fwsg['ports'])
-        del fwsg['ports']
         # self._validate_fwr_protocol_parameters(fwr)
         # self._validate_fwr_src_dst_ip_version(fwr)
         with context.session.begin(subtransactions=True):
+            self._update_service_association(context, id, fwsg['ports'])
+            del fwsg['ports']
             fwsg_db = self._get_service_group(context, id)
             fwsg_db.update(fwsg)
+            self._bump_revision_of_policies_with_service_group(context, id)
         return self._make_service_group_dict(fwsg_db)
 
     def delete_service_group(self, context, id):
@@ -682,6 +870,7 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
         with context.session.begin(subtransactions=True):
             # if self._get_address_group_with_address(context, id):
             #     raise f_exc.AddressGroupInUse(address_group_id=id)
+            self._bump_revision_of_policies_with_service_group(context, id)
             context.session.query(ServiceGroup).filter_by(id=id).delete()
 
     def get_service_group(self, context, id, fields=None):
@@ -726,6 +915,29 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
                 RuleV2DestinationAddressGroupAssociation).filter_by(
                 firewall_rule_id=id).delete()
 
+    def _set_service_groups_for_rule(self, context, id, firewall_rule):
+        fwr = firewall_rule['firewall_rule']
+        with context.session.begin(subtransactions=True):
+            for service_group_id in fwr.get('service_group_ids') or []:
+                fw_sg_db = RuleV2ServiceGroupAssociation(
+                    id=uuidutils.generate_uuid(),
+                    service_group_id=service_group_id,
+                    firewall_rule_id=id
+                )
+                context.session.add(fw_sg_db)
+
+    def _update_service_groups_for_rule(self, context, id, firewall_rule):
+        if 'service_group_ids' not in firewall_rule['firewall_rule']:
+            return
+        self._delete_all_service_groups_from_rule(context, id)
+        self._set_service_groups_for_rule(context, id, firewall_rule)
+
+    def _delete_all_service_groups_from_rule(self, context, id):
+        with context.session.begin(subtransactions=True):
+            context.session.query(
+                RuleV2ServiceGroupAssociation).filter_by(
+                firewall_rule_id=id).delete()
+
     def create_firewall_rule(self, context, firewall_rule):
         LOG.debug("create_firewall_rule() called")
         fwr = firewall_rule['firewall_rule']
@@ -757,6 +969,8 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
                 shared=fwr['shared'])
             context.session.add(fwr_db)
             self._set_address_groups_for_rule(context, fwr_db.id, firewall_rule)
+            self._set_service_groups_for_rule(context, fwr_db.id,
+                                              firewall_rule)
         return self._make_firewall_rule_dict(fwr_db)
 
     def update_firewall_rule(self, context, id, firewall_rule):
@@ -792,7 +1006,9 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
             for fwp_id in fwp_ids:
                 fwp_db = self._get_firewall_policy(context, fwp_id)
                 fwp_db['audited'] = False
+                self._bump_firewall_policy_revision(fwp_db)
             self._update_address_groups_for_rule(context, id, firewall_rule)
+            self._update_service_groups_for_rule(context, id, firewall_rule)
         return self._make_firewall_rule_dict(fwr_db)
 
     def delete_firewall_rule(self, context, id):
@@ -803,6 +1019,7 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
             if self._get_policies_with_rule(context, id):
                 raise f_exc.FirewallRuleInUse(firewall_rule_id=id)
             self._delete_all_address_groups_from_rule(context, id)
+            self._delete_all_service_groups_from_rule(context, id)
             context.session.delete(fwr)
 
     def insert_rule(self, context, id, rule_info):
@@ -899,6 +1116,26 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
             fwps = [entry.firewall_policy_id for entry in fw_pol_rule_qry]
         return fwps
 
+    def _get_rules_with_address_group(self, context, address_group_id):
+        """Gets the rules matching addresses of an address group"""
+        with context.session.begin(subtransactions=True):
+            fwrs = set()
+            for association in (RuleV2SourceAddressGroupAssociation,
+                                RuleV2DestinationAddressGroupAssociation):
+                fw_rule_ag_qry = context.session.query(
+                    association).filter_by(address_group_id=address_group_id)
+                fwrs.update(entry.firewall_rule_id for entry in fw_rule_ag_qry)
+        return sorted(fwrs)
+
+    def _get_rules_with_service_group(self, context, service_group_id):
+        """Gets the rules matching services of a service group"""
+        with context.session.begin(subtransactions=True):
+            fw_rule_sg_qry = context.session.query(
+                RuleV2ServiceGroupAssociation).filter_by(
+                service_group_id=service_group_id)
+            fwrs = [entry.firewall_rule_id for entry in fw_rule_sg_qry]
+        return fwrs
+
     def _set_rules_in_policy_rule_assoc(self, context, fwp_db, fwp):
         # Pull the rules and add it to policy - rule association table
         # Set the position (this can be used in the making the dict)
@@ -1081,6 +1318,7 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
             if 'audited' not in fwp:
                 fwp['audited'] = False
             fwp_db.update(fwp)
+            self._bump_firewall_policy_revision(fwp_db)
         return self._make_firewall_policy_dict(fwp_db)
 
     def delete_firewall_policy(self, context, id):
@@ -1306,6 +1544,7 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
                 self._delete_ports_in_firewall_group(context, id)
                 self._set_ports_for_firewall_group(context, fwg_db, fwg)
                 del fwg['ports']
+            fwg['revision_number'] = FirewallGroup.revision_number + 1
             count = context.session.query(
                 FirewallGroup).filter_by(id=id).update(fwg)
             if not count:
@@ -1401,6 +1640,51 @@ class Firewall_db_mixin_v2(fw_ext.Firewallv2PluginBase, base_db.CommonDbMixin):
                                     self._make_firewall_group_dict,
                                     filters=filters, fields=fields)
 
+    def _get_firewall_groups_on_host_query(self, context, host):
+        """Query the firewall groups with ports on the routers of a host
+
+        Routers are hosted by the L3 agents they are scheduled to, and
+        distributed routers possibly by every host, so the groups of
+        distributed routers are returned for all hosts. Only the groups
+        visible to the context are returned.
+        """
+        hosted_routers = context.session.query(
+            l3agent_model.RouterL3AgentBinding.router_id)
+        hosted_routers = hosted_routers.join(agent_model.Agent)
+        hosted_routers = hosted_routers.filter(agent_model.Agent.host == host)
+        distributed_routers = context.session.query(
+            l3_attrs.RouterExtraAttributes.router_id)
+        distributed_routers = distributed_routers.filter(
+            l3_attrs.RouterExtraAttributes.distributed == sa.true())
+        query = self._model_query(context, FirewallGroup)
+        query = query.options(orm.subqueryload(FirewallGroup.ports))
+        query = query.join(FirewallGroupPortAssociation)
+        query = query.join(models_v2.Port,
+                           models_v2.Port.id ==
+                           FirewallGroupPortAssociation.port_id)
+        query = query.filter(or_(
+            models_v2.Port.device_id.in_(hosted_routers.subquery()),
+            models_v2.Port.device_id.in_(distributed_routers.subquery())))
+        return query.distinct()
+
+    def get_firewall_groups_on_host(self, context, host, marker=None,
+                                    limit=None):
+        """Get a page of the firewall groups with ports on a host
+
+        :param host: host of the L3 agent the groups are sent to
+        :param marker: id of the last group of the previous page, groups
+                       being ordered by id
+        :param limit: maximum number of groups returned
+        """
+        LOG.debug("get_firewall_groups_on_host() called")
+        query = self._get_firewall_groups_on_host_query(context, host)
+        if marker:
+            query = query.filter(FirewallGroup.id > marker)
+        query = query.order_by(FirewallGroup.id)
+        if limit:
+            query = query.limit(limit)
+        return [self._make_firewall_group_dict(fwg) for fwg in query]
+
     def get_firewall_group_for_port(self, context, port_id):
         """Get firewall group is associated with a port
 
@@ -0,0 +1,64 @@
+# Copyright (c) 2018
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import copy
+
+
+class PolicyRulesCache(object):
+    """LRU cache of the ordered rule lists of firewall policies
+
+    The rule list of a policy is cached along with the policy revision
+    number it was read at, and only returned for that revision: changing
+    the rules of a policy bumps its revision, making the entry stale. Rule
+    lists are copied in and out of the cache, callers being free to modify
+    them.
+    """
+
+    def __init__(self, size):
+        """:param size: maximum number of cached policies, 0 disabling"""
+        self.size = size
+        self._rule_lists = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, policy_id, revision_number):
+        """Return the rules of a policy revision, or None if not cached."""
+        cached_revision, rules = self._rule_lists.get(policy_id, (None, None))
+        if rules is None or cached_revision != revision_number:
+            self.misses += 1
+            return None
+        # move the entry to the most recently used end
+        self._rule_lists[policy_id] = self._rule_lists.pop(policy_id)
+        self.hits += 1
+        return copy.deepcopy(rules)
+
+    def set(self, policy_id, revision_number, rules):
+        """Cache the rules of a policy revision, evicting the oldest entry."""
+        if not self.size:
+            return
+        self._rule_lists.pop(policy_id, None)
+        if len(self._rule_lists) >= self.size:
+            self._rule_lists.popitem(last=False)
+        self._rule_lists[policy_id] = (revision_number, copy.deepcopy(rules))
+
+    @property
+    def stats(self):
+        """Return the size, hits, misses and hit rate of the cache."""
+        lookups = self.hits + self.misses
+        return {'size': len(self._rule_lists),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
@@ -0,0 +1,35 @@
+# Copyright 2018 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""add_firewall_policy_revision_number
+
+Revision ID: 9fcbd75043ff
+Revises: bd101346cde6
+Create Date: 2018-04-09 11:02:13.517248
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9fcbd75043ff'
+down_revision = 'bd101346cde6'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('firewall_policies_v2',
+                  sa.Column('revision_number', sa.BigInteger(),
+                            nullable=False, server_default='0'))
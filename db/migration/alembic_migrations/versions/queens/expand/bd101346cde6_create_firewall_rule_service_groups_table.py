@@ -0,0 +1,43 @@
+# Copyright 2018 <PUT YOUR NAME/COMPANY HERE>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""create_firewall_rule_service_groups_table
+
+Revision ID: bd101346cde6
+Revises: c575480592dd
+Create Date: 2018-03-12 10:21:37.412530
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'bd101346cde6'
+down_revision = 'c575480592dd'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'firewall_rule_service_group_associations_v2',
+        sa.Column('id', sa.String(length=36), primary_key=True),
+        sa.Column('firewall_rule_id', sa.String(length=36),
+                  sa.ForeignKey('firewall_rules_v2.id', ondelete='CASCADE'),
+                  nullable=False),
+        sa.Column('service_group_id', sa.String(length=36),
+                  sa.ForeignKey('service_groups.id', ondelete='CASCADE'),
+                  nullable=False),
+        mysql_DEFAULT_CHARSET='utf8'
+    )
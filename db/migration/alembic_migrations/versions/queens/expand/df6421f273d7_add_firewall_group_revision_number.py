@@ -0,0 +1,35 @@
+# Copyright 2018 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+"""add_firewall_group_revision_number
+
+Revision ID: df6421f273d7
+Revises: 9fcbd75043ff
+Create Date: 2018-04-16 09:47:51.208306
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'df6421f273d7'
+down_revision = '9fcbd75043ff'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('firewall_groups_v2',
+                  sa.Column('revision_number', sa.BigInteger(),
+                            nullable=False, server_default='0'))
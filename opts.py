@@ -10,8 +10,10 @@
 #  License for the specific language governing permissions and limitations
 #  under the License.
 
+import neutron_fwaas.db.firewall.v2.firewall_db_v2
 import neutron_fwaas.extensions.firewall
 import neutron_fwaas.services.firewall.agents.firewall_agent_api
+import neutron_fwaas.services.firewall.fwaas_plugin_v2
 
 
 def list_agent_opts():
@@ -24,5 +26,10 @@ def list_agent_opts():
 def list_opts():
     return [
         ('quotas',
-         neutron_fwaas.extensions.firewall.firewall_quota_opts)
+         neutron_fwaas.extensions.firewall.firewall_quota_opts),
+        ('fwaas',
+         neutron_fwaas.db.firewall.v2.firewall_db_v2.firewall_db_v2_opts),
+        ('fwaas',
+         neutron_fwaas.services.firewall.fwaas_plugin_v2.
+         firewall_plugin_v2_opts)
     ]
@@ -48,15 +48,22 @@ NFCT_OF_TIME = 1 << NFCT_OF_TIME_BIT
 NFCT_Q_DESTROY = 2
 NFCT_Q_FLUSH = 4
 NFCT_Q_DUMP = 5
+NFCT_Q_DUMP_FILTER = 8
 NFCT_T_DESTROY_BIT = 2
 NFCT_T_DESTROY = 1 << NFCT_T_DESTROY_BIT
 
 ATTR_IPV4_SRC = 0
 ATTR_IPV4_DST = 1
+ATTR_REPL_IPV4_SRC = 2
+ATTR_REPL_IPV4_DST = 3
 ATTR_IPV6_SRC = 4
 ATTR_IPV6_DST = 5
+ATTR_REPL_IPV6_SRC = 6
+ATTR_REPL_IPV6_DST = 7
 ATTR_PORT_SRC = 8
 ATTR_PORT_DST = 9
+ATTR_REPL_PORT_SRC = 10
+ATTR_REPL_PORT_DST = 11
 ATTR_ICMP_TYPE = 12
 ATTR_ICMP_CODE = 13
 ATTR_ICMP_ID = 14
@@ -72,6 +79,9 @@ NFCT_T_DESTROY = 1 << NFCT_T_DESTROY_BIT
 
 NFCT_T_ALL = NFCT_T_NEW | NFCT_T_UPDATE | NFCT_T_DESTROY
 
+NFCT_FILTER_DUMP_MARK = 0
+NFCT_FILTER_DUMP_L3NUM = 1
+
 NFCT_CB_CONTINUE = 1
 NFCT_CB_FAILURE = -1
 
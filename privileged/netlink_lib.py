@@ -35,8 +35,15 @@
 # THE SOFTWARE.
 #
 
+import collections
+import contextlib
 import ctypes
 from ctypes import util
+from multiprocessing import pool
+import socket
+import struct
+import threading
+import time
 
 from oslo_log import log as logging
 
@@ -45,6 +52,7 @@ from neutron_lib import constants
 from neutron_fwaas import privileged
 from neutron_fwaas.privileged import netlink_constants as nl_constants
 from neutron_fwaas.privileged import utils as fwaas_utils
+from neutron_fwaas.services.firewall.drivers.linux import conntrack_matcher
 
 LOG = logging.getLogger(__name__)
 
@@ -64,6 +72,10 @@ TARGET = {'src': {4: nl_constants.ATTR_IPV4_SRC,
                   6: nl_constants.ATTR_IPV6_SRC},
           'dst': {4: nl_constants.ATTR_IPV4_DST,
                   6: nl_constants.ATTR_IPV6_DST},
+          'reply_src': {4: nl_constants.ATTR_REPL_IPV4_SRC,
+                        6: nl_constants.ATTR_REPL_IPV6_SRC},
+          'reply_dst': {4: nl_constants.ATTR_REPL_IPV4_DST,
+                        6: nl_constants.ATTR_REPL_IPV6_DST},
           'ipversion': {4: nl_constants.ATTR_L3PROTO,
                         6: nl_constants.ATTR_L3PROTO},
           'protocol': {4: nl_constants.ATTR_L4PROTO,
@@ -79,10 +91,24 @@ TARGET = {'src': {4: nl_constants.ATTR_IPV4_SRC,
           'dport': {4: nl_constants.ATTR_PORT_DST,
                     6: nl_constants.ATTR_PORT_DST}}
 
+IPV6_ADDRESS_LENGTH = 16
+# seconds after which an unused pooled conntrack handler is closed
+HANDLER_IDLE_TIMEOUT = 300
+PROTOCOL_NAMES = dict((number, name) for name, number
+                      in constants.IP_PROTOCOL_MAP.items())
+# conntrack names icmp for IPv6 icmpv6
+PROTOCOL_NAMES[constants.PROTO_NUM_IPV6_ICMP] = 'icmpv6'
+
 NFCT_CALLBACK = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_int,
                                  ctypes.c_void_p, ctypes.c_void_p)
 
 
+class NfctFilterDumpMark(ctypes.Structure):
+    """struct nfct_filter_dump_mark"""
+    _fields_ = [('val', ctypes.c_uint32),
+                ('mask', ctypes.c_uint32)]
+
+
 class ConntrackOpenFailedExit(SystemExit):
     """Raised if we fail to open a new conntrack or conntrack handler"""
 
@@ -118,6 +144,43 @@ class ConntrackManager(object):
                       'id': libc.htons,
                       'sport': libc.htons,
                       'dport': libc.htons, }
+        # handles, conntrack objects and dump filters are pointers, which
+        # ctypes would truncate to C ints without their prototypes
+        nfct.nfct_open.restype = ctypes.c_void_p
+        nfct.nfct_open.argtypes = [ctypes.c_uint8, ctypes.c_uint]
+        nfct.nfct_close.argtypes = [ctypes.c_void_p]
+        nfct.nfct_new.restype = ctypes.c_void_p
+        nfct.nfct_new.argtypes = []
+        nfct.nfct_destroy.argtypes = [ctypes.c_void_p]
+        nfct.nfct_query.argtypes = [ctypes.c_void_p, ctypes.c_int,
+                                    ctypes.c_void_p]
+        nfct.nfct_callback_register.argtypes = [
+            ctypes.c_void_p, ctypes.c_int, NFCT_CALLBACK, ctypes.c_void_p]
+        nfct.nfct_callback_unregister.argtypes = [ctypes.c_void_p]
+        nfct.nfct_filter_dump_create.restype = ctypes.c_void_p
+        nfct.nfct_filter_dump_create.argtypes = []
+        nfct.nfct_filter_dump_set_attr.argtypes = [
+            ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p]
+        nfct.nfct_filter_dump_set_attr_u8.argtypes = [
+            ctypes.c_void_p, ctypes.c_int, ctypes.c_uint8]
+        nfct.nfct_filter_dump_destroy.argtypes = [ctypes.c_void_p]
+        nfct.nfct_snprintf.argtypes = [
+            ctypes.c_char_p, ctypes.c_uint, ctypes.c_void_p, ctypes.c_uint,
+            ctypes.c_uint, ctypes.c_uint]
+        # pointers and unsigned attributes are returned by the library
+        for function, value_type in (('', ctypes.c_void_p),
+                                     ('_u8', ctypes.c_uint8),
+                                     ('_u16', ctypes.c_uint16),
+                                     ('_u32', ctypes.c_uint32)):
+            get_attr = getattr(nfct, 'nfct_get_attr' + function)
+            get_attr.restype = value_type
+            get_attr.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        for function, value_type in (('_u8', ctypes.c_uint8),
+                                     ('_u16', ctypes.c_uint16),
+                                     ('_u32', ctypes.c_uint32),
+                                     ('_u64', ctypes.c_uint64)):
+            getattr(nfct, 'nfct_set_attr' + function).argtypes = [
+                ctypes.c_void_p, ctypes.c_int, value_type]
 
     def list_entries(self):
         entries = []
@@ -153,6 +216,81 @@ class ConntrackManager(object):
         finally:
             nfct.nfct_destroy(conntrack)
 
+    def delete_matching_entries(self, matcher, deleter, mark=None):
+        """Dump the entries of the socket family, deleting the matched ones
+
+        The dump is filtered by the kernel on the socket family, entries are
+        read from their binary attributes and deleted as they are dumped.
+
+        :param matcher: ConntrackMatcher selecting the entries to delete
+        :param deleter: ConntrackManager used to delete the entries, a
+                        handler can't be queried while it dumps
+        :param mark: (value, mask) connection mark the kernel restricts the
+                     dump to, if any
+        :return: number of deleted entries
+        """
+        ipversion = IPVERSION_BY_SOCKET[self.family_socket]
+        deleted = [0]
+
+        @NFCT_CALLBACK
+        def callback(type_, conntrack, data):
+            if matcher.match(_get_entry(conntrack, ipversion),
+                             _get_reply_entry(conntrack, ipversion)):
+                result = nfct.nfct_query(deleter.conntrack_handler,
+                                         nl_constants.NFCT_Q_DESTROY,
+                                         conntrack)
+                # the entry may have expired since it was dumped
+                if result != nl_constants.NFCT_CB_FAILURE:
+                    deleted[0] += 1
+            return nl_constants.NFCT_CB_CONTINUE
+
+        self._dump_family(callback, mark)
+        return deleted[0]
+
+    def list_parsed_entries(self):
+        """List the entries of the socket family as parsed tuples
+
+        Unlike list_entries, which formats each entry as text for
+        _parse_entry to split it, the attributes are read directly from
+        the conntrack objects. Only the entries of the protocols
+        delete_entries supports are returned.
+        """
+        ipversion = IPVERSION_BY_SOCKET[self.family_socket]
+        entries = []
+
+        @NFCT_CALLBACK
+        def callback(type_, conntrack, data):
+            entry = _get_entry(conntrack, ipversion)
+            if entry[1] in ATTR_POSITIONS:
+                entries.append(entry)
+            return nl_constants.NFCT_CB_CONTINUE
+
+        self._dump_family(callback)
+        return entries
+
+    def _dump_family(self, callback, mark=None):
+        """Call the callback on each entry of the socket family
+
+        :param mark: (value, mask) connection mark of the entries to dump,
+                     all the entries are dumped if None
+        """
+        self._callback_register(nl_constants.NFCT_T_ALL,
+                                callback, DATA_CALLBACK)
+        dump_filter = nfct.nfct_filter_dump_create()
+        try:
+            nfct.nfct_filter_dump_set_attr_u8(
+                dump_filter, nl_constants.NFCT_FILTER_DUMP_L3NUM,
+                self.family_socket)
+            if mark is not None:
+                dump_mark = NfctFilterDumpMark(*mark)
+                nfct.nfct_filter_dump_set_attr(
+                    dump_filter, nl_constants.NFCT_FILTER_DUMP_MARK,
+                    ctypes.byref(dump_mark))
+            self._query(nl_constants.NFCT_Q_DUMP_FILTER, dump_filter)
+        finally:
+            nfct.nfct_filter_dump_destroy(dump_filter)
+            nfct.nfct_callback_unregister(self.conntrack_handler)
+
     def flush_entries(self):
         data_ref = self._get_ref(self.family_socket or
                                  nl_constants.IPVERSION_SOCKET[4])
@@ -193,6 +331,168 @@ class ConntrackManager(object):
         nfct.nfct_close(self.conntrack_handler)
 
 
+class ConntrackHandlerPool(object):
+    """Pool of conntrack handlers opened in namespaces
+
+    A netlink socket stays bound to the namespace it was opened in, so a
+    handler opened once can be used again without moving into the namespace.
+    Handlers are checked out by a single user at a time, closed after
+    idle_timeout seconds without use, and discarded when their namespace
+    was deleted and created again. The idle handlers of all the namespaces
+    are checked for expiry whenever a handler is checked out or returned,
+    and those of a namespace are closed once it is released.
+    """
+
+    def __init__(self, idle_timeout=HANDLER_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # (namespace, family_socket) -> [(manager, netns inode, last used)]
+        self._idle = collections.defaultdict(list)
+
+    @contextlib.contextmanager
+    def get(self, namespace, family_socket=None):
+        key = (namespace, family_socket)
+        inode = fwaas_utils.netns_inode(namespace)
+        manager = None
+        to_close = []
+        with self._lock:
+            to_close.extend(self._pop_expired())
+            idle = self._idle[key]
+            while idle and manager is None:
+                candidate, candidate_inode, _last_used = idle.pop()
+                if candidate_inode == inode:
+                    manager = candidate
+                else:
+                    to_close.append(candidate)
+        for stale_manager in to_close:
+            stale_manager.__exit__()
+        if manager is None:
+            with fwaas_utils.in_namespace(namespace):
+                manager = ConntrackManager(family_socket).__enter__()
+        try:
+            yield manager
+        except Exception:
+            # the state of the handler is unknown
+            manager.__exit__()
+            raise
+        nfct.nfct_callback_unregister(manager.conntrack_handler)
+        with self._lock:
+            to_close = self._pop_expired()
+            self._idle[key].append((manager, inode, time.time()))
+        for stale_manager in to_close:
+            stale_manager.__exit__()
+
+    def _pop_expired(self):
+        expired = []
+        deadline = time.time() - self.idle_timeout
+        for key, idle in list(self._idle.items()):
+            expired.extend(manager for manager, _inode, last_used in idle
+                           if last_used < deadline)
+            idle[:] = [handler for handler in idle if handler[2] >= deadline]
+            if not idle:
+                del self._idle[key]
+        return expired
+
+    def release(self, namespace):
+        """Close the idle handlers of a namespace
+
+        Called once the namespace, or what used it, was removed. Handlers
+        checked out meanwhile are closed when they expire.
+        """
+        managers = []
+        with self._lock:
+            for key in list(self._idle):
+                if key[0] == namespace:
+                    managers.extend(handler[0]
+                                    for handler in self._idle.pop(key))
+        for manager in managers:
+            manager.__exit__()
+
+    def clear(self):
+        """Close all idle handlers"""
+        with self._lock:
+            managers = [handler[0] for idle in self._idle.values()
+                        for handler in idle]
+            self._idle.clear()
+        for manager in managers:
+            manager.__exit__()
+
+
+_handler_pool = ConntrackHandlerPool()
+
+
+IPVERSION_BY_SOCKET = dict((family, ipversion) for ipversion, family
+                           in nl_constants.IPVERSION_SOCKET.items())
+
+
+def _get_address(conntrack, attr, ipversion):
+    if ipversion == constants.IP_VERSION_4:
+        # the address is in network order, pack it back as it was stored
+        address = struct.pack('=I', nfct.nfct_get_attr_u32(conntrack, attr))
+    else:
+        address = ctypes.string_at(nfct.nfct_get_attr(conntrack, attr),
+                                   IPV6_ADDRESS_LENGTH)
+    return socket.inet_ntop(nl_constants.IPVERSION_SOCKET[ipversion],
+                            address)
+
+
+def _get_entry(conntrack, ipversion):
+    """Read a conntrack entry from its binary attributes
+
+    :param conntrack: conntrack object pointer
+    :param ipversion: ipversion 4 or 6
+    :return: conntrack entry in Python tuple, as returned by _parse_entry
+    example: (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')
+    Entries of protocols without ports nor icmp attributes are returned as
+    (ipversion, protocol, None, None, src, dst)
+    """
+    protocol_number = nfct.nfct_get_attr_u8(conntrack,
+                                            nl_constants.ATTR_L4PROTO)
+    protocol = PROTOCOL_NAMES.get(protocol_number, protocol_number)
+    src = _get_address(conntrack, TARGET['src'][ipversion], ipversion)
+    dst = _get_address(conntrack, TARGET['dst'][ipversion], ipversion)
+    if protocol in ('tcp', 'udp'):
+        return (ipversion, protocol,
+                socket.ntohs(nfct.nfct_get_attr_u16(
+                    conntrack, nl_constants.ATTR_PORT_SRC)),
+                socket.ntohs(nfct.nfct_get_attr_u16(
+                    conntrack, nl_constants.ATTR_PORT_DST)),
+                src, dst)
+    if protocol in ('icmp', 'icmpv6'):
+        return (ipversion, protocol,
+                nfct.nfct_get_attr_u8(conntrack, nl_constants.ATTR_ICMP_TYPE),
+                nfct.nfct_get_attr_u8(conntrack, nl_constants.ATTR_ICMP_CODE),
+                src, dst,
+                socket.ntohs(nfct.nfct_get_attr_u16(
+                    conntrack, nl_constants.ATTR_ICMP_ID)))
+    return (ipversion, protocol, None, None, src, dst)
+
+
+def _get_reply_entry(conntrack, ipversion):
+    """Read the reply tuple of a conntrack entry from its attributes
+
+    :param conntrack: conntrack object pointer
+    :param ipversion: ipversion 4 or 6
+    :return: reply tuple in Python tuple, like the entries but with only the
+    ports and addresses: (ipversion, protocol, sport, dport, src, dst), the
+    ports being None for protocols without ports
+    """
+    protocol_number = nfct.nfct_get_attr_u8(conntrack,
+                                            nl_constants.ATTR_L4PROTO)
+    protocol = PROTOCOL_NAMES.get(protocol_number, protocol_number)
+    sport = dport = None
+    if protocol in ('tcp', 'udp'):
+        sport = socket.ntohs(nfct.nfct_get_attr_u16(
+            conntrack, nl_constants.ATTR_REPL_PORT_SRC))
+        dport = socket.ntohs(nfct.nfct_get_attr_u16(
+            conntrack, nl_constants.ATTR_REPL_PORT_DST))
+    return (ipversion, protocol, sport, dport,
+            _get_address(conntrack, TARGET['reply_src'][ipversion],
+                         ipversion),
+            _get_address(conntrack, TARGET['reply_dst'][ipversion],
+                         ipversion))
+
+
 def _parse_entry(entry, ipversion):
     """Parse entry from text to Python tuple
 
@@ -212,6 +512,32 @@ def _parse_entry(entry, ipversion):
     return tuple(parsed_entry)
 
 
+def _flush_entries(namespace):
+    for ipversion in IP_VERSIONS:
+        with _handler_pool.get(
+                namespace, nl_constants.IPVERSION_SOCKET[ipversion]) \
+                as conntrack:
+            conntrack.flush_entries()
+
+
+def _delete_entries_by_filters(rule_filters, namespace, marks=None):
+    matcher = conntrack_matcher.ConntrackMatcher(rule_filters)
+    ipversions = set(rule_filter[0] for rule_filter in rule_filters)
+    deleted = 0
+    for ipversion in IP_VERSIONS:
+        if ipversion not in ipversions:
+            continue
+        family_socket = nl_constants.IPVERSION_SOCKET[ipversion]
+        with _handler_pool.get(namespace, family_socket) as conntrack, \
+                _handler_pool.get(namespace, family_socket) as deleter:
+            # an entry having several of the marks is deleted by the first
+            # dump, later ones don't return it
+            for mark in marks or [None]:
+                deleted += conntrack.delete_matching_entries(
+                    matcher, deleter, mark)
+    return deleted
+
+
 @privileged.default.entrypoint
 def flush_entries(namespace=None):
     """Delete all conntrack entries
@@ -219,31 +545,32 @@ def flush_entries(namespace=None):
     :param namespace: namespace to delete conntrack entries
     :return: None
     """
-    with fwaas_utils.in_namespace(namespace):
-        for ipversion in IP_VERSIONS:
-            with ConntrackManager(nl_constants.IPVERSION_SOCKET[ipversion]) \
-                    as conntrack:
-                conntrack.flush_entries()
+    _flush_entries(namespace)
 
 
 @privileged.default.entrypoint
-def list_entries(namespace=None):
+def list_entries(namespace=None, text=False):
     """List and parse all conntrack entries
 
     :param namespace: namespace to get conntrack entries
+    :param text: parse the entries from their text representation rather
+                 than reading their attributes, kept for comparison
     :return: sorted list of conntrack entries in Python tuple
-    example: [(4, 'icmp', '8', '0', '1.1.1.1', '2.2.2.2', '1234'),
-              (4, 'tcp', '1', '2', '1.1.1.1', '2.2.2.2')]
+    example: [(4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234),
+              (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')]
     """
     parsed_entries = []
-    with fwaas_utils.in_namespace(namespace):
-        for ipversion in IP_VERSIONS:
-            with ConntrackManager(nl_constants.IPVERSION_SOCKET[ipversion]) \
-                    as conntrack:
-                raw_entries = conntrack.list_entries()
-            for raw_entry in raw_entries:
-                parsed_entry = _parse_entry(raw_entry.split(), ipversion)
-                parsed_entries.append(parsed_entry)
+    for ipversion in IP_VERSIONS:
+        with _handler_pool.get(
+                namespace, nl_constants.IPVERSION_SOCKET[ipversion]) \
+                as conntrack:
+            if not text:
+                parsed_entries.extend(conntrack.list_parsed_entries())
+                continue
+            raw_entries = conntrack.list_entries()
+        for raw_entry in raw_entries:
+            parsed_entry = _parse_entry(raw_entry.split(), ipversion)
+            parsed_entries.append(parsed_entry)
     return sorted(parsed_entries)
 
 
@@ -262,6 +589,67 @@ def delete_entries(entries, namespace=None):
             entry_arg[attr[0]] = entry[idx + 2]
         entry_args.append(entry_arg)
 
-    with fwaas_utils.in_namespace(namespace):
-        with ConntrackManager() as conntrack:
-            conntrack.delete_entries(entry_args)
+    with _handler_pool.get(namespace) as conntrack:
+        conntrack.delete_entries(entry_args)
+
+
+@privileged.default.entrypoint
+def delete_entries_by_filters(rule_filters, namespace=None, marks=None):
+    """Delete the entries matched by firewall rule filters
+
+    Unlike list_entries followed by delete_entries, the entries are matched
+    and deleted while the conntrack table is dumped, without being returned
+    to the caller.
+
+    :param rule_filters: filters parsed from firewall rules, as tuples
+    (ip_version, protocol, sport_range, dport_range, src, dst)
+    :param namespace: namespace to delete conntrack entries
+    :param marks: list of (value, mask) connection marks, the kernel only
+    dumps the entries with one of them if given
+    :return: number of deleted entries
+    """
+    return _delete_entries_by_filters(rule_filters, namespace, marks)
+
+
+@privileged.default.entrypoint
+def release_namespace(namespace):
+    """Close the pooled conntrack handlers of a namespace
+
+    :param namespace: namespace removed, or no longer firewalled
+    :return: None
+    """
+    _handler_pool.release(namespace)
+
+
+def _process_job(job):
+    namespace, rule_filters = job[:2]
+    if rule_filters is None:
+        _flush_entries(namespace)
+        return None
+    if not rule_filters:
+        return 0
+    return _delete_entries_by_filters(rule_filters, namespace, *job[2:])
+
+
+@privileged.default.entrypoint
+def delete_entries_batch(jobs, workers=1):
+    """Delete conntrack entries in several namespaces
+
+    :param jobs: list of (namespace, rule_filters) pairs, where
+    rule_filters are as accepted by delete_entries_by_filters or None to
+    flush all the entries of the namespace, optionally followed by the
+    marks accepted by delete_entries_by_filters
+    :param workers: maximum number of namespaces processed in parallel,
+    each thread moving into its namespaces on its own
+    :return: list with, for each job, the number of deleted entries or None
+    when the namespace was flushed
+    """
+    workers = min(workers, len(jobs))
+    if workers <= 1:
+        return [_process_job(job) for job in jobs]
+    thread_pool = pool.ThreadPool(workers)
+    try:
+        return thread_pool.map(_process_job, jobs)
+    finally:
+        thread_pool.close()
+        thread_pool.join()
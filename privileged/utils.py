@@ -62,3 +62,21 @@ def in_namespace(namespace):
             os.close(new_netns_fd)
     finally:
         os.close(org_netns_fd)
+
+
+def netns_inode(namespace):
+    """Return the inode identifying a namespace, None if it doesn't exist.
+
+    A namespace deleted and created again under the same name gets a new
+    inode, which tells apart resources bound to its previous instance.
+    """
+    if not namespace:
+        path = PROCESS_NETNS
+    elif namespace.startswith('/'):
+        path = namespace
+    else:
+        path = os.path.join(pynetns.NETNS_RUN_DIR, namespace)
+    try:
+        return os.stat(path).st_ino
+    except OSError:
+        return None
@@ -45,7 +45,103 @@ FWaaSOpts = [
         'firewall_l2_driver',
         default=FW_L2_NOOP_DRIVER,
         help=_("Name of the firewall l2 driver")
-    )
+    ),
+    cfg.BoolOpt(
+        'incremental_chain_update',
+        default=False,
+        help=_("Keep a model of the iptables chains rendered for each "
+               "firewall group and, on update, only add and remove the "
+               "rules that changed instead of rebuilding the chains")),
+    cfg.IntOpt(
+        'batch_apply_workers',
+        default=1,
+        min=1,
+        help=_("Number of namespaces whose iptables rules are committed "
+               "in parallel when the firewall groups of a synchronization "
+               "round are applied as a batch")),
+    cfg.IntOpt(
+        'conntrack_workers',
+        default=1,
+        min=1,
+        help=_("Maximum number of namespaces whose connection tracking "
+               "entries are removed in parallel after a firewall group "
+               "update")),
+    cfg.BoolOpt(
+        'conntrack_async_cleanup',
+        default=False,
+        help=_("Remove the connections of updated firewall groups in the "
+               "background, so that their status is reported as soon as "
+               "their iptables rules are committed. Requests for a "
+               "namespace made while it is waiting to be processed are "
+               "merged. Only supported by the iptables v2 driver")),
+    cfg.IntOpt(
+        'conntrack_max_processes',
+        default=100,
+        min=1,
+        help=_("Maximum number of conntrack processes the legacy "
+               "conntrack driver spawns to remove the connections of a "
+               "namespace. Past it, connections are removed by coarser "
+               "filters which may also remove connections the firewall "
+               "rules didn't match")),
+    cfg.IntOpt(
+        'rule_cache_size',
+        default=4096,
+        min=0,
+        help=_("Maximum number of firewall rules whose iptables "
+               "translation is cached by the driver, least recently used "
+               "entries being evicted first. 0 disables the cache")),
+    cfg.BoolOpt(
+        'conntrack_port_marks',
+        default=False,
+        help=_("Mark the connections of each firewall group port with a "
+               "connection mark, so that the connections removed when a "
+               "firewall group is updated are only looked up among the "
+               "ones of its ports rather than in the whole router "
+               "namespace. Only supported by the iptables v2 driver")),
+    cfg.StrOpt(
+        'conntrack_port_mark_mask',
+        default='0xffff',
+        help=_("Contiguous connection mark bits, an even number of them, "
+               "used by conntrack_port_marks. The lower half identifies "
+               "the port a connection egresses from, the upper half the "
+               "port it ingresses to. They must not overlap the bits used "
+               "by the L3 agent, 0xffff0000 for address scopes")),
+    cfg.BoolOpt(
+        'forward_dispatch_chains',
+        default=False,
+        help=_("Dispatch the packets of firewall group ports to their "
+               "chains through chains grouping the ports by the first "
+               "character of their interface name, so that FORWARD holds "
+               "a fixed number of rules instead of several rules per "
+               "port. Only supported by the iptables v2 driver")),
+    cfg.BoolOpt(
+        'optimize_rules',
+        default=False,
+        help=_("Do not render the firewall rules which can't change the "
+               "verdict of their chain: duplicate rules and rules shadowed "
+               "by an earlier rule are removed, and consecutive rules "
+               "taking the same action on adjacent CIDRs or port ranges "
+               "are merged. Only supported by the iptables v2 driver")),
+    cfg.IntOpt(
+        'rule_counters_interval',
+        default=0,
+        min=0,
+        help=_("Interval, in seconds, between two readings of the packets "
+               "and bytes matched by each firewall rule applied by the "
+               "agent. 0 disables the readings")),
+    cfg.StrOpt(
+        'rule_counters_file',
+        default='$state_path/fwaas/rule_counters.json',
+        help=_("File the firewall rule counters are written to as JSON, "
+               "replaced at each reading")),
+    cfg.IntOpt(
+        'sync_page_size',
+        default=100,
+        min=1,
+        help=_("Number of firewall groups fetched per RPC when the agent "
+               "synchronizes the firewall groups of its routers with the "
+               "plugin. The rules of the groups of a page are applied and "
+               "committed while the next page is being fetched")),
 ]
 cfg.CONF.register_opts(FWaaSOpts, 'fwaas')
 
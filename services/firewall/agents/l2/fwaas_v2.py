@@ -321,6 +321,14 @@ class FWaaSV2AgentExtension(l2_extension.L2AgentExtension):
                 self._send_fwg_status(context, firewall_group['id'],
                                       status=nl_const.ERROR, host=host)
 
+    def update_firewall_group_rules(self, context, firewall_group, host):
+        """Handles update firewall group rules event
+
+        Rule deltas are only sent for firewall groups without ports of L2
+        agents, whose updates are always sent whole.
+        """
+        pass
+
     @lockutils.synchronized('fwg-port')
     def handle_port(self, context, port):
         """Handle port update event"""
@@ -13,7 +13,14 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
+import os
+
+import eventlet
+from neutron.agent.l3 import dvr_snat_ns
+from neutron.agent.l3 import namespaces
 from neutron.agent.linux import ip_lib
+from neutron.agent.linux import utils as linux_utils
 from neutron.common import rpc as n_rpc
 from neutron_lib.agent import l3_extension
 from neutron_lib import constants as nl_constants
@@ -22,15 +29,30 @@ from neutron_lib.exceptions import firewall_v2 as fw_ext
 from oslo_config import cfg
 from oslo_log import helpers as log_helpers
 from oslo_log import log as logging
+import oslo_messaging
+from oslo_serialization import jsonutils
+from oslo_service import loopingcall
+from oslo_utils import fileutils
+from oslo_utils import timeutils
 
 from neutron_fwaas.common import fwaas_constants
 from neutron_fwaas.common import resources as f_resources
+from neutron_fwaas.common import rule_deltas
 from neutron_fwaas.services.firewall.agents import firewall_agent_api as api
 from neutron_fwaas.services.firewall.agents import firewall_service
 
 
 LOG = logging.getLogger(__name__)
 
+# keys of the firewall group dicts whose values the rule list deltas apply to
+RULE_LIST_KEYS = ('revision_number',
+                  'ingress_firewall_policy_id',
+                  'ingress_firewall_policy_revision_number',
+                  'ingress_rule_list',
+                  'egress_firewall_policy_id',
+                  'egress_firewall_policy_revision_number',
+                  'egress_rule_list')
+
 
 class FWaaSL3PluginApi(api.FWaaSPluginApiMixin):
     """Agent side of the FWaaS agent-to-plugin RPC API."""
@@ -44,6 +66,21 @@ class FWaaSL3PluginApi(api.FWaaSPluginApiMixin):
         return cctxt.call(context, 'get_firewall_groups_for_project',
                 host=self.host)
 
+    def get_firewall_groups_for_host(self, context, marker=None, limit=None,
+                                     **kwargs):
+        """Fetches a page of the host's firewall groups from the plugin."""
+        LOG.debug("Fetch firewall groups of host from plugin")
+        cctxt = self.client.prepare(version='1.1')
+        return cctxt.call(context, 'get_firewall_groups_for_host',
+                          host=self.host, marker=marker, limit=limit)
+
+    def get_firewall_group_for_host(self, context, fwg_id, **kwargs):
+        """Fetches a firewall group of the host from the plugin."""
+        LOG.debug("Fetch firewall group %s from plugin", fwg_id)
+        cctxt = self.client.prepare(version='1.2')
+        return cctxt.call(context, 'get_firewall_group_for_host',
+                          host=self.host, fwg_id=fwg_id)
+
     def get_projects_with_firewall_groups(self, context, **kwargs):
         """Fetches from the plugin all projects that have firewall groups
            configured.
@@ -119,12 +156,42 @@ class FWaaSL3AgentExtension(l3_extension.L3AgentExtension):
             # NOTE: Temp location for creating service and loading driver
             self.fw_service = firewall_service.FirewallService()
             self.fwaas_driver = self.fw_service.load_device_drivers()
+            if cfg.CONF.fwaas.rule_counters_interval:
+                self._start_rule_counters_reporting()
 
         self.services_sync_needed = False
+        # rule lists of the firewall groups last applied, by group id
+        self._applied_rule_lists = {}
         self.fwplugin_rpc = FWaaSL3PluginApi(fwaas_constants.FIREWALL_PLUGIN,
                                              host)
         super(FWaaSL3AgentExtension, self).__init__()
 
+    def _start_rule_counters_reporting(self):
+        interval = cfg.CONF.fwaas.rule_counters_interval
+        self._rule_counters_loop = loopingcall.FixedIntervalLoopingCall(
+            self._report_rule_counters)
+        self._rule_counters_loop.start(interval=interval,
+                                       initial_delay=interval)
+
+    def _report_rule_counters(self):
+        """Write the counters of the firewall rules applied by the agent.
+
+        The file holds, for each firewall group, the packets and bytes
+        matched by each of its rules since they were last applied.
+        """
+        try:
+            counters = self.fwaas_driver.get_rule_counters()
+            path = cfg.CONF.fwaas.rule_counters_file
+            fileutils.ensure_tree(os.path.dirname(path), mode=0o755)
+            linux_utils.replace_file(path, jsonutils.dumps(
+                {'timestamp': timeutils.utcnow_ts(),
+                 'firewall_groups': counters}))
+            LOG.debug("Wrote the rule counters of %d firewall groups",
+                      len(counters))
+        except Exception:
+            # keep reporting at the next interval
+            LOG.exception("Failed to report the firewall rule counters")
+
     @property
     def _local_namespaces(self):
         local_ns_list = ip_lib.list_network_namespaces()
@@ -199,6 +266,7 @@ class FWaaSL3AgentExtension(l3_extension.L3AgentExtension):
         """
         port_list = self._get_in_ns_ports(ports)
         if firewall_group['status'] == nl_constants.PENDING_DELETE:
+            self._forget_rule_lists(firewall_group)
             try:
                 self.fwaas_driver.delete_firewall_group(
                     self.conf.agent_mode, port_list, firewall_group)
@@ -224,11 +292,13 @@ class FWaaSL3AgentExtension(l3_extension.L3AgentExtension):
             try:
                 self.fwaas_driver.update_firewall_group(
                     self.conf.agent_mode, port_list, firewall_group)
+                self._remember_rule_lists(firewall_group)
             except fw_ext.FirewallInternalDriverError:
                 msg = ("FWaaS driver error on %(status)s for firewall "
                        "group: %(fwg_id)s")
                 LOG.exception(msg, {'status': firewall_group['status'],
                                     'fwg_id': firewall_group['id']})
+                self._forget_rule_lists(firewall_group)
                 status = nl_constants.ERROR
 
             # Notify the plugin of firewall group's status.
@@ -311,13 +381,22 @@ class FWaaSL3AgentExtension(l3_extension.L3AgentExtension):
             self.services_sync_needed = True
 
     def delete_router(self, context, new_router):
-        """Handles router deletion. There is basically nothing to do for this
-        in the context of FWaaS with an IPTables driver; the namespace will
-        already have been deleted, taking the IPTables rules with it.
+        """Handles router deletion. The namespaces will already have been
+        deleted, taking the firewall rules with them; the driver releases
+        what it still holds for them.
         """
-        #TODO(njohnston): When another firewall driver is implemented, look at
-        # expanding this out so that the driver can handle deletion calls.
-        pass
+        if not self.fwaas_enabled:
+            return
+
+        router_id = new_router['id']
+        for namespace in (
+                namespaces.build_ns_name(namespaces.NS_PREFIX, router_id),
+                dvr_snat_ns.SnatNamespace.get_snat_ns_name(router_id)):
+            try:
+                self.fwaas_driver.release_namespace(namespace)
+            except Exception:
+                LOG.exception("FWaaS failed to release namespace %s of "
+                              "deleted router %s", namespace, router_id)
 
     def process_services_sync(self, ctx):
         """Syncs with plugin and applies the sync data.
@@ -327,28 +406,90 @@ class FWaaSL3AgentExtension(l3_extension.L3AgentExtension):
             return
 
         try:
-            # Fetch from the plugin the list of projects with firewall groups.
-            project_ids = \
-                    self.fwplugin_rpc.get_projects_with_firewall_groups(ctx)
-            LOG.debug("Projects with firewall groups: %s",
-                      ', '.join(project_ids))
-            for project_id in project_ids:
-                ctx = context.Context('', project_id)
-                fwg_list = \
-                    self.fwplugin_rpc.get_firewall_groups_for_project(ctx)
-                for firewall_group in fwg_list:
-                    if firewall_group['status'] == nl_constants.PENDING_DELETE:
-                        self.delete_firewall_group(ctx, firewall_group,
-                                                   self.host)
-                    # No need to apply sync data for ACTIVE firewall group.
-                    elif firewall_group['status'] != nl_constants.ACTIVE:
-                        self.update_firewall_group(ctx, firewall_group,
-                                                   self.host)
+            # each page is committed while the next one is being fetched
+            with contextlib.closing(
+                    self._get_firewall_groups_to_sync(ctx)) as pages:
+                for page in pages:
+                    self._sync_firewall_groups(page)
             self.services_sync_needed = False
         except Exception:
             LOG.exception("Failed FWaaS process services sync.")
             self.services_sync_needed = True
 
+    def _sync_firewall_groups(self, page):
+        """Apply a page of the firewall groups fetched from the plugin."""
+        # Context of each firewall group updated by this page, needed to
+        # report the ones whose rules failed to be committed.
+        updated_fwgs = {}
+        # The driver commits the rules of each namespace once, after all
+        # firewall groups of the page have been processed.
+        with self.fwaas_driver.batch_apply() as failed_fwg_ids:
+            for ctx, firewall_group in page:
+                if firewall_group['status'] == nl_constants.PENDING_DELETE:
+                    self.delete_firewall_group(ctx, firewall_group,
+                                               self.host)
+                # No need to apply sync data for ACTIVE firewall group.
+                elif firewall_group['status'] != nl_constants.ACTIVE:
+                    self.update_firewall_group(ctx, firewall_group,
+                                               self.host)
+                    updated_fwgs[firewall_group['id']] = ctx
+        for fwg_id in failed_fwg_ids:
+            if fwg_id not in updated_fwgs:
+                continue
+            LOG.error("FWaaS driver failed to commit the rules of "
+                      "firewall group: %s", fwg_id)
+            self.fwplugin_rpc.set_firewall_group_status(
+                updated_fwgs[fwg_id], fwg_id, nl_constants.ERROR)
+
+    def _get_firewall_groups_to_sync(self, ctx):
+        """Fetch the firewall groups to sync with the plugin.
+
+        Yields pages of the (project context, firewall group) pairs of the
+        groups with ports on the host's routers, or of all the groups of a
+        project at a time from plugins not supporting it.
+        """
+        limit = cfg.CONF.fwaas.sync_page_size
+        try:
+            fwg_list = self.fwplugin_rpc.get_firewall_groups_for_host(
+                ctx, limit=limit)
+        except (oslo_messaging.UnsupportedVersion,
+                oslo_messaging.RemoteError) as e:
+            if (isinstance(e, oslo_messaging.RemoteError) and
+                    e.exc_type not in ('UnsupportedVersion', 'NoSuchMethod')):
+                raise
+            LOG.debug("Plugin can't fetch the firewall groups of a host, "
+                      "fetching the ones of every project")
+            return self._get_project_firewall_groups(ctx)
+        return self._get_host_firewall_groups(ctx, fwg_list, limit)
+
+    def _get_host_firewall_groups(self, ctx, fwg_list, limit):
+        # the next page is fetched while the groups of the page are applied
+        # and committed
+        next_page = None
+        try:
+            while fwg_list:
+                if len(fwg_list) == limit:
+                    next_page = eventlet.spawn(
+                        self.fwplugin_rpc.get_firewall_groups_for_host, ctx,
+                        marker=fwg_list[-1]['id'], limit=limit)
+                yield [(context.Context('', firewall_group['tenant_id']),
+                        firewall_group) for firewall_group in fwg_list]
+                fwg_list = next_page.wait() if next_page else []
+                next_page = None
+        finally:
+            # the page failed to be applied, the sync is retried
+            if next_page is not None:
+                next_page.kill()
+
+    def _get_project_firewall_groups(self, ctx):
+        # Fetch from the plugin the list of projects with firewall groups.
+        project_ids = self.fwplugin_rpc.get_projects_with_firewall_groups(ctx)
+        LOG.debug("Projects with firewall groups: %s", ', '.join(project_ids))
+        for project_id in project_ids:
+            ctx = context.Context('', project_id)
+            fwg_list = self.fwplugin_rpc.get_firewall_groups_for_project(ctx)
+            yield [(ctx, firewall_group) for firewall_group in fwg_list]
+
     @log_helpers.log_method_call
     def create_firewall_group(self, context, firewall_group, host):
         """Handles RPC from plugin to create a firewall group.
@@ -376,10 +517,12 @@ class FWaaSL3AgentExtension(l3_extension.L3AgentExtension):
             self.fwaas_driver.create_firewall_group(self.conf.agent_mode,
                                                     ports_for_fwg,
                                                     firewall_group)
+            self._remember_rule_lists(firewall_group)
         except fw_ext.FirewallInternalDriverError:
             msg = ("FWaaS driver error in create_firewall_group "
                    "for firewall group: %(fwg_id)s")
             LOG.exception(msg, {'fwg_id': firewall_group['id']})
+            self._forget_rule_lists(firewall_group)
             status = nl_constants.ERROR
 
         # Send firewall group's status to plugin.
@@ -474,6 +617,11 @@ class FWaaSL3AgentExtension(l3_extension.L3AgentExtension):
             else:
                 status = nl_constants.INACTIVE
 
+        if status in (nl_constants.ACTIVE, nl_constants.DOWN):
+            self._remember_rule_lists(firewall_group)
+        else:
+            self._forget_rule_lists(firewall_group)
+
         # Return status to plugin.
         try:
             self.fwplugin_rpc.set_firewall_group_status(context,
@@ -483,11 +631,82 @@ class FWaaSL3AgentExtension(l3_extension.L3AgentExtension):
                           "for firewall group: %s", firewall_group['id'])
             self.services_sync_needed = True
 
+    def _remember_rule_lists(self, firewall_group):
+        self._applied_rule_lists[firewall_group['id']] = dict(
+            (key, firewall_group.get(key)) for key in RULE_LIST_KEYS)
+
+    def _forget_rule_lists(self, firewall_group):
+        self._applied_rule_lists.pop(firewall_group['id'], None)
+
+    def _apply_firewall_group_delta(self, firewall_group_delta):
+        """Return the firewall group resulting from a delta.
+
+        None is returned if the delta doesn't apply to the revisions of the
+        group and of its policies last applied.
+        """
+        applied = self._applied_rule_lists.get(firewall_group_delta['id'])
+        if (not applied or applied['revision_number'] !=
+                firewall_group_delta['base_revision_number']):
+            return None
+        firewall_group = dict(firewall_group_delta)
+        for direction in ('ingress', 'egress'):
+            delta = firewall_group.pop('%s_rule_list_delta' % direction)
+            policy_key = '%s_firewall_policy_id' % direction
+            revision_key = '%s_firewall_policy_revision_number' % direction
+            if (applied[policy_key] != firewall_group[policy_key] or
+                    applied[revision_key] != delta['base_revision_number']):
+                return None
+            firewall_group['%s_rule_list' % direction] = (
+                rule_deltas.apply_rule_list_delta(
+                    applied['%s_rule_list' % direction], delta))
+        return firewall_group
+
+    @log_helpers.log_method_call
+    def update_firewall_group_rules(self, context, firewall_group, host):
+        """Handles RPC from plugin to update the rules of a firewall group.
+
+        The rule lists of the group are given as deltas from the revisions
+        last applied. If the agent missed a revision, the whole group is
+        fetched from the plugin and applied instead.
+        """
+        if not self._get_firewall_group_ports(context, firewall_group):
+            return
+        firewall_group_delta = firewall_group
+        fwg_id = firewall_group_delta['id']
+        firewall_group = self._apply_firewall_group_delta(firewall_group_delta)
+        if firewall_group is None:
+            LOG.info("Firewall group %s rule deltas don't apply to the "
+                     "revisions applied, fetching it", fwg_id)
+            self._forget_rule_lists(firewall_group_delta)
+            try:
+                firewall_group = self.fwplugin_rpc.get_firewall_group_for_host(
+                    context, fwg_id)
+            except Exception:
+                LOG.exception("FWaaS RPC failure in "
+                              "update_firewall_group_rules for firewall "
+                              "group: %s", fwg_id)
+                # the group must not stay pending, and is applied whole by
+                # its next update
+                try:
+                    self.fwplugin_rpc.set_firewall_group_status(
+                        context, fwg_id, nl_constants.ERROR)
+                except Exception:
+                    LOG.exception("FWaaS RPC failure in "
+                                  "update_firewall_group_rules for firewall "
+                                  "group: %s", fwg_id)
+                    self.services_sync_needed = True
+                return
+            if firewall_group is None:
+                LOG.debug("Firewall group %s was deleted meanwhile", fwg_id)
+                return
+        self.update_firewall_group(context, firewall_group, host)
+
     @log_helpers.log_method_call
     def delete_firewall_group(self, context, firewall_group, host):
         """Handles RPC from plugin to delete a firewall group.
         """
 
+        self._forget_rule_lists(firewall_group)
         ports_for_fwg = self._get_firewall_group_ports(context, firewall_group,
                                                        to_delete=True)
 
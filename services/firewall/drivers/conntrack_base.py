@@ -47,9 +47,45 @@ class ConntrackDriverBase(object):
         """Initialize the driver"""
 
     @abc.abstractmethod
-    def delete_entries(self, rules, namespace):
-        """Delete conntrack entries specified by list of rules"""
+    def delete_entries(self, rules, namespace, marks=None):
+        """Delete conntrack entries specified by list of rules
+
+        :param marks: list of (value, mask) connection marks, only the
+                      entries with one of them are looked up if given
+        """
 
     @abc.abstractmethod
     def flush_entries(self, namespace):
         """Delete all conntrack entries within namespace"""
+
+    def release_namespace(self, namespace):
+        """Release what the driver holds for a namespace
+
+        Called once the namespace was removed, or a firewall group was
+        removed from it. Drivers holding nothing per namespace don't need
+        to override it.
+        """
+
+    def delete_entries_batch(self, jobs, workers=1):
+        """Delete conntrack entries within several namespaces
+
+        :param jobs: list of (namespace, rules) pairs, rules being the list
+                     of firewall rules whose entries are deleted, or None to
+                     delete all the entries of the namespace. Jobs with
+                     rules may hold the connection marks the entries are
+                     looked up among as a third item
+        :param workers: maximum number of namespaces processed in parallel,
+                        drivers may process them sequentially
+        :returns: dict of the number of entries deleted by namespace, None
+                  when the namespace was flushed or the number is unknown
+        """
+        counts = {}
+        for job in jobs:
+            namespace, rules = job[:2]
+            if rules is None:
+                self.flush_entries(namespace)
+                counts[namespace] = None
+            else:
+                counts[namespace] = self.delete_entries(rules, namespace,
+                                                        *job[2:])
+        return counts
@@ -14,6 +14,7 @@
 #    under the License.
 
 import abc
+import contextlib
 
 import six
 
@@ -95,3 +96,30 @@ class FwaasDriverBase(object):
         interfaces.
         """
         pass
+
+    def release_namespace(self, namespace):
+        """Release the resources held for a namespace which was removed.
+
+        Drivers which hold no resource per namespace don't need to
+        override it.
+        """
+        pass
+
+    @contextlib.contextmanager
+    def batch_apply(self):
+        """Group the changes made within the block into a single commit.
+
+        Yields a set which, once the block exits, holds the ids of the
+        firewall groups whose changes failed to be committed. Drivers which
+        apply every change immediately don't need to override it.
+        """
+        yield set()
+
+    def get_rule_counters(self):
+        """Return the traffic matched by the rules of the firewall groups.
+
+        Returns a dict of the firewall group ids to dicts of their rule ids
+        to {'packets': n, 'bytes': n}. Drivers which don't count the
+        traffic matched by the rules return an empty dict.
+        """
+        return {}
@@ -0,0 +1,233 @@
+# Copyright (c) 2018
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import bisect
+
+import netaddr
+
+# protocols whose conntrack entries carry source and destination ports
+PORT_PROTOCOLS = ('tcp', 'udp')
+# protocol names used by firewall rules which differ from the conntrack ones
+PROTOCOL_ALIASES = {'ipv6-icmp': 'icmpv6'}
+MIN_PORT = 0
+MAX_PORT = 65535
+
+
+def _port_range(port_range):
+    """Return the (lower, upper) bounds of a rule filter port range."""
+    if not port_range:
+        return None
+    ports = [int(port) for port in port_range]
+    return min(ports[0], ports[-1]), max(ports[0], ports[-1])
+
+
+def _address_range(address):
+    """Return the (first, last) integer bounds of a rule filter address."""
+    if not address:
+        return None
+    if '-' in address:
+        first, last = address.split('-', 1)
+        ip_range = netaddr.IPRange(first.strip(), last.strip())
+    else:
+        ip_range = netaddr.IPNetwork(address)
+    return ip_range.first, ip_range.last
+
+
+def get_translated_entry(entry, reply_entry):
+    """Return the entry as seen from its reply tuple, if it is NATed
+
+    The reply of a connection is sent from its destination, after DNAT, to
+    its source, after SNAT, e.g. from the fixed IP of a floating IP
+    connection, which the firewall rules see rather than the floating IP.
+
+    :param entry: parsed conntrack entry
+    :param reply_entry: parsed reply tuple of the entry, or None
+    :returns: the entry with the addresses, and ports, of the reply tuple
+              swapped, or None if they are the ones of the entry
+    """
+    if reply_entry is None:
+        return None
+    translated = list(entry)
+    translated[4], translated[5] = reply_entry[5], reply_entry[4]
+    if entry[1] in PORT_PROTOCOLS:
+        translated[2], translated[3] = reply_entry[3], reply_entry[2]
+    translated = tuple(translated)
+    return None if translated == entry else translated
+
+
+class _CompiledFilter(object):
+    __slots__ = ('sport', 'dport', 'src', 'dst')
+
+    def __init__(self, rule_filter):
+        rule_filter = tuple(rule_filter) + (None,) * (6 - len(rule_filter))
+        self.sport = _port_range(rule_filter[2])
+        self.dport = _port_range(rule_filter[3])
+        self.src = _address_range(rule_filter[4])
+        self.dst = _address_range(rule_filter[5])
+
+    @property
+    def has_ports(self):
+        return bool(self.sport or self.dport)
+
+    def match(self, entry, values):
+        """Check the source port and addresses of an entry
+
+        The destination port has already been checked by the index.
+
+        :param entry: parsed conntrack entry
+        :param values: function returning the values, integers for the
+                       addresses, at a given position of the entry and of
+                       its translated entry if it is NATed
+        """
+        for bounds, position in ((self.sport, 2), (self.src, 4),
+                                 (self.dst, 5)):
+            if (not bounds or
+                    (position == 2 and entry[1] not in PORT_PROTOCOLS)):
+                continue
+            if not any(bounds[0] <= value <= bounds[1]
+                       for value in values(position)):
+                return False
+        return True
+
+
+class _PortIndex(object):
+    """Index of filters by the destination port range they match
+
+    The port space is cut into the elementary segments delimited by the
+    bounds of all the ranges, each segment holding the filters which cover
+    it, so that the candidates for a port are found with one bisection.
+    """
+
+    def __init__(self, compiled_filters):
+        bounds = set([MIN_PORT])
+        for compiled in compiled_filters:
+            lower, upper = compiled.dport or (MIN_PORT, MAX_PORT)
+            bounds.add(lower)
+            bounds.add(upper + 1)
+        self.starts = sorted(bound for bound in bounds if bound <= MAX_PORT)
+        self.segments = [[] for _start in self.starts]
+        for compiled in compiled_filters:
+            lower, upper = compiled.dport or (MIN_PORT, MAX_PORT)
+            first = bisect.bisect_left(self.starts, lower)
+            last = bisect.bisect_right(self.starts, upper)
+            for segment in self.segments[first:last]:
+                segment.append(compiled)
+
+    def lookup(self, port):
+        return self.segments[bisect.bisect_right(self.starts, port) - 1]
+
+
+class ConntrackMatcher(object):
+    """Select the conntrack entries matched by a set of rule filters
+
+    Rule filters are tuples parsed from firewall rules:
+        (ip_version, protocol, sport_range, dport_range, src, dst)
+    where port ranges are lists of one or two ports and addresses are
+    CIDRs or 'first-last' ranges; empty values match anything.
+
+    Entries are parsed conntrack entries:
+        (ip_version, protocol, sport, dport, src, dst)
+        (ip_version, protocol, type, code, src, dst, id) for icmp
+
+    Filters are compiled once into per (ip_version, protocol) destination
+    port indexes, so matching an entry costs a dictionary lookup and a
+    bisection whatever the number of filters.
+
+    The reply tuple of NATed entries, parsed like the entries, can be
+    given too: their addresses and ports then match the filters if either
+    the ones of the entry or the ones of its reply tuple do, as the rules
+    see the connections after DNAT.
+    """
+
+    def __init__(self, rule_filters):
+        # (ip_version, protocol) -> _PortIndex for tcp and udp,
+        # list of filters for the other protocols
+        self._index = {}
+        # ip_version -> filters without protocol
+        self._any_protocol = {}
+        by_key = {}
+        for rule_filter in rule_filters:
+            compiled = _CompiledFilter(rule_filter)
+            protocol = rule_filter[1] or None
+            protocol = PROTOCOL_ALIASES.get(protocol, protocol)
+            if protocol is None:
+                self._any_protocol.setdefault(rule_filter[0], []).append(
+                    compiled)
+            elif protocol in PORT_PROTOCOLS or not compiled.has_ports:
+                by_key.setdefault((rule_filter[0], protocol), []).append(
+                    compiled)
+        for key, compiled_filters in by_key.items():
+            if key[1] in PORT_PROTOCOLS:
+                self._index[key] = _PortIndex(compiled_filters)
+            else:
+                self._index[key] = compiled_filters
+
+    def _candidates(self, entry):
+        ip_version, protocol = entry[0], entry[1]
+        index = self._index.get((ip_version, protocol))
+        if protocol in PORT_PROTOCOLS:
+            candidates = index.lookup(entry[3]) if index else []
+            dport = entry[3]
+            for compiled in self._any_protocol.get(ip_version, ()):
+                if (not compiled.dport or
+                        compiled.dport[0] <= dport <= compiled.dport[1]):
+                    candidates = candidates + [compiled]
+            return candidates
+        candidates = index or []
+        for compiled in self._any_protocol.get(ip_version, ()):
+            # ports only exist for tcp and udp
+            if not compiled.has_ports:
+                candidates = candidates + [compiled]
+        return candidates
+
+    def match(self, entry, reply_entry=None):
+        """Return True if the entry is matched by any of the filters.
+
+        :param reply_entry: parsed reply tuple of the entry, if known
+        """
+        views = [entry]
+        translated = get_translated_entry(entry, reply_entry)
+        if translated:
+            views.append(translated)
+        candidates = []
+        for view in views:
+            candidates.extend(self._candidates(view))
+        if not candidates:
+            return False
+        values = {}
+
+        def _values(position):
+            if position not in values:
+                view_values = set(view[position] for view in views)
+                if position != 2:
+                    view_values = [int(netaddr.IPAddress(value))
+                                   for value in view_values]
+                values[position] = tuple(view_values)
+            return values[position]
+
+        for compiled in candidates:
+            if compiled.match(entry, _values):
+                return True
+        return False
+
+    def select(self, entries, reply_entries=None):
+        """Return the entries matched by the filters, in the same order.
+
+        :param reply_entries: dict of the reply tuples of NATed entries by
+                              entry, looked up once each entry is read
+        """
+        return [entry for entry in entries
+                if self.match(entry, None if reply_entries is None
+                              else reply_entries.get(entry))]
@@ -0,0 +1,142 @@
+# Copyright (c) 2018
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+
+import eventlet
+from oslo_log import log as logging
+from oslo_utils import timeutils
+
+LOG = logging.getLogger(__name__)
+
+
+class _CleanupJob(object):
+    """Connections waiting to be removed from a namespace
+
+    rules is None when the namespace must be flushed, marks is None when
+    the entries are looked up in the whole namespace.
+    """
+
+    def __init__(self, rules, marks):
+        self.rules = None if rules is None else list(rules)
+        self.marks = None if marks is None else list(marks)
+        self.watch = timeutils.StopWatch()
+        self.watch.start()
+
+    def merge(self, rules, marks):
+        """Extend the job to also remove the connections of another one.
+
+        The merged job may remove more connections than the two jobs would
+        separately, e.g. the entries of the rules of one job having the
+        marks of the other.
+        """
+        if self.rules is None or rules is None:
+            self.rules = None
+            self.marks = None
+            return
+        self.rules.extend(rules)
+        if self.marks is None or marks is None:
+            self.marks = None
+        else:
+            self.marks.extend(mark for mark in marks
+                              if mark not in self.marks)
+
+
+class ConntrackCleanupQueue(object):
+    """Remove conntrack entries in the background
+
+    Requests for a namespace are queued until a worker processes them;
+    requests made meanwhile for the same namespace are merged into the
+    queued one, and a namespace is never processed by two workers at once.
+    """
+
+    def __init__(self, conntrack, workers=1, on_failure=None):
+        """
+        :param conntrack: conntrack driver removing the entries
+        :param workers: maximum number of namespaces processed in parallel
+        :param on_failure: function called with the namespace whose
+                           connections failed to be removed
+        """
+        self.conntrack = conntrack
+        self._on_failure = on_failure
+        self._pool = eventlet.GreenPool(workers)
+        # namespace -> job waiting to be processed
+        self._pending = collections.OrderedDict()
+        # namespaces a worker is processing
+        self._running = set()
+        self.stats = collections.Counter()
+
+    def enqueue(self, namespace, rules, marks=None):
+        """Queue the removal of the connections of a namespace
+
+        :param rules: firewall rules whose connections are removed, or None
+                      to remove all the connections of the namespace
+        :param marks: connection marks the entries are looked up among
+        """
+        self.stats['enqueued'] += 1
+        job = self._pending.get(namespace)
+        if job is not None:
+            job.merge(rules, marks)
+            self.stats['coalesced'] += 1
+            return
+        self._pending[namespace] = _CleanupJob(rules, marks)
+        if namespace not in self._running:
+            self._running.add(namespace)
+            self._pool.spawn_n(self._run, namespace)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def wait(self):
+        """Wait until all the queued jobs are processed."""
+        self._pool.waitall()
+
+    def _run(self, namespace):
+        try:
+            while namespace in self._pending:
+                self._process(namespace, self._pending.pop(namespace))
+        finally:
+            self._running.discard(namespace)
+
+    def _process(self, namespace, job):
+        queued = job.watch.elapsed()
+        watch = timeutils.StopWatch()
+        watch.start()
+        try:
+            if job.rules is None:
+                self.conntrack.flush_entries(namespace)
+                deleted = None
+            elif job.marks is None:
+                deleted = self.conntrack.delete_entries(job.rules, namespace)
+            else:
+                deleted = self.conntrack.delete_entries(job.rules, namespace,
+                                                        job.marks)
+        except Exception:
+            # nobody waits for the job, so the worker reports all failures
+            LOG.exception("Failed to remove connections in namespace %s",
+                          namespace)
+            self.stats['failed'] += 1
+            if self._on_failure:
+                self._on_failure(namespace)
+            return
+        watch.stop()
+        self.stats['completed'] += 1
+        self.stats['deleted'] += deleted or 0
+        LOG.info("Removed %(deleted)s connections in namespace %(ns)s in "
+                 "%(time).3f seconds after %(queued).3f seconds in queue, "
+                 "%(pending)d namespaces pending",
+                 {'deleted': 'all' if deleted is None else deleted,
+                  'ns': namespace, 'time': watch.elapsed(),
+                  'queued': queued, 'pending': len(self._pending)})
@@ -16,6 +16,7 @@
 from neutron.agent.linux import iptables_manager
 from neutron.common import utils
 from neutron_lib.exceptions import firewall_v1 as f_exc
+from oslo_config import cfg
 from oslo_log import log as logging
 
 from neutron_fwaas.common import fwaas_constants as f_const
@@ -255,32 +256,36 @@ class IptablesFwaasDriver(fwaas_base.FwaasDriverBase):
     def _find_new_rules(self, pre_firewall, firewall):
         return self._find_removed_rules(firewall, pre_firewall)
 
+    def _get_namespaces(self, agent_mode, apply_list):
+        """Return the namespaces the apply list spans, without duplicates."""
+        namespaces = []
+        for router_info in set(apply_list):
+            for ipt_if_prefix in self._get_ipt_mgrs_with_if_prefix(
+                    agent_mode, router_info):
+                namespace = ipt_if_prefix['ipt'].namespace
+                if namespace not in namespaces:
+                    namespaces.append(namespace)
+        return namespaces
+
     def _remove_conntrack_new_firewall(self, agent_mode, apply_list, firewall):
         """Remove conntrack when create new firewall"""
-        routers_list = list(set(apply_list))
-        for router_info in routers_list:
-            ipt_if_prefix_list = self._get_ipt_mgrs_with_if_prefix(
-                agent_mode, router_info)
-            for ipt_if_prefix in ipt_if_prefix_list:
-                ipt_mgr = ipt_if_prefix['ipt']
-                self.conntrack.flush_entries(ipt_mgr.namespace)
+        namespaces = self._get_namespaces(agent_mode, apply_list)
+        self.conntrack.delete_entries_batch(
+            [(namespace, None) for namespace in namespaces],
+            cfg.CONF.fwaas.conntrack_workers)
 
     def _remove_conntrack_updated_firewall(self, agent_mode,
                                            apply_list, pre_firewall, firewall):
         """Remove conntrack when updated firewall"""
-        router_list = list(set(apply_list))
-        for router_info in router_list:
-            ipt_if_prefix_list = self._get_ipt_mgrs_with_if_prefix(
-                agent_mode, router_info)
-            for ipt_if_prefix in ipt_if_prefix_list:
-                ipt_mgr = ipt_if_prefix['ipt']
-                ch_rules = self._find_changed_rules(pre_firewall,
-                                                    firewall)
-                i_rules = self._find_new_rules(pre_firewall, firewall)
-                r_rules = self._find_removed_rules(pre_firewall, firewall)
-                removed_conntrack_rules_list = ch_rules + i_rules + r_rules
-                self.conntrack.delete_entries(removed_conntrack_rules_list,
-                                              ipt_mgr.namespace)
+        ch_rules = self._find_changed_rules(pre_firewall, firewall)
+        i_rules = self._find_new_rules(pre_firewall, firewall)
+        r_rules = self._find_removed_rules(pre_firewall, firewall)
+        removed_conntrack_rules_list = ch_rules + i_rules + r_rules
+        namespaces = self._get_namespaces(agent_mode, apply_list)
+        self.conntrack.delete_entries_batch(
+            [(namespace, removed_conntrack_rules_list)
+             for namespace in namespaces],
+            cfg.CONF.fwaas.conntrack_workers)
 
     def _remove_default_chains(self, nsid):
         """Remove fwaas default policy chain."""
@@ -13,13 +13,26 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
+import re
+
+import eventlet
+from neutron.agent.linux import ipset_manager
 from neutron.agent.linux import iptables_manager
+from neutron.agent.linux import utils as linux_utils
 from neutron.common import utils
+from neutron_lib import constants
 from neutron_lib.exceptions import firewall_v2 as fw_ext
+from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import timeutils
 
+from neutron_fwaas._i18n import _
 from neutron_fwaas.services.firewall.drivers import conntrack_base
 from neutron_fwaas.services.firewall.drivers import fwaas_base_v2
+from neutron_fwaas.services.firewall.drivers.linux import conntrack_queue
+from neutron_fwaas.services.firewall.drivers.linux import rule_optimizer
 
 LOG = logging.getLogger(__name__)
 FWAAS_DRIVER_NAME = 'Fwaas iptables driver'
@@ -32,6 +45,26 @@ INGRESS_DIRECTION = 'ingress'
 EGRESS_DIRECTION = 'egress'
 CHAIN_NAME_PREFIX = {INGRESS_DIRECTION: 'i',
                      EGRESS_DIRECTION: 'o'}
+# prefix of the mangle chains marking the connections of the ports
+MARK_CHAIN_PREFIX = 'm'
+# maximum number of ports whose connections are looked up by their marks,
+# each port costing two dumps of the conntrack table against one for a
+# lookup in the whole namespace
+CONNTRACK_MARKS_MAX_PORTS = 4
+# prefix of the ids of the ipsets holding the addresses of address groups
+ADDRESS_GROUP_SET_PREFIX = 'fwag'
+ETHERTYPES = {constants.IP_VERSION_4: constants.IPv4,
+              constants.IP_VERSION_6: constants.IPv6}
+ADDRESS_GROUP_ATTRS = ('source_address_groups', 'destination_address_groups')
+# maximum number of ports of a multiport match, a range counting as two
+MULTIPORT_MAX_PORTS = 15
+# prefixes of the FORWARD dispatch chains jumping to the firewall group
+# chains and to the default policy chain, dispatch chains being shared by
+# the firewall groups of a namespace
+JUMP_DISPATCH_CHAIN_PREFIX = 'fwj'
+DEFAULT_DISPATCH_CHAIN_PREFIX = 'fwd'
+# first characters of the interface names dispatch chains are made for
+DISPATCH_CHARS = '0123456789abcdef'
 
 """ Firewall rules are applied on internal-interfaces of Neutron router.
     The packets ingressing tenant's network will be on the output
@@ -43,12 +76,20 @@ IPV4 = 'ipv4'
 IPV6 = 'ipv6'
 IP_VER_TAG = {IPV4: 'v4',
               IPV6: 'v6'}
+# commands dumping the rules of a table with their counters
+IPTABLES_SAVE_CMDS = {IPV4: 'iptables-save', IPV6: 'ip6tables-save'}
+# rule of an iptables-save -c dump: [packets:bytes] -A chain ...
+COUNTED_RULE_RE = re.compile(r'^\[(\d+):(\d+)\] -A (\S+) ')
 
 INTERNAL_DEV_PREFIX = 'qr-'
 SNAT_INT_DEV_PREFIX = 'sg-'
 ROUTER_2_FIP_DEV_PREFIX = 'rfp-'
 
 MAX_INTF_NAME_LEN = 14
+# rule attributes the iptables translation of a rule depends on
+RULE_CACHE_KEY_ATTRS = ('action', 'protocol', 'source_ip_address',
+                        'destination_ip_address', 'source_port',
+                        'destination_port')
 
 
 class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
@@ -56,8 +97,52 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
 
     def __init__(self):
         LOG.debug("Initializing fwaas iptables driver")
-        self.pre_firewall = None
+        # (fwid, namespace) -> rule lists of the last firewall group applied
+        self._applied_firewalls = {}
         self.conntrack = conntrack_base.load_and_init_conntrack_driver()
+        self.conntrack_cleanup_queue = None
+        if cfg.CONF.fwaas.conntrack_async_cleanup:
+            self.conntrack_cleanup_queue = (
+                conntrack_queue.ConntrackCleanupQueue(
+                    self.conntrack, cfg.CONF.fwaas.conntrack_workers,
+                    self._forget_namespace))
+        self.incremental_chain_update = cfg.CONF.fwaas.incremental_chain_update
+        # (fwid, namespace, if_prefix) -> rendered chains last applied
+        self._chain_models = {}
+        # iptables managers waiting for the end of a batch to be committed
+        self._pending_apply = None
+        # calls to run once the rules of the batch are committed
+        self._pending_after_apply = []
+        # rule attributes -> iptables rule, in least recently used order
+        self._rule_cache = collections.OrderedDict()
+        self._rule_cache_size = cfg.CONF.fwaas.rule_cache_size
+        self.rule_cache_hits = 0
+        self.rule_cache_misses = 0
+        self.forward_dispatch_chains = (
+            cfg.CONF.fwaas.forward_dispatch_chains)
+        self.optimize_rules = cfg.CONF.fwaas.optimize_rules
+        self.conntrack_port_marks = cfg.CONF.fwaas.conntrack_port_marks
+        if self.conntrack_port_marks:
+            self._mark_shift, self._mark_bits = self._parse_mark_mask(
+                cfg.CONF.fwaas.conntrack_port_mark_mask)
+        # namespace -> {port id: index of the port in the connection marks},
+        # an index being kept as long as connections may carry it
+        self._port_marks = {}
+        # (fwid, namespace) -> ports marked by the firewall group mark chain
+        self._mark_chain_ports = {}
+        # namespace -> ports all the connections of which carry their mark,
+        # i.e. ports marked since the namespace connections were flushed
+        self._marked_ports = {}
+        # namespace -> ipset manager of the address group sets
+        self._ipset_managers = {}
+        # (fwid, namespace) -> (set id, ethertype) of the address group sets
+        # the firewall group rules match
+        self._address_group_sets = {}
+        # namespace -> (set id, ethertype) of the address group sets created
+        self._ipsets = {}
+        # (fwid, namespace) -> {ip version: {chain name: id of the firewall
+        # rule of each iptables rule of the chain}}
+        self._rule_chains = {}
 
     def _get_intf_name(self, if_prefix, port_id):
         _name = "%s%s" % (if_prefix, port_id)
@@ -69,9 +154,9 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
         try:
             if firewall['admin_state_up']:
                 self._setup_firewall(agent_mode, apply_list, firewall)
-                self._remove_conntrack_new_firewall(agent_mode,
-                                                    apply_list, firewall)
-                self.pre_firewall = dict(firewall)
+                self._after_apply(firewall['id'],
+                                  self._remove_conntrack_new_firewall,
+                                  agent_mode, apply_list, firewall)
             else:
                 self.apply_default_policy(agent_mode, apply_list, firewall)
         except (LookupError, RuntimeError):
@@ -117,8 +202,9 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
                     self._remove_chains(fwid, ipt_mgr)
                     self._remove_default_chains(ipt_mgr)
                     # apply the changes immediately (no defer in firewall path)
-                    ipt_mgr.defer_apply_off()
-            self.pre_firewall = None
+                    self._apply(ipt_mgr, fwid)
+            self._after_apply(fwid, self._forget_applied_firewall,
+                              agent_mode, apply_list, fwid)
         except (LookupError, RuntimeError):
             # catch known library exceptions and raise Fwaas generic exception
             LOG.exception("Failed to delete firewall: %s", fwid)
@@ -130,15 +216,11 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
         try:
             if firewall['admin_state_up']:
                 self._setup_firewall(agent_mode, apply_list, firewall)
-                if self.pre_firewall:
-                    self._remove_conntrack_updated_firewall(agent_mode,
-                                    apply_list, self.pre_firewall, firewall)
-                else:
-                    self._remove_conntrack_new_firewall(agent_mode,
-                                                    apply_list, firewall)
+                self._after_apply(firewall['id'],
+                                  self._remove_conntrack_updated_firewall,
+                                  agent_mode, apply_list, firewall)
             else:
                 self.apply_default_policy(agent_mode, apply_list, firewall)
-            self.pre_firewall = dict(firewall)
         except (LookupError, RuntimeError):
             # catch known library exceptions and raise Fwaas generic exception
             LOG.exception("Failed to update firewall: %s", firewall['id'])
@@ -164,7 +246,9 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
                                               router_fw_ports)
 
                     # apply the changes immediately (no defer in firewall path)
-                    ipt_mgr.defer_apply_off()
+                    self._apply(ipt_mgr, fwid)
+            self._after_apply(fwid, self._forget_applied_firewall,
+                              agent_mode, apply_list, fwid)
         except (LookupError, RuntimeError):
             # catch known library exceptions and raise Fwaas generic exception
             LOG.exception(
@@ -173,79 +257,319 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
 
     def _setup_firewall(self, agent_mode, apply_list, firewall):
         fwid = firewall['id']
+        if self.optimize_rules:
+            firewall = self._optimize_firewall(firewall)
+        address_groups = self._get_address_group_members(firewall)
+        namespaces = []
         for ri, router_fw_ports in apply_list:
             ipt_if_prefix_list = self._get_ipt_mgrs_with_if_prefix(
                 agent_mode, ri)
             for ipt_if_prefix in ipt_if_prefix_list:
                 ipt_mgr = ipt_if_prefix['ipt']
-                # the following only updates local memory; no hole in FW
-                self._remove_chains(fwid, ipt_mgr)
-                self._remove_default_chains(ipt_mgr)
+                # the sets must exist before the rules matching them
+                self._setup_address_groups(fwid, ipt_mgr.namespace,
+                                           address_groups)
+                namespaces.append(ipt_mgr.namespace)
+                self._setup_dispatch_chains(ipt_if_prefix)
+                rule_ids = {}
+                rendered = self._render_chains(firewall, ipt_if_prefix,
+                                               router_fw_ports, rule_ids)
+                self._rule_chains[(fwid, ipt_mgr.namespace)] = rule_ids
+                model_key = self._get_chain_model_key(fwid, ipt_if_prefix)
+                model = self._get_valid_chain_model(fwid, ipt_if_prefix)
+                if model:
+                    # only push the rules which differ from the last ones
+                    self._update_chains(ipt_mgr, model['rules'], rendered)
+                else:
+                    # the following only updates local memory; no hole in FW
+                    self._remove_chains(fwid, ipt_mgr)
+                    self._remove_default_chains(ipt_mgr)
 
-                # create default 'DROP ALL' policy chain
-                self._add_default_policy_chain_v4v6(ipt_mgr)
-                # create chain based on configured policy
-                self._setup_chains(firewall, ipt_if_prefix, router_fw_ports)
+                    # create default 'DROP ALL' policy chain
+                    self._add_default_policy_chain_v4v6(ipt_mgr)
+                    # create chain based on configured policy
+                    self._setup_chains(ipt_mgr, rendered)
+                if self.incremental_chain_update:
+                    self._chain_models[model_key] = {'ipt': ipt_mgr,
+                                                     'rules': rendered}
+                if self.conntrack_port_marks:
+                    self._setup_port_marks(fwid, ipt_if_prefix,
+                                           router_fw_ports)
 
                 # apply the changes immediately (no defer in firewall path)
+                self._apply(ipt_mgr, fwid)
+        self._after_apply(fwid, self._remove_unused_address_groups,
+                          namespaces)
+        LOG.debug("Firewall rule cache: %(size)d entries, %(hits)d hits, "
+                  "%(misses)d misses",
+                  {'size': len(self._rule_cache),
+                   'hits': self.rule_cache_hits,
+                   'misses': self.rule_cache_misses})
+
+    @contextlib.contextmanager
+    def batch_apply(self):
+        """Commit the iptables changes made within the block at its end.
+
+        Every namespace touched within the block is committed exactly once
+        when the block exits, on up to 'batch_apply_workers' namespaces in
+        parallel. The yielded set is filled with the ids of the firewall
+        groups whose namespace failed to be committed.
+        """
+        if self._pending_apply is not None:
+            # nested batch, the outermost one commits
+            yield set()
+            return
+        self._pending_apply = collections.OrderedDict()
+        failed_fwids = set()
+        try:
+            yield failed_fwids
+        finally:
+            pending, self._pending_apply = self._pending_apply, None
+            after_apply, self._pending_after_apply = (
+                self._pending_after_apply, [])
+            failed_fwids.update(self._commit_batch(list(pending.values())))
+            # the rules in place of failed firewalls are unknown
+            for fwid, namespace in list(self._applied_firewalls):
+                if fwid in failed_fwids:
+                    del self._applied_firewalls[(fwid, namespace)]
+                    self._marked_ports.pop(namespace, None)
+            for fwid, func, args in after_apply:
+                if fwid in failed_fwids:
+                    continue
+                try:
+                    func(*args)
+                except (LookupError, RuntimeError):
+                    LOG.exception("Failed to clean up connections of "
+                                  "firewall: %s", fwid)
+                    failed_fwids.add(fwid)
+
+    def _apply(self, ipt_mgr, fwid):
+        """Commit the changes of an iptables manager, unless batching."""
+        if self._pending_apply is None:
+            ipt_mgr.defer_apply_off()
+            return
+        _ipt_mgr, fwids = self._pending_apply.setdefault(
+            id(ipt_mgr), (ipt_mgr, set()))
+        fwids.add(fwid)
+
+    def _after_apply(self, fwid, func, *args):
+        """Call func once the rules of the firewall group are committed."""
+        if self._pending_apply is None:
+            func(*args)
+        else:
+            self._pending_after_apply.append((fwid, func, args))
+
+    def _commit_batch(self, pending):
+        """Commit each pending iptables manager once.
+
+        :param pending: list of (iptables manager, firewall group ids) pairs
+        :returns: the ids of the firewall groups which failed to be committed
+        """
+        def _commit(ipt_mgr_fwids):
+            ipt_mgr, fwids = ipt_mgr_fwids
+            watch = timeutils.StopWatch()
+            watch.start()
+            try:
                 ipt_mgr.defer_apply_off()
+            except (LookupError, RuntimeError):
+                LOG.exception("Failed to commit firewall rules in namespace "
+                              "%s", ipt_mgr.namespace)
+                return fwids
+            finally:
+                watch.stop()
+                LOG.debug("Committed firewall rules of %(fwids)s in "
+                          "namespace %(ns)s in %(time).3f seconds",
+                          {'fwids': ', '.join(sorted(fwids)),
+                           'ns': ipt_mgr.namespace,
+                           'time': watch.elapsed()})
+            return set()
+
+        if not pending:
+            return set()
+        workers = min(cfg.CONF.fwaas.batch_apply_workers, len(pending))
+        watch = timeutils.StopWatch()
+        watch.start()
+        if workers > 1:
+            results = list(eventlet.GreenPool(workers).imap(_commit, pending))
+        else:
+            results = [_commit(ipt_mgr_fwids) for ipt_mgr_fwids in pending]
+        watch.stop()
+        LOG.info("Committed firewall rules in %(count)d namespaces in "
+                 "%(time).3f seconds",
+                 {'count': len(pending), 'time': watch.elapsed()})
+        failed_fwids = set()
+        for fwids in results:
+            failed_fwids.update(fwids)
+        return failed_fwids
 
     def _get_chain_name(self, fwid, ver, direction):
         return '%s%s%s' % (CHAIN_NAME_PREFIX[direction],
                            IP_VER_TAG[ver],
                            fwid)
 
-    def _setup_chains(self, firewall, ipt_if_prefix, router_fw_ports):
-        """Create Fwaas chain using the rules in the policy
+    def _get_chain_model_key(self, fwid, ipt_if_prefix):
+        return (fwid, ipt_if_prefix['ipt'].namespace,
+                ipt_if_prefix['if_prefix'])
+
+    def _get_valid_chain_model(self, fwid, ipt_if_prefix):
+        """Returns the chain model of a firewall group if it can be reused.
+
+        The model is discarded if the iptables manager of the router was
+        replaced (e.g. the router was re-created) or if the firewall group
+        chains are no longer present in the manager.
+        """
+        if not self.incremental_chain_update:
+            return None
+        model = self._chain_models.get(
+            self._get_chain_model_key(fwid, ipt_if_prefix))
+        ipt_mgr = ipt_if_prefix['ipt']
+        if not model or model['ipt'] is not ipt_mgr:
+            return None
+        for ver in [IPV4, IPV6]:
+            table = self._get_filter_table(ipt_mgr, ver)
+            for direction in [INGRESS_DIRECTION, EGRESS_DIRECTION]:
+                chain_name = iptables_manager.get_chain_name(
+                    self._get_chain_name(fwid, ver, direction))
+                if chain_name not in table.chains:
+                    return None
+        return model
+
+    def _invalidate_chain_models(self, ipt_mgr, fwid=None):
+        """Forget the chain models of a namespace, or of one of its FWGs."""
+        for key in list(self._chain_models):
+            if (key[1] == ipt_mgr.namespace and
+                    (fwid is None or key[0] == fwid)):
+                del self._chain_models[key]
+
+    def _get_filter_table(self, ipt_mgr, ver):
+        if ver == IPV4:
+            return ipt_mgr.ipv4['filter']
+        return ipt_mgr.ipv6['filter']
+
+    def _optimize_firewall(self, firewall):
+        """Return a copy of a firewall group without its redundant rules.
+
+        Rules are optimized per chain, i.e. per direction and IP version.
+        """
+        optimized = dict(firewall)
+        removed_count = 0
+        for attr in ['ingress_rule_list', 'egress_rule_list']:
+            rule_list = []
+            for ip_version in [4, 6]:
+                rules, removed = rule_optimizer.optimize_rules(
+                    [rule for rule in firewall[attr]
+                     if rule['enabled'] and rule['ip_version'] == ip_version])
+                rule_list.extend(rules)
+                for rule_id, reason in removed:
+                    LOG.debug("Firewall group %(fwid)s: rule %(rule)s not "
+                              "rendered, %(reason)s",
+                              {'fwid': firewall['id'], 'rule': rule_id,
+                               'reason': reason})
+                removed_count += len(removed)
+            optimized[attr] = rule_list
+        if removed_count:
+            LOG.info("Firewall group %(fwid)s: %(count)d redundant rules "
+                     "not rendered",
+                     {'fwid': firewall['id'], 'count': removed_count})
+        return optimized
+
+    def _render_chains(self, firewall, ipt_if_prefix, router_fw_ports,
+                       rule_ids=None):
+        """Render the iptables rules of a firewall group.
+
+        Returns, for each IP version, an ordered mapping of the firewall
+        group chains (and of FORWARD) to the list of rules they hold.
+
+        :param rule_ids: dict filled, for each IP version, with the firewall
+                         group chains and the id of the firewall rule of each
+                         of their rules, None for the default rules
         """
         egress_rule_list = firewall['egress_rule_list']
         ingress_rule_list = firewall['ingress_rule_list']
         fwid = firewall['id']
-        ipt_mgr = ipt_if_prefix['ipt']
 
         # default rules for invalid packets and established sessions
         invalid_rule = self._drop_invalid_packets_rule()
         est_rule = self._allow_established_rule()
 
+        rendered = {}
         for ver in [IPV4, IPV6]:
-            if ver == IPV4:
-                table = ipt_mgr.ipv4['filter']
-            else:
-                table = ipt_mgr.ipv6['filter']
-            ichain_name = self._get_chain_name(fwid, ver, INGRESS_DIRECTION)
-            ochain_name = self._get_chain_name(fwid, ver, EGRESS_DIRECTION)
-            for name in [ichain_name, ochain_name]:
-                table.add_chain(name)
-                table.add_rule(name, invalid_rule)
-                table.add_rule(name, est_rule)
-
-        for rule in ingress_rule_list:
-            if not rule['enabled']:
-                continue
-            iptbl_rule = self._convert_fwaas_to_iptables_rule(rule)
-            if rule['ip_version'] == 4:
-                ver = IPV4
-                table = ipt_mgr.ipv4['filter']
-            else:
-                ver = IPV6
-                table = ipt_mgr.ipv6['filter']
-            ichain_name = self._get_chain_name(fwid, ver, INGRESS_DIRECTION)
-            table.add_rule(ichain_name, iptbl_rule)
-
-        for rule in egress_rule_list:
-            if not rule['enabled']:
-                continue
-            iptbl_rule = self._convert_fwaas_to_iptables_rule(rule)
-            if rule['ip_version'] == 4:
-                ver = IPV4
-                table = ipt_mgr.ipv4['filter']
-            else:
-                ver = IPV6
-                table = ipt_mgr.ipv6['filter']
-            ochain_name = self._get_chain_name(fwid, ver, EGRESS_DIRECTION)
-            table.add_rule(ochain_name, iptbl_rule)
-
-        self._enable_policy_chain(fwid, ipt_if_prefix, router_fw_ports)
+            chains = collections.OrderedDict()
+            for direction in [INGRESS_DIRECTION, EGRESS_DIRECTION]:
+                chain_name = self._get_chain_name(fwid, ver, direction)
+                chains[chain_name] = [invalid_rule, est_rule]
+                if rule_ids is not None:
+                    rule_ids.setdefault(ver, {})[chain_name] = [None, None]
+            chains.update(self._get_forward_jump_rules(
+                fwid, ipt_if_prefix['if_prefix'], router_fw_ports, ver))
+            rendered[ver] = chains
+
+        for direction, rule_list in [(INGRESS_DIRECTION, ingress_rule_list),
+                                     (EGRESS_DIRECTION, egress_rule_list)]:
+            for rule in rule_list:
+                if not rule['enabled']:
+                    continue
+                iptbl_rules = self._convert_fwaas_to_iptables_rules(rule)
+                ver = IPV4 if rule['ip_version'] == 4 else IPV6
+                chain_name = self._get_chain_name(fwid, ver, direction)
+                rendered[ver][chain_name].extend(iptbl_rules)
+                if rule_ids is not None:
+                    rule_ids[ver][chain_name].extend(
+                        [rule['id']] * len(iptbl_rules))
+        return rendered
+
+    def _setup_chains(self, ipt_mgr, rendered):
+        """Create Fwaas chains from rendered rules
+        """
+        for ver in [IPV4, IPV6]:
+            table = self._get_filter_table(ipt_mgr, ver)
+            for chain_name, rules in rendered[ver].items():
+                if not self._is_shared_chain(chain_name):
+                    table.add_chain(chain_name)
+                for rule in rules:
+                    table.add_rule(chain_name, rule)
+
+    def _update_chains(self, ipt_mgr, old_rendered, new_rendered):
+        """Apply the difference between two renderings of the same chains.
+
+        Rules can only be appended to an iptables manager chain, so in the
+        firewall group chains the rules following the first difference are
+        removed and re-added. FORWARD and dispatch chain jump rules only
+        need to be ordered per interface, hence they are diffed as sets.
+        """
+        for ver in [IPV4, IPV6]:
+            table = self._get_filter_table(ipt_mgr, ver)
+            # dispatch chains no longer holding a port of the firewall group
+            # are only in the old rendering
+            chain_names = list(new_rendered[ver]) + [
+                chain_name for chain_name in old_rendered[ver]
+                if chain_name not in new_rendered[ver]]
+            for chain_name in chain_names:
+                rules = new_rendered[ver].get(chain_name, [])
+                old_rules = old_rendered[ver].get(chain_name, [])
+                if self._is_shared_chain(chain_name):
+                    old_jumps = set(old_rules)
+                    new_jumps = set(rules)
+                    to_remove = [r for r in old_rules if r not in new_jumps]
+                    to_add = [r for r in rules if r not in old_jumps]
+                else:
+                    common = 0
+                    for old_rule, new_rule in zip(old_rules, rules):
+                        if old_rule != new_rule:
+                            break
+                        common += 1
+                    to_remove = old_rules[common:]
+                    to_add = rules[common:]
+                for rule in to_remove:
+                    table.remove_rule(chain_name, rule)
+                for rule in to_add:
+                    table.add_rule(chain_name, rule)
+                if to_remove or to_add:
+                    LOG.debug("Updated chain %(chain)s in namespace %(ns)s: "
+                              "%(removed)d rules removed, %(added)d added",
+                              {'chain': chain_name, 'ns': ipt_mgr.namespace,
+                               'removed': len(to_remove),
+                               'added': len(to_add)})
 
     def _find_changed_rules(self, pre_firewall, firewall):
         """Find the rules changed between the current firewall
@@ -253,22 +577,21 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
         """
         changed_rules = []
         for fw_rule_list in ['egress_rule_list', 'ingress_rule_list']:
-            pre_fw_rules = pre_firewall[fw_rule_list]
-            fw_rules = firewall[fw_rule_list]
-            for pre_fw_rule in pre_fw_rules:
-                for fw_rule in fw_rules:
-                    if (pre_fw_rule.get('id') == fw_rule.get('id') and
-                        pre_fw_rule != fw_rule):
-                        changed_rules.append(pre_fw_rule)
-                        changed_rules.append(fw_rule)
+            fw_rules_by_id = dict((fw_rule.get('id'), fw_rule)
+                                  for fw_rule in firewall[fw_rule_list])
+            for pre_fw_rule in pre_firewall[fw_rule_list]:
+                fw_rule = fw_rules_by_id.get(pre_fw_rule.get('id'))
+                if fw_rule is not None and pre_fw_rule != fw_rule:
+                    changed_rules.append(pre_fw_rule)
+                    changed_rules.append(fw_rule)
         return changed_rules
 
     def _find_removed_rules(self, pre_firewall, firewall):
         removed_rules = []
         for fw_rule_list in ['egress_rule_list', 'ingress_rule_list']:
             pre_fw_rules = pre_firewall[fw_rule_list]
-            fw_rules = firewall[fw_rule_list]
-            fw_rule_ids = [fw_rule['id'] for fw_rule in fw_rules]
+            fw_rule_ids = set(fw_rule['id'] for fw_rule in
+                              firewall[fw_rule_list])
             removed_rules.extend([pre_fw_rule for pre_fw_rule in pre_fw_rules
                     if pre_fw_rule['id'] not in fw_rule_ids])
         return removed_rules
@@ -276,44 +599,374 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
     def _find_new_rules(self, pre_firewall, firewall):
         return self._find_removed_rules(firewall, pre_firewall)
 
+    def _find_conntrack_rules(self, pre_firewall, firewall):
+        """Find the rules whose connections must be removed on update."""
+        return (self._find_changed_rules(pre_firewall, firewall) +
+                self._find_new_rules(pre_firewall, firewall) +
+                self._find_removed_rules(pre_firewall, firewall))
+
+    def get_rule_counters(self):
+        """Return the packets and bytes matched by the firewall rules.
+
+        The counters of all the chains of a namespace are read at once,
+        with one iptables-save call per namespace and IP version.
+
+        :returns: {fwid: {rule id: {'packets': n, 'bytes': n}}}, summed over
+                  the namespaces, directions and iptables rules of each
+                  firewall rule
+        """
+        namespace_fwids = collections.OrderedDict()
+        for fwid, namespace in self._rule_chains:
+            namespace_fwids.setdefault(namespace, []).append(fwid)
+        counters = {}
+        for namespace, fwids in namespace_fwids.items():
+            for ver in [IPV4, IPV6]:
+                chain_counters = self._get_chain_counters(namespace, ver)
+                if chain_counters is None:
+                    continue
+                for fwid in fwids:
+                    fw_counters = counters.setdefault(fwid, {})
+                    rule_chains = self._rule_chains[(fwid, namespace)]
+                    for chain_name, rule_ids in rule_chains.get(
+                            ver, {}).items():
+                        self._add_rule_counters(
+                            fw_counters, rule_ids,
+                            chain_counters.get(self._get_wrapped_chain_name(
+                                chain_name), []))
+        return counters
+
+    def _get_wrapped_chain_name(self, chain_name):
+        return '%s-%s' % (iptables_manager.binary_name,
+                          iptables_manager.get_chain_name(chain_name))
+
+    def _get_chain_counters(self, namespace, ver):
+        """Return the (packets, bytes) counters of the filter table rules.
+
+        :returns: dict of the counters of the rules of each chain, in
+                  order, or None if the rules couldn't be dumped
+        """
+        try:
+            output = linux_utils.execute(
+                ['ip', 'netns', 'exec', namespace, IPTABLES_SAVE_CMDS[ver],
+                 '-c', '-t', 'filter'], run_as_root=True)
+        except RuntimeError:
+            LOG.warning("Failed to read the %(ver)s rule counters of "
+                        "namespace %(ns)s", {'ver': ver, 'ns': namespace})
+            return None
+        chain_counters = {}
+        for line in output.splitlines():
+            match = COUNTED_RULE_RE.match(line)
+            if match:
+                chain_counters.setdefault(match.group(3), []).append(
+                    (int(match.group(1)), int(match.group(2))))
+        return chain_counters
+
+    def _add_rule_counters(self, fw_counters, rule_ids, counters):
+        """Add the counters of the rules of a chain to their firewall rules.
+
+        A chain whose rules don't match its last rendering, e.g. being
+        updated, is skipped.
+        """
+        if len(counters) != len(rule_ids):
+            return
+        for rule_id, (packet_count, byte_count) in zip(rule_ids, counters):
+            if rule_id is None:
+                continue
+            rule_counters = fw_counters.setdefault(
+                rule_id, {'packets': 0, 'bytes': 0})
+            rule_counters['packets'] += packet_count
+            rule_counters['bytes'] += byte_count
+
+    def _get_namespace_ports(self, agent_mode, apply_list):
+        """Return the firewall group ports of each apply list namespace."""
+        namespace_ports = collections.OrderedDict()
+        for ri, router_fw_ports in apply_list:
+            for ipt_if_prefix in self._get_ipt_mgrs_with_if_prefix(
+                    agent_mode, ri):
+                namespace_ports.setdefault(
+                    ipt_if_prefix['ipt'].namespace, []).extend(
+                        router_fw_ports)
+        return namespace_ports
+
+    def _set_applied_firewall(self, namespaces, firewall):
+        # a single copy is shared by the namespaces so that the next update
+        # diffs it once for all of them
+        applied_firewall = {
+            'egress_rule_list': list(firewall['egress_rule_list']),
+            'ingress_rule_list': list(firewall['ingress_rule_list'])}
+        for namespace in namespaces:
+            self._applied_firewalls[(firewall['id'], namespace)] = (
+                applied_firewall)
+
+    def _set_flushed_namespaces(self, namespaces):
+        """Trust the port marks of namespaces whose connections are flushed.
+
+        Connections opened after the flush are marked by their first packet,
+        so all the connections of the ports marked at that time carry their
+        mark, and the indexes of the ports no longer marked are free again.
+        """
+        if not self.conntrack_port_marks:
+            return
+        for namespace in namespaces:
+            marked_ports = set()
+            for (fwid, chain_namespace), ports in (
+                    self._mark_chain_ports.items()):
+                if chain_namespace == namespace:
+                    marked_ports.update(ports)
+            self._marked_ports[namespace] = marked_ports
+            port_marks = self._port_marks.get(namespace, {})
+            for port_id in set(port_marks) - marked_ports:
+                del port_marks[port_id]
+
+    def _forget_applied_firewall(self, agent_mode, apply_list, fwid):
+        """Drop the rules applied by a firewall in the apply list namespaces.
+
+        Next time the firewall is set up in those namespaces, their
+        connections are flushed as there is no baseline to diff against.
+        """
+        namespace_ports = self._get_namespace_ports(agent_mode, apply_list)
+        for namespace, ports in namespace_ports.items():
+            self._applied_firewalls.pop((fwid, namespace), None)
+            if self.conntrack_port_marks:
+                self._mark_chain_ports.pop((fwid, namespace), None)
+                self._release_port_marks(namespace, ports)
+            self._address_group_sets.pop((fwid, namespace), None)
+            self._rule_chains.pop((fwid, namespace), None)
+            self.conntrack.release_namespace(namespace)
+        self._remove_unused_address_groups(namespace_ports)
+
+    def release_namespace(self, namespace):
+        """Forget the firewalls applied in a removed namespace."""
+        self._forget_namespace(namespace)
+        self.conntrack.release_namespace(namespace)
+
+    def _forget_namespace(self, namespace):
+        """Drop the rules applied by all the firewalls in a namespace.
+
+        Called when removing the connections of the namespace failed, so
+        that they are flushed next time a firewall is set up in it.
+        """
+        for key in list(self._applied_firewalls):
+            if key[1] == namespace:
+                del self._applied_firewalls[key]
+        self._marked_ports.pop(namespace, None)
+
+    def _delete_conntrack_entries(self, jobs):
+        """Remove the connections of the jobs, or queue their removal.
+
+        :param jobs: jobs as accepted by delete_entries_batch
+        :returns: the counts returned by delete_entries_batch, or None if
+                  the jobs were queued
+        """
+        if self.conntrack_cleanup_queue is None:
+            return self.conntrack.delete_entries_batch(
+                jobs, cfg.CONF.fwaas.conntrack_workers)
+        for job in jobs:
+            self.conntrack_cleanup_queue.enqueue(*job)
+        return None
+
     def _remove_conntrack_new_firewall(self, agent_mode, apply_list, firewall):
         """Remove conntrack when create new firewall"""
-        routers_list = list(set([apply_info[0] for apply_info in apply_list]))
-        for ri in routers_list:
-            ipt_if_prefix_list = self._get_ipt_mgrs_with_if_prefix(
-                agent_mode, ri)
-            for ipt_if_prefix in ipt_if_prefix_list:
-                ipt_mgr = ipt_if_prefix['ipt']
-                self.conntrack.flush_entries(ipt_mgr.namespace)
+        namespace_ports = self._get_namespace_ports(agent_mode, apply_list)
+        namespaces = list(namespace_ports)
+        self._delete_conntrack_entries(
+            [(namespace, None) for namespace in namespaces])
+        self._set_applied_firewall(namespaces, firewall)
+        self._set_flushed_namespaces(namespaces)
 
     def _remove_conntrack_updated_firewall(self, agent_mode,
-                                           apply_list, pre_firewall, firewall):
-        """Remove conntrack when updated firewall"""
-        routers_list = list(set([apply_info[0] for apply_info in apply_list]))
-        for ri in routers_list:
-            ipt_if_prefix_list = self._get_ipt_mgrs_with_if_prefix(
-                agent_mode, ri)
-            for ipt_if_prefix in ipt_if_prefix_list:
-                ipt_mgr = ipt_if_prefix['ipt']
-                ch_rules = self._find_changed_rules(pre_firewall,
-                                                    firewall)
-                i_rules = self._find_new_rules(pre_firewall, firewall)
-                r_rules = self._find_removed_rules(pre_firewall, firewall)
-                removed_conntrack_rules_list = ch_rules + i_rules + r_rules
-                self.conntrack.delete_entries(removed_conntrack_rules_list,
-                                              ipt_mgr.namespace)
+                                           apply_list, firewall):
+        """Remove conntrack when updated firewall
+
+        Only the connections matching the rules which differ from the ones
+        last applied by the firewall in a namespace are removed; namespaces
+        the firewall had not been applied to yet are flushed. With port
+        marks, those connections are only looked up among the ones of the
+        firewall group ports.
+        """
+        namespace_ports = self._get_namespace_ports(agent_mode, apply_list)
+        namespaces = list(namespace_ports)
+        # id of a baseline -> rules to remove, namespaces usually share one
+        conntrack_rules = {}
+        jobs = []
+        flushed_namespaces = []
+        for namespace in namespaces:
+            pre_firewall = self._applied_firewalls.get(
+                (firewall['id'], namespace))
+            if pre_firewall is None:
+                jobs.append((namespace, None))
+                flushed_namespaces.append(namespace)
+                continue
+            if id(pre_firewall) not in conntrack_rules:
+                conntrack_rules[id(pre_firewall)] = (
+                    self._find_conntrack_rules(pre_firewall, firewall))
+            removed_conntrack_rules_list = conntrack_rules[id(pre_firewall)]
+            if removed_conntrack_rules_list:
+                marks = self._get_conntrack_marks(
+                    namespace, namespace_ports[namespace])
+                jobs.append((namespace, removed_conntrack_rules_list) +
+                            ((marks,) if marks else ()))
+        if jobs:
+            counts = self._delete_conntrack_entries(jobs)
+            if counts is not None:
+                LOG.debug("Removed connections of firewall %(fw_id)s: "
+                          "%(counts)s",
+                          {'fw_id': firewall['id'], 'counts': counts})
+        self._set_applied_firewall(namespaces, firewall)
+        self._set_flushed_namespaces(flushed_namespaces)
+
+    @staticmethod
+    def _parse_mark_mask(mask):
+        """Return the (shift, bits) of the port marks of a connmark mask.
+
+        Each half of the mask bits holds the index of a port, the lower one
+        for the port a connection egresses from, the upper one for the port
+        it ingresses to.
+        """
+        try:
+            value = int(mask, 0)
+        except ValueError:
+            value = 0
+        shift = 0
+        while value and not value >> shift & 1:
+            shift += 1
+        bits = len(bin(value >> shift)) - 2 if value else 0
+        if (not value or value >> 32 or bits % 2 or
+                value != ((1 << bits) - 1) << shift):
+            raise ValueError(_("conntrack_port_mark_mask %s is not an even "
+                               "number of contiguous bits") % mask)
+        return shift, bits // 2
+
+    def _get_port_mark_index(self, namespace, port_id):
+        """Return the index of a port in the namespace connection marks.
+
+        Indexes are allocated on first use and kept while connections may
+        carry them, a port getting the same index back when it is marked
+        again; None is returned once all the indexes the mask allows are
+        taken.
+        """
+        port_marks = self._port_marks.setdefault(namespace, {})
+        if port_id not in port_marks:
+            used = set(port_marks.values())
+            for index in range(1, 1 << self._mark_bits):
+                if index not in used:
+                    port_marks[port_id] = index
+                    break
+            else:
+                LOG.warning("No connection mark left for port %(port)s in "
+                            "namespace %(ns)s, its connections are looked "
+                            "up in the whole namespace",
+                            {'port': port_id, 'ns': namespace})
+                return None
+        return port_marks[port_id]
+
+    def _release_port_marks(self, namespace, port_ids):
+        """Stop trusting the marks of ports no longer marked.
+
+        Their indexes are only freed once the namespace connections are
+        flushed, or once no firewall group marks ports in the namespace, the
+        next one set up in it flushing its connections.
+        """
+        self._marked_ports.get(namespace, set()).difference_update(port_ids)
+        if not any(chain_namespace == namespace
+                   for fwid, chain_namespace in self._mark_chain_ports):
+            self._port_marks.pop(namespace, None)
+            self._marked_ports.pop(namespace, None)
+
+    def _get_port_marks(self, index):
+        """Return the (value, mask) marks of a port, egress then ingress."""
+        egress_mask = ((1 << self._mark_bits) - 1) << self._mark_shift
+        ingress_mask = egress_mask << self._mark_bits
+        return [(index << self._mark_shift, egress_mask),
+                (index << (self._mark_shift + self._mark_bits), ingress_mask)]
+
+    def _get_conntrack_marks(self, namespace, port_ids):
+        """Return the marks of the connections of ports, if all are marked.
+
+        None is returned if any of the ports wasn't marked since the
+        namespace connections were last flushed, as its connections idle
+        since then or opened while it was unmarked may not carry its mark,
+        or if there are too many ports for their lookups to pay off.
+        """
+        if (not self.conntrack_port_marks or
+                len(port_ids) > CONNTRACK_MARKS_MAX_PORTS):
+            return None
+        marked_ports = self._marked_ports.get(namespace, ())
+        port_marks = self._port_marks.get(namespace, {})
+        marks = []
+        for port_id in port_ids:
+            if port_id not in marked_ports or port_id not in port_marks:
+                return None
+            marks.extend(self._get_port_marks(port_marks[port_id]))
+        return marks
+
+    def _get_mark_chain_name(self, fwid, ver):
+        return '%s%s%s' % (MARK_CHAIN_PREFIX, IP_VER_TAG[ver], fwid)
+
+    def _setup_port_marks(self, fwid, ipt_if_prefix, router_fw_ports):
+        """Mark the connections of the firewall group ports.
+
+        The marks are set in the mangle table, before any filtering, on the
+        connections of the ports which don't carry one yet, so that
+        connections opened before the port was marked get it too.
+        """
+        ipt_mgr = ipt_if_prefix['ipt']
+        if_prefix = ipt_if_prefix['if_prefix']
+        bname = iptables_manager.binary_name
+        rules = []
+        marked_ports = set()
+        for router_fw_port in router_fw_ports:
+            index = self._get_port_mark_index(ipt_mgr.namespace,
+                                              router_fw_port)
+            if index is None:
+                continue
+            marked_ports.add(router_fw_port)
+            intf_name = self._get_intf_name(if_prefix, router_fw_port)
+            for direction, (value, mask) in zip(
+                    ['-i', '-o'], self._get_port_marks(index)):
+                rules.append('%s %s -m connmark --mark 0x0/%#x '
+                             '-j CONNMARK --set-xmark %#x/%#x' % (
+                                 direction, intf_name, mask, value, mask))
+        key = (fwid, ipt_mgr.namespace)
+        unmarked_ports = self._mark_chain_ports.get(key, frozenset()) - (
+            marked_ports)
+        self._mark_chain_ports[key] = frozenset(marked_ports)
+        self._release_port_marks(ipt_mgr.namespace, unmarked_ports)
+        for ver in [IPV4, IPV6]:
+            table = self._get_mangle_table(ipt_mgr, ver)
+            chain_name = self._get_mark_chain_name(fwid, ver)
+            table.remove_chain(chain_name)
+            if not rules:
+                continue
+            table.add_chain(chain_name)
+            for rule in rules:
+                table.add_rule(chain_name, rule)
+            table.add_rule('FORWARD', '-j %s-%s' % (
+                bname, iptables_manager.get_chain_name(chain_name)))
+
+    def _get_mangle_table(self, ipt_mgr, ver):
+        if ver == IPV4:
+            return ipt_mgr.ipv4['mangle']
+        return ipt_mgr.ipv6['mangle']
 
     def _remove_default_chains(self, nsid):
         """Remove fwaas default policy chain."""
         self._remove_chain_by_name(IPV4, FWAAS_DEFAULT_CHAIN, nsid)
         self._remove_chain_by_name(IPV6, FWAAS_DEFAULT_CHAIN, nsid)
+        # removing the chain also removed the jumps of every firewall group
+        # of the namespace to it
+        self._invalidate_chain_models(nsid)
 
     def _remove_chains(self, fwid, ipt_mgr):
         """Remove fwaas policy chain."""
+        self._invalidate_chain_models(ipt_mgr, fwid)
         for ver in [IPV4, IPV6]:
             for direction in [INGRESS_DIRECTION, EGRESS_DIRECTION]:
                 chain_name = self._get_chain_name(fwid, ver, direction)
                 self._remove_chain_by_name(ver, chain_name, ipt_mgr)
+            if self.conntrack_port_marks:
+                self._get_mangle_table(ipt_mgr, ver).remove_chain(
+                    self._get_mark_chain_name(fwid, ver))
 
     def _add_default_policy_chain_v4v6(self, ipt_mgr):
         ipt_mgr.ipv4['filter'].add_chain(FWAAS_DEFAULT_CHAIN)
@@ -335,70 +988,327 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
         for rule in rules:
             table.add_rule(chain_name, rule)
 
-    def _enable_policy_chain(self, fwid, ipt_if_prefix, router_fw_ports):
-        bname = iptables_manager.binary_name
-        ipt_mgr = ipt_if_prefix['ipt']
-        if_prefix = ipt_if_prefix['if_prefix']
+    def _get_forward_jump_rules(self, fwid, if_prefix, router_fw_ports, ver,
+                                policy_chains=True):
+        """Returns the rules sending the ports to their chains.
 
-        for (ver, tbl) in [(IPV4, ipt_mgr.ipv4['filter']),
-                           (IPV6, ipt_mgr.ipv6['filter'])]:
+        Each port first jumps to the firewall group chain of its direction,
+        then to the DROP_ALL policy chain. The rules are in FORWARD, or with
+        forward_dispatch_chains in the dispatch chains of the interfaces.
+
+        :returns: ordered mapping of the chains to the jump rules they hold
+        """
+        bname = iptables_manager.binary_name
+        jump_rules = collections.OrderedDict([('FORWARD', [])])
+        if policy_chains:
             for direction in [INGRESS_DIRECTION, EGRESS_DIRECTION]:
-                chain_name = self._get_chain_name(fwid, ver, direction)
-                chain_name = iptables_manager.get_chain_name(chain_name)
-                if chain_name in tbl.chains:
-                    for router_fw_port in router_fw_ports:
-                        intf_name = self._get_intf_name(if_prefix,
-                                                        router_fw_port)
-                        jump_rule = ['%s %s -j %s-%s' % (
-                            IPTABLES_DIR[direction], intf_name,
-                            bname, chain_name)]
-                        self._add_rules_to_chain(ipt_mgr, ver,
-                                             'FORWARD', jump_rule)
+                chain_name = iptables_manager.get_chain_name(
+                    self._get_chain_name(fwid, ver, direction))
+                for router_fw_port in router_fw_ports:
+                    intf_name = self._get_intf_name(if_prefix,
+                                                    router_fw_port)
+                    dispatch_chain = self._get_dispatch_chain_name(
+                        JUMP_DISPATCH_CHAIN_PREFIX, IPTABLES_DIR[direction],
+                        if_prefix, intf_name)
+                    jump_rules.setdefault(dispatch_chain, []).append(
+                        '%s %s -j %s-%s' % (IPTABLES_DIR[direction],
+                                            intf_name, bname, chain_name))
 
         # jump to DROP_ALL policy
         chain_name = iptables_manager.get_chain_name(FWAAS_DEFAULT_CHAIN)
-        for router_fw_port in router_fw_ports:
-            intf_name = self._get_intf_name(if_prefix,
-                                            router_fw_port)
-            jump_rule = ['-o %s -j %s-%s' % (intf_name, bname, chain_name)]
-            self._add_rules_to_chain(ipt_mgr, IPV4, 'FORWARD', jump_rule)
-            self._add_rules_to_chain(ipt_mgr, IPV6, 'FORWARD', jump_rule)
+        for direction in ['-o', '-i']:
+            for router_fw_port in router_fw_ports:
+                intf_name = self._get_intf_name(if_prefix, router_fw_port)
+                dispatch_chain = self._get_dispatch_chain_name(
+                    DEFAULT_DISPATCH_CHAIN_PREFIX, direction, if_prefix,
+                    intf_name)
+                jump_rules.setdefault(dispatch_chain, []).append(
+                    '%s %s -j %s-%s' % (direction, intf_name, bname,
+                                        chain_name))
+        if self.forward_dispatch_chains and not jump_rules['FORWARD']:
+            del jump_rules['FORWARD']
+        return jump_rules
+
+    def _get_dispatch_chain_name(self, chain_prefix, direction, if_prefix,
+                                 intf_name):
+        """Return the chain holding the jump rules of an interface.
+
+        FORWARD is returned without forward_dispatch_chains, or for the
+        interfaces having no dispatch chain.
+        """
+        char = intf_name[len(if_prefix):len(if_prefix) + 1]
+        if (not self.forward_dispatch_chains or not char or
+                char not in DISPATCH_CHARS):
+            return 'FORWARD'
+        return '%s%s%s%s' % (chain_prefix, direction[1], if_prefix, char)
+
+    def _is_shared_chain(self, chain_name):
+        """Return True for the chains shared by all the firewall groups."""
+        return (chain_name == 'FORWARD' or
+                chain_name.startswith(JUMP_DISPATCH_CHAIN_PREFIX) or
+                chain_name.startswith(DEFAULT_DISPATCH_CHAIN_PREFIX))
+
+    def _setup_dispatch_chains(self, ipt_if_prefix):
+        """Create the dispatch chains of an interface prefix, once.
+
+        FORWARD sends the interfaces starting with each character to its
+        dispatch chains: first to the ones jumping to the firewall group
+        chains, for both directions, then to the ones jumping to the
+        DROP_ALL policy chain, so that a packet is only dropped once the
+        chains of both of its ports were walked, as without them.
+        """
+        if not self.forward_dispatch_chains:
+            return
+        ipt_mgr = ipt_if_prefix['ipt']
+        if_prefix = ipt_if_prefix['if_prefix']
+        bname = iptables_manager.binary_name
+        for ver in [IPV4, IPV6]:
+            table = self._get_filter_table(ipt_mgr, ver)
+            first_chain = self._get_dispatch_chain_name(
+                JUMP_DISPATCH_CHAIN_PREFIX, '-o', if_prefix,
+                if_prefix + DISPATCH_CHARS[0])
+            if first_chain in table.chains:
+                continue
+            for chain_prefix in [JUMP_DISPATCH_CHAIN_PREFIX,
+                                 DEFAULT_DISPATCH_CHAIN_PREFIX]:
+                for direction in ['-o', '-i']:
+                    for char in DISPATCH_CHARS:
+                        chain_name = self._get_dispatch_chain_name(
+                            chain_prefix, direction, if_prefix,
+                            if_prefix + char)
+                        table.add_chain(chain_name)
+                        table.add_rule('FORWARD', '%s %s%s+ -j %s-%s' % (
+                            direction, if_prefix, char, bname, chain_name))
 
-        # jump to DROP_ALL policy
-        chain_name = iptables_manager.get_chain_name(FWAAS_DEFAULT_CHAIN)
-        for router_fw_port in router_fw_ports:
-            intf_name = self._get_intf_name(if_prefix,
-                                            router_fw_port)
-            jump_rule = ['-i %s -j %s-%s' % (intf_name, bname, chain_name)]
-            self._add_rules_to_chain(ipt_mgr, IPV4, 'FORWARD', jump_rule)
-            self._add_rules_to_chain(ipt_mgr, IPV6, 'FORWARD', jump_rule)
+    def _enable_policy_chain(self, fwid, ipt_if_prefix, router_fw_ports):
+        ipt_mgr = ipt_if_prefix['ipt']
+        if_prefix = ipt_if_prefix['if_prefix']
+        self._setup_dispatch_chains(ipt_if_prefix)
 
-    def _convert_fwaas_to_iptables_rule(self, rule):
+        for ver in [IPV4, IPV6]:
+            tbl = self._get_filter_table(ipt_mgr, ver)
+            chain_names = [iptables_manager.get_chain_name(
+                self._get_chain_name(fwid, ver, direction))
+                for direction in [INGRESS_DIRECTION, EGRESS_DIRECTION]]
+            policy_chains = all(name in tbl.chains for name in chain_names)
+            jump_rules = self._get_forward_jump_rules(
+                fwid, if_prefix, router_fw_ports, ver,
+                policy_chains=policy_chains)
+            for chain_name, rules in jump_rules.items():
+                self._add_rules_to_chain(ipt_mgr, ver, chain_name, rules)
+
+    def _get_address_group_set_id(self, address_group):
+        return ADDRESS_GROUP_SET_PREFIX + address_group['id']
+
+    def _get_address_group_members(self, firewall):
+        """Return the addresses of the address groups a firewall matches.
+
+        :returns: dict of the addresses of each (set id, ethertype), a set
+                  holding the addresses of a group of the IP version of the
+                  rules matching it
+        """
+        members = {}
+        for rule in (firewall['ingress_rule_list'] +
+                     firewall['egress_rule_list']):
+            if not rule['enabled']:
+                continue
+            for attr in ADDRESS_GROUP_ATTRS:
+                for address_group in rule.get(attr) or []:
+                    key = (self._get_address_group_set_id(address_group),
+                           ETHERTYPES[rule['ip_version']])
+                    if key in members:
+                        continue
+                    members[key] = [
+                        address['ip_address']
+                        for address in address_group['ip_addresses']
+                        if self._get_address_version(address) ==
+                        rule['ip_version']]
+        return members
+
+    @staticmethod
+    def _get_address_version(address):
+        if address.get('ip_version'):
+            return address['ip_version']
+        if ':' in address['ip_address']:
+            return constants.IP_VERSION_6
+        return constants.IP_VERSION_4
+
+    def _setup_address_groups(self, fwid, namespace, address_groups):
+        """Sync the address group sets of a firewall group in a namespace.
+
+        The ipset manager only adds and deletes the addresses which changed
+        since the sets were last synced.
+        """
+        if address_groups and namespace not in self._ipset_managers:
+            self._ipset_managers[namespace] = ipset_manager.IpsetManager(
+                namespace=namespace)
+        for (set_id, ethertype), addresses in address_groups.items():
+            self._ipset_managers[namespace].set_members(set_id, ethertype,
+                                                        addresses)
+            self._ipsets.setdefault(namespace, set()).add((set_id, ethertype))
+        self._address_group_sets[(fwid, namespace)] = frozenset(
+            address_groups)
+
+    def _remove_unused_address_groups(self, namespaces):
+        """Destroy the sets no rule applied in the namespaces matches."""
+        for namespace in namespaces:
+            created = self._ipsets.get(namespace)
+            if not created:
+                continue
+            used = set()
+            for (fwid, set_namespace), sets in (
+                    self._address_group_sets.items()):
+                if set_namespace == namespace:
+                    used.update(sets)
+            for set_id, ethertype in created - used:
+                self._ipset_managers[namespace].destroy(set_id, ethertype)
+                created.discard((set_id, ethertype))
+            if not created:
+                del self._ipsets[namespace]
+                del self._ipset_managers[namespace]
+
+    def _get_address_group_sets(self, rule, attr):
+        """Return the set names of the address groups of a rule attribute."""
+        ethertype = ETHERTYPES[rule['ip_version']]
+        return [ipset_manager.IpsetManager.get_name(
+            self._get_address_group_set_id(address_group), ethertype)
+            for address_group in rule.get(attr) or []]
+
+    @staticmethod
+    def _get_service_port(port):
+        """Return a service group port in the multiport syntax."""
+        return str(port).replace('-', ':')
+
+    def _get_rule_services(self, rule):
+        """Return the services matched by the service groups of a rule.
+
+        The destination ports of each protocol are packed into as few
+        multiport matches as possible.
+
+        :returns: list of (protocol, destination ports) tuples, where the
+                  ports are None for protocols without ports, or [None] if
+                  the rule has no service group
+        """
+        service_groups = rule.get('service_groups')
+        if not service_groups:
+            return [None]
+        # protocol -> destination ports, in the service groups order, None
+        # once a service of the protocol matches any port
+        protocol_ports = collections.OrderedDict()
+        for service_group in service_groups:
+            for service in service_group['ports']:
+                protocol = service['protocol']
+                if rule.get('protocol') and protocol != rule['protocol']:
+                    continue
+                ports = protocol_ports.setdefault(protocol, [])
+                port = service.get('port')
+                if protocol not in ['udp', 'tcp'] or not port:
+                    protocol_ports[protocol] = None
+                elif ports is not None:
+                    port = self._get_service_port(port)
+                    if port not in ports:
+                        ports.append(port)
+        services = []
+        for protocol, ports in protocol_ports.items():
+            if not ports:
+                services.append((protocol, None))
+                continue
+            chunk, size = [], 0
+            for port in ports:
+                port_size = 2 if ':' in port else 1
+                if size + port_size > MULTIPORT_MAX_PORTS:
+                    services.append((protocol, ','.join(chunk)))
+                    chunk, size = [], 0
+                chunk.append(port)
+                size += port_size
+            services.append((protocol, ','.join(chunk)))
+        return services
+
+    def _convert_fwaas_to_iptables_rules(self, rule):
+        """Return the iptables rules of a firewall rule.
+
+        A rule matching address groups is rendered once per pair of its
+        source and destination address group sets, as iptables rules can't
+        match any of several sets, and once per multiport match of its
+        service groups.
+        """
+        src_sets = self._get_address_group_sets(
+            rule, 'source_address_groups') or [None]
+        dst_sets = self._get_address_group_sets(
+            rule, 'destination_address_groups') or [None]
+        services = self._get_rule_services(rule)
+        return [self._convert_fwaas_to_iptables_rule(rule, src_set, dst_set,
+                                                     service)
+                for src_set in src_sets for dst_set in dst_sets
+                for service in services]
+
+    def _convert_fwaas_to_iptables_rule(self, rule, src_set=None,
+                                        dst_set=None, service=None):
+        """Return the iptables rule of a firewall rule, using the cache.
+
+        The same rules are rendered for every router, interface prefix and
+        update, so translations are kept in a LRU cache keyed by the rule
+        attributes they depend on.
+
+        :param src_set: name of the ipset the source address must be in
+        :param dst_set: name of the ipset the destination address must be in
+        :param service: (protocol, destination ports) of a service group
+                        replacing the protocol and destination port of the rule
+        """
+        if not self._rule_cache_size:
+            return self._compile_fwaas_to_iptables_rule(rule, src_set,
+                                                        dst_set, service)
+        key = tuple(rule.get(attr) for attr in RULE_CACHE_KEY_ATTRS) + (
+            src_set, dst_set, service)
+        try:
+            iptables_rule = self._rule_cache.pop(key)
+            self.rule_cache_hits += 1
+        except KeyError:
+            iptables_rule = self._compile_fwaas_to_iptables_rule(
+                rule, src_set, dst_set, service)
+            self.rule_cache_misses += 1
+            if len(self._rule_cache) >= self._rule_cache_size:
+                self._rule_cache.popitem(last=False)
+        self._rule_cache[key] = iptables_rule
+        return iptables_rule
+
+    def _compile_fwaas_to_iptables_rule(self, rule, src_set=None,
+                                        dst_set=None, service=None):
         action = FWAAS_TO_IPTABLE_ACTION_MAP[rule.get('action')]
+        protocol = rule.get('protocol')
+        destination_port = rule.get('destination_port')
+        if service:
+            protocol, destination_port = service[0], None
 
         # Output ordering is important here as it must exactly match what
         # is returned by iptables-save.  If not we risk unnecessarily removing
         # and readding rules.
         args = []
 
-        args += self._protocol_arg(rule.get('protocol'))
+        args += self._protocol_arg(protocol)
 
         args += self._ip_prefix_arg('s', rule.get('source_ip_address'))
         args += self._ip_prefix_arg('d', rule.get('destination_ip_address'))
 
+        args += self._match_set_arg(src_set, 'src')
+        args += self._match_set_arg(dst_set, 'dst')
+
         # iptables adds '-m protocol' when any source
         # or destination port number is specified
         if not((rule.get('source_port') is None)
-           and (rule.get('destination_port') is None)):
-                args += self._match_arg(rule.get('protocol'))
+           and (destination_port is None)):
+            args += self._match_arg(protocol)
 
         args += self._port_arg('sport',
-                               rule.get('protocol'),
+                               protocol,
                                rule.get('source_port'))
 
         args += self._port_arg('dport',
-                               rule.get('protocol'),
-                               rule.get('destination_port'))
+                               protocol,
+                               destination_port)
+
+        if service:
+            args += self._multiport_arg('dports', service[1])
 
         args += self._action_arg(action)
 
@@ -419,6 +1329,22 @@ class IptablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
 
         return args
 
+    def _match_set_arg(self, set_name, direction):
+        if not set_name:
+            return []
+
+        args = ['-m', 'set', '--match-set', set_name, direction]
+
+        return args
+
+    def _multiport_arg(self, direction, ports):
+        if not ports:
+            return []
+
+        args = ['-m', 'multiport', '--%s' % direction, ports]
+
+        return args
+
     def _protocol_arg(self, protocol):
         if not protocol:
             return []
@@ -13,11 +13,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+
+import eventlet
 from neutron.agent.linux import utils as linux_utils
 from neutron_lib import constants
+from neutron_lib.utils import helpers
+from oslo_config import cfg
 from oslo_log import log as logging
 
 from neutron_fwaas.services.firewall.drivers import conntrack_base
+from neutron_fwaas.services.firewall.drivers.linux import conntrack_matcher
 
 
 LOG = logging.getLogger(__name__)
@@ -42,13 +48,124 @@ class ConntrackLegacy(conntrack_base.ConntrackDriverBase):
         cmd = prefixcmd + ['conntrack', '-D']
         self._execute_command(cmd)
 
-    def delete_entries(self, rules, namespace):
+    def delete_entries(self, rules, namespace, marks=None):
         rule_filters = sorted(self._get_filter_from_rule(r) for r in rules)
+        reply_entries = {}
         delete_entries = self._get_entries_to_delete(
-            rule_filters, self.list_entries(namespace))
-        for delete_entry in delete_entries:
-            cmd = self._get_conntrack_cmd_from_entry(delete_entry, namespace)
-            self._execute_command(cmd)
+            rule_filters, self.iter_entries(namespace, marks, reply_entries),
+            reply_entries)
+        if marks and len(marks) > 1:
+            # entries having several of the marks are listed once per mark
+            delete_entries = list(
+                collections.OrderedDict.fromkeys(delete_entries))
+        cmds = self._get_conntrack_cmds_from_entries(
+            delete_entries, namespace, cfg.CONF.fwaas.conntrack_max_processes,
+            marks)
+        if cmds is None:
+            self.flush_entries(namespace)
+        else:
+            for cmd in cmds:
+                self._execute_command(cmd)
+        return len(delete_entries)
+
+    def _get_conntrack_cmds_from_entries(self, entries, namespace,
+                                         max_cmds, marks=None):
+        """Return the commands deleting entries, at most max_cmds of them
+
+        Entries are deleted one command each when possible. Otherwise they
+        are deleted by protocol and destination port (icmp type and code),
+        then by protocol only, which also deletes unmatched entries. When
+        the entries were listed by connection marks, the coarser commands
+        only delete the entries having the marks.
+
+        :returns: list of commands, or None if the namespace must be flushed
+        """
+        if len(entries) <= max_cmds:
+            return [self._get_conntrack_cmd_from_entry(entry, namespace)
+                    for entry in entries]
+        mark_args = [self._get_mark_args(mark) for mark in marks or []]
+        for get_filter in (self._get_service_filter, lambda e: e[:2]):
+            filters = sorted(set(get_filter(entry) for entry in entries))
+            if len(filters) * max(len(mark_args), 1) <= max_cmds:
+                LOG.debug('Deleting %(count)d conntrack entries with '
+                          '%(cmds)d commands in namespace %(namespace)s',
+                          {'count': len(entries), 'cmds': len(filters),
+                           'namespace': namespace})
+                return [self._get_conntrack_cmd_from_filter(entry_filter,
+                                                            namespace) + args
+                        for entry_filter in filters
+                        for args in mark_args or [[]]]
+        if mark_args:
+            prefixcmd = (['ip', 'netns', 'exec', namespace]
+                         if namespace else [])
+            return [prefixcmd + ['conntrack', '-D'] + args
+                    for args in mark_args]
+        LOG.debug('Flushing namespace %(namespace)s instead of deleting '
+                  '%(count)d conntrack entries',
+                  {'namespace': namespace, 'count': len(entries)})
+        return None
+
+    @staticmethod
+    def _get_mark_args(mark):
+        return ['--mark', '%#x/%#x' % tuple(mark)]
+
+    @staticmethod
+    def _get_icmp_option(protocol, attr):
+        """Return the conntrack option of an icmp or icmpv6 attribute
+
+        e.g. --icmp-type for icmp and --icmpv6-type for icmpv6 entries
+        """
+        return '--%s-%s' % (protocol, attr)
+
+    @staticmethod
+    def _get_service_filter(entry):
+        """Return the filter matching all the clients of an entry service
+
+        :returns: (ip_version, protocol, type, code) for icmp entries,
+        (ip_version, protocol, dport) for the others
+        """
+        if entry[1] in ['icmp', 'icmpv6']:
+            return entry[:4]
+        return entry[:2] + (entry[3],)
+
+    def _get_conntrack_cmd_from_filter(self, entry_filter, namespace):
+        """Return the command deleting the entries matched by a filter
+
+        :param entry_filter: (ip_version, protocol) or a filter returned by
+        _get_service_filter
+        """
+        prefixcmd = ['ip', 'netns', 'exec', namespace] if namespace else []
+        cmd = ['conntrack', '-D']
+        contrack_filter = ['-f', 'ipv' + str(entry_filter[0]),
+                           '-p', entry_filter[1]]
+        if entry_filter[1] in ['icmp', 'icmpv6'] and len(entry_filter) > 2:
+            contrack_filter.extend(
+                [self._get_icmp_option(entry_filter[1], 'type'),
+                 entry_filter[2],
+                 self._get_icmp_option(entry_filter[1], 'code'),
+                 entry_filter[3]])
+        elif len(entry_filter) > 2:
+            contrack_filter.extend(['--dport', entry_filter[2]])
+        return prefixcmd + cmd + contrack_filter
+
+    def delete_entries_batch(self, jobs, workers=1):
+        """Delete conntrack entries within several namespaces
+
+        Up to workers namespaces have their conntrack commands run
+        concurrently.
+        """
+        if workers <= 1 or len(jobs) <= 1:
+            return super(ConntrackLegacy, self).delete_entries_batch(jobs)
+
+        def _process_job(job):
+            namespace, rules = job[:2]
+            if rules is None:
+                self.flush_entries(namespace)
+                return namespace, None
+            return namespace, self.delete_entries(rules, namespace,
+                                                  *job[2:])
+
+        return dict(eventlet.GreenPool(workers).imap(_process_job, jobs))
 
     def _execute_command(self, cmd):
         try:
@@ -69,27 +186,72 @@ class ConntrackLegacy(conntrack_base.ConntrackDriverBase):
             for example: [(4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234),
             (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')]
         """
-        parsed_entries = []
+        return sorted(self.iter_entries(namespace))
+
+    def iter_entries(self, namespace, marks=None, reply_entries=None):
+        """Parse the conntrack entries while they are listed
+
+        conntrack output is read line by line, so that memory doesn't grow
+        with the number of entries.
+
+        :param namespace: namespace to get conntrack entries
+        :param marks: list of (value, mask) connection marks, only the
+            entries with one of them are listed if given
+        :param reply_entries: dict filled with the parsed reply tuples of
+            the NATed entries, by entry, before they are yielded
+        :returns: generator of unsorted conntrack entries in Python tuple
+        """
         prefixcmd = ['ip', 'netns', 'exec', namespace] if namespace else []
+        mark_args = [self._get_mark_args(mark) for mark in marks or []]
         for ip_version in IP_VERSIONS:
             cmd = prefixcmd + ['conntrack', '-L',
                                '-f', 'ipv' + str(ip_version)]
-            raw_entries = self._execute_command(cmd).splitlines()
-            for raw_entry in raw_entries:
-                parsed_entry = self._parse_entry(raw_entry.split(), ip_version)
-                parsed_entries.append(parsed_entry)
-        return sorted(parsed_entries)
+            for args in mark_args or [[]]:
+                for raw_entry in self._stream_command(cmd + args):
+                    raw_entry = raw_entry.split()
+                    entry = self._parse_entry(raw_entry, ip_version)
+                    if reply_entries is not None:
+                        reply_entry = self._parse_reply_entry(raw_entry,
+                                                              ip_version)
+                        if conntrack_matcher.get_translated_entry(
+                                entry, reply_entry):
+                            reply_entries[entry] = reply_entry
+                    yield entry
+
+    def _stream_command(self, cmd):
+        """Run a command and yield its output lines as they are read."""
+        try:
+            process, cmd = linux_utils.create_process(cmd, run_as_root=True)
+        except OSError:
+            msg = "Failed execute conntrack command %s" % cmd
+            raise RuntimeError(msg)
+        try:
+            for line in process.stdout:
+                line = helpers.safe_decode_utf8(line).strip()
+                if line:
+                    yield line
+        finally:
+            # drain the output left by a consumer stopping early
+            for _line in process.stdout:
+                pass
+            returncode = process.wait()
+        if returncode not in (0, 1):
+            msg = "Failed execute conntrack command %s" % cmd
+            raise RuntimeError(msg)
 
     def _get_conntrack_cmd_from_entry(self, entry, namespace):
         prefixcmd = ['ip', 'netns', 'exec', namespace] if namespace else []
         cmd = ['conntrack', '-D']
         contrack_filter = ['-f', 'ipv' + str(entry[0]), '-p', entry[1]]
         if entry[1] in ['icmp', 'icmpv6']:
-            contrack_filter.extend(['--icmp-type', entry[2],
-                                    '--icmp-code', entry[3],
+            contrack_filter.extend([self._get_icmp_option(entry[1], 'type'),
+                                    entry[2],
+                                    self._get_icmp_option(entry[1], 'code'),
+                                    entry[3],
                                     '-s', entry[4],
                                     '-d', entry[5],
-                                    '--icmp-id', entry[6]])
+                                    self._get_icmp_option(entry[1], 'id'),
+                                    entry[6]])
         else:
             contrack_filter.extend(['--sport', entry[2],
                                     '--dport', entry[3],
@@ -116,36 +278,48 @@ class ConntrackLegacy(conntrack_base.ConntrackDriverBase):
                                                      'code', 'id'] else val)
         return tuple(parsed_entry)
 
-    def _get_entries_to_delete(self, rule_filters, entries):
+    def _parse_reply_entry(self, entry, ip_version):
+        """Parse the reply tuple of an entry from text to Python tuple
+
+        The reply tuple follows the original one in the entry text, and is
+        parsed like the entry.
+
+        :param entry: conntrack entry in text
+        :param ip_version: ip version 4 or 6
+        :returns: reply tuple in Python tuple, or None if it isn't listed
+        """
+        protocol = entry[0]
+        positions = [position for position, attr in enumerate(entry)
+                     if attr.startswith('src=')]
+        if len(positions) < 2:
+            return None
+        attrs = {}
+        for attr in entry[positions[1]:]:
+            key, sep, val = attr.partition('=')
+            if not sep or key in attrs:
+                break
+            attrs[key] = val
+        parsed_entry = [ip_version, protocol]
+        for attr, _position in ATTR_POSITIONS[protocol]:
+            if attr not in attrs:
+                return None
+            parsed_entry.append(int(attrs[attr]) if attr in [
+                'sport', 'dport', 'type', 'code', 'id'] else attrs[attr])
+        return tuple(parsed_entry)
+
+    def _get_entries_to_delete(self, rule_filters, entries,
+                               reply_entries=None):
         """Specify conntrack entries to delete
 
         :param rule_filters: List of filters parsed from firewall rules
-        :param entries: all entries within namespace
+        :param entries: iterable of the entries within namespace, which is
+            consumed once
+        :param reply_entries: dict of the reply tuples of the NATed entries,
+            filled while the entries are consumed
         :returns: conntrack entries to delete
         """
-        # List all entries from namespace, they are already parsed
-        # to a list of tuples:
-        # [(4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234),
-        #  (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')]
-        delete_entries = []
-        entry_index = 0
-        entry_number = len(entries)
-        for rule_filter in rule_filters:
-            while entry_index < entry_number:
-                # Compare entry with rule
-                comp = self._compare_entry_and_rule_filter(
-                    rule_filter, entries[entry_index])
-                # Increase entry_index when entry is under rule
-                if comp < 0:
-                    entry_index += 1
-                # Append entry to delete_entry if it matches with rule
-                elif comp == 0:
-                    delete_entries.append(entries[entry_index])
-                    entry_index += 1
-                # Switch to new higher rule
-                else:
-                    break
-        return delete_entries
+        return conntrack_matcher.ConntrackMatcher(rule_filters).select(
+            entries, reply_entries)
 
     @staticmethod
     def _get_filter_from_rule(rule):
@@ -169,47 +343,3 @@ class ConntrackLegacy(conntrack_base.ConntrackDriverBase):
             else:
                 rule_filter.append(rule.get(key, []))
         return tuple(rule_filter)
-
-    @staticmethod
-    def _compare_entry_and_rule_filter(rule_filter, entry):
-        """Define that the entry should be deleted or not
-
-        :param rule_filter: filter that is parsed from a firewall rule
-        for example: (4, 'tcp', ['22', '33'], ['44', '55'])
-        :param entry: parsed conntrack entry,
-        for example: (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')
-        :returns: -1 if entry is lower than rule
-                   0 if entry matches rule,
-                   1 if entry is higher than rule
-        """
-        ENTRY_IS_LOWER = -1
-        ENTRY_MATCHES = 0
-        ENTRY_IS_HIGHER = 1
-        rule_ip_version = rule_filter[0]
-        if entry[0] < rule_ip_version:
-            return ENTRY_IS_LOWER
-        elif entry[0] > rule_ip_version:
-            return ENTRY_IS_HIGHER
-        rule_protocol = rule_filter[1]
-        if rule_protocol == constants.PROTO_NAME_IPV6_ICMP:
-            rule_protocol = constants.PROTO_NAME_IPV6_ICMP_LEGACY
-        if rule_protocol:
-            if entry[1] < rule_protocol:
-                return ENTRY_IS_LOWER
-            elif entry[1] > rule_protocol:
-                return ENTRY_IS_HIGHER
-        sport_range = rule_filter[2]
-        if sport_range:
-            sport_range = [int(port) for port in sport_range]
-            if entry[2] < min(sport_range[0], sport_range[-1]):
-                return ENTRY_IS_LOWER
-            elif entry[2] > max(sport_range[0], sport_range[-1]):
-                return ENTRY_IS_HIGHER
-        dport_range = rule_filter[3]
-        if dport_range:
-            dport_range = [int(port) for port in dport_range]
-            if entry[3] < min(dport_range[0], dport_range[-1]):
-                return ENTRY_IS_LOWER
-            elif entry[3] > max(dport_range[0], dport_range[-1]):
-                return ENTRY_IS_HIGHER
-        return ENTRY_MATCHES
@@ -0,0 +1,462 @@
+# Copyright (c) 2018
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import contextlib
+
+from neutron.agent.linux import utils as linux_utils
+from neutron_lib.exceptions import firewall_v2 as fw_ext
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import timeutils
+
+from neutron_fwaas.services.firewall.drivers import conntrack_base
+from neutron_fwaas.services.firewall.drivers import fwaas_base_v2
+from neutron_fwaas.services.firewall.drivers.linux import iptables_fwaas_v2
+
+LOG = logging.getLogger(__name__)
+FWAAS_DRIVER_NAME = 'Fwaas nftables driver'
+
+NFT_FAMILY = 'inet'
+NFT_TABLE = 'neutron_fwaas'
+FWAAS_TO_NFT_ACTION_MAP = {'allow': 'accept',
+                           'deny': 'drop',
+                           'reject': 'reject'}
+INGRESS_DIRECTION = iptables_fwaas_v2.INGRESS_DIRECTION
+EGRESS_DIRECTION = iptables_fwaas_v2.EGRESS_DIRECTION
+CHAIN_NAME_PREFIX = iptables_fwaas_v2.CHAIN_NAME_PREFIX
+# interface matched and verdict map used to dispatch each direction, the
+# packets ingressing tenant's network leave the router by the port
+DIRECTION_PORT_MAPS = {INGRESS_DIRECTION: ('oifname', 'ingress-ports'),
+                       EGRESS_DIRECTION: ('iifname', 'egress-ports')}
+# set of the interfaces of all the firewall groups, dropped by default
+PORTS_SET = 'ports'
+NFPROTO = {4: 'ipv4', 6: 'ipv6'}
+ADDRESS_FAMILY = {4: 'ip', 6: 'ip6'}
+ADDRESS_TYPE = {4: 'ipv4_addr', 6: 'ipv6_addr'}
+ADDRESS_GROUP_SET_PREFIX = 'ag-'
+PORT_PROTOCOLS = ('tcp', 'udp')
+
+
+class NftablesFwaasDriver(fwaas_base_v2.FwaasDriverBase):
+    """nftables driver for Firewall As A Service.
+
+    The firewall groups of a router namespace live in a single nftables
+    table, which is rewritten by one atomic 'nft -f' transaction whenever
+    one of them changes. Packets are dispatched to the chain of the firewall
+    group of their port with verdict map lookups, the addresses of address
+    groups are named sets and the ports of service groups anonymous sets.
+    """
+
+    def __init__(self):
+        LOG.debug("Initializing fwaas nftables driver")
+        self.conntrack = conntrack_base.load_and_init_conntrack_driver()
+        # namespace -> {fwid: {'interfaces': [...], 'firewall': firewall}},
+        # firewall being None for firewall groups with the default policy
+        self._namespaces = {}
+        # namespace -> ids of the firewall groups changed within a batch
+        self._pending_apply = None
+        self._pending_after_apply = []
+
+    def _get_intf_name(self, if_prefix, port_id):
+        _name = "%s%s" % (if_prefix, port_id)
+        return _name[:iptables_fwaas_v2.MAX_INTF_NAME_LEN]
+
+    def _get_namespaces_with_if_prefix(self, agent_mode, ri):
+        """Gets the namespaces along with the if prefix to apply rules.
+
+        Same as the iptables driver: with DVR the snat namespace and the
+        fip interfaces of the router namespace may both be firewalled.
+        """
+        if not ri.router.get('distributed'):
+            return [(ri.iptables_manager.namespace,
+                     iptables_fwaas_v2.INTERNAL_DEV_PREFIX)]
+        namespaces = []
+        if agent_mode == 'dvr_snat':
+            if ri.snat_iptables_manager:
+                namespaces.append((ri.snat_iptables_manager.namespace,
+                                   iptables_fwaas_v2.SNAT_INT_DEV_PREFIX))
+        if ri.dist_fip_count:
+            namespaces.append((ri.iptables_manager.namespace,
+                               iptables_fwaas_v2.ROUTER_2_FIP_DEV_PREFIX))
+        return namespaces
+
+    def _get_namespace_interfaces(self, agent_mode, apply_list):
+        """Return the firewall group interfaces of each namespace."""
+        namespace_interfaces = collections.OrderedDict()
+        for ri, router_fw_ports in apply_list:
+            for namespace, if_prefix in self._get_namespaces_with_if_prefix(
+                    agent_mode, ri):
+                namespace_interfaces.setdefault(namespace, []).extend(
+                    self._get_intf_name(if_prefix, port_id)
+                    for port_id in router_fw_ports)
+        return namespace_interfaces
+
+    def create_firewall_group(self, agent_mode, apply_list, firewall):
+        LOG.debug('Creating firewall %(fw_id)s for tenant %(tid)s',
+                  {'fw_id': firewall['id'], 'tid': firewall['tenant_id']})
+        self._set_firewall(agent_mode, apply_list, firewall,
+                           firewall['admin_state_up'], 'create')
+
+    def update_firewall_group(self, agent_mode, apply_list, firewall):
+        LOG.debug('Updating firewall %(fw_id)s for tenant %(tid)s',
+                  {'fw_id': firewall['id'], 'tid': firewall['tenant_id']})
+        self._set_firewall(agent_mode, apply_list, firewall,
+                           firewall['admin_state_up'], 'update')
+
+    def apply_default_policy(self, agent_mode, apply_list, firewall):
+        LOG.debug('Applying firewall %(fw_id)s for tenant %(tid)s',
+                  {'fw_id': firewall['id'], 'tid': firewall['tenant_id']})
+        self._set_firewall(agent_mode, apply_list, firewall, False,
+                           'apply default policy on')
+
+    def delete_firewall_group(self, agent_mode, apply_list, firewall):
+        LOG.debug('Deleting firewall %(fw_id)s for tenant %(tid)s',
+                  {'fw_id': firewall['id'], 'tid': firewall['tenant_id']})
+        fwid = firewall['id']
+        try:
+            for namespace in self._get_namespace_interfaces(agent_mode,
+                                                            apply_list):
+                firewall_groups = self._namespaces.get(namespace, {})
+                if firewall_groups.pop(fwid, None) is not None:
+                    self._apply(namespace, fwid)
+                    self.conntrack.release_namespace(namespace)
+        except (LookupError, RuntimeError):
+            # catch known library exceptions and raise Fwaas generic exception
+            LOG.exception("Failed to delete firewall: %s", fwid)
+            raise fw_ext.FirewallInternalDriverError(driver=FWAAS_DRIVER_NAME)
+
+    def release_namespace(self, namespace):
+        """Forget the firewall groups applied in a removed namespace."""
+        self._namespaces.pop(namespace, None)
+        if self._pending_apply is not None:
+            self._pending_apply.pop(namespace, None)
+        self.conntrack.release_namespace(namespace)
+
+    def _set_firewall(self, agent_mode, apply_list, firewall, policy,
+                      operation):
+        """Apply the rules of a firewall group, or its default policy.
+
+        :param policy: False to drop all the traffic of the ports instead
+                       of applying the firewall group rules
+        """
+        fwid = firewall['id']
+        try:
+            pre_firewalls = {}
+            for namespace, interfaces in self._get_namespace_interfaces(
+                    agent_mode, apply_list).items():
+                firewall_groups = self._namespaces.setdefault(
+                    namespace, collections.OrderedDict())
+                pre_firewall_group = firewall_groups.get(fwid)
+                pre_firewalls[namespace] = (
+                    pre_firewall_group and pre_firewall_group['firewall'])
+                firewall_groups[fwid] = {
+                    'interfaces': interfaces,
+                    'firewall': firewall if policy else None}
+                self._apply(namespace, fwid)
+            if policy:
+                self._after_apply(fwid, self._remove_conntrack,
+                                  pre_firewalls, firewall)
+        except (LookupError, RuntimeError):
+            # catch known library exceptions and raise Fwaas generic exception
+            LOG.exception("Failed to %(operation)s firewall: %(fwid)s",
+                          {'operation': operation, 'fwid': fwid})
+            raise fw_ext.FirewallInternalDriverError(driver=FWAAS_DRIVER_NAME)
+
+    @contextlib.contextmanager
+    def batch_apply(self):
+        """Commit the nftables changes made within the block at its end.
+
+        Every namespace touched within the block is committed exactly once,
+        in a single transaction, when the block exits. The yielded set is
+        filled with the ids of the firewall groups whose namespace failed
+        to be committed.
+        """
+        if self._pending_apply is not None:
+            # nested batch, the outermost one commits
+            yield set()
+            return
+        self._pending_apply = collections.OrderedDict()
+        failed_fwids = set()
+        try:
+            yield failed_fwids
+        finally:
+            pending, self._pending_apply = self._pending_apply, None
+            after_apply, self._pending_after_apply = (
+                self._pending_after_apply, [])
+            for namespace, fwids in pending.items():
+                try:
+                    self._commit(namespace)
+                except RuntimeError:
+                    LOG.exception("Failed to commit firewall rules in "
+                                  "namespace %s", namespace)
+                    failed_fwids.update(fwids)
+            for fwid, func, args in after_apply:
+                if fwid in failed_fwids:
+                    continue
+                try:
+                    func(*args)
+                except (LookupError, RuntimeError):
+                    LOG.exception("Failed to clean up connections of "
+                                  "firewall: %s", fwid)
+                    failed_fwids.add(fwid)
+
+    def _apply(self, namespace, fwid):
+        """Commit the table of a namespace, unless batching."""
+        if self._pending_apply is None:
+            self._commit(namespace)
+            return
+        self._pending_apply.setdefault(namespace, set()).add(fwid)
+
+    def _after_apply(self, fwid, func, *args):
+        """Call func once the rules of the firewall group are committed."""
+        if self._pending_apply is None:
+            func(*args)
+        else:
+            self._pending_after_apply.append((fwid, func, args))
+
+    def _commit(self, namespace):
+        """Replace the table of a namespace in a single nft transaction."""
+        firewall_groups = self._namespaces.get(namespace)
+        # declaring the table first makes deleting it always succeed
+        lines = ['add table %s %s' % (NFT_FAMILY, NFT_TABLE),
+                 'delete table %s %s' % (NFT_FAMILY, NFT_TABLE)]
+        if firewall_groups:
+            lines += self._render_table(firewall_groups)
+        else:
+            self._namespaces.pop(namespace, None)
+        prefixcmd = ['ip', 'netns', 'exec', namespace] if namespace else []
+        watch = timeutils.StopWatch()
+        watch.start()
+        linux_utils.execute(prefixcmd + ['nft', '-f', '-'],
+                            process_input='\n'.join(lines) + '\n',
+                            run_as_root=True)
+        watch.stop()
+        LOG.debug("Committed %(count)d nftables lines in namespace %(ns)s "
+                  "in %(time).3f seconds",
+                  {'count': len(lines), 'ns': namespace,
+                   'time': watch.elapsed()})
+
+    def _remove_conntrack(self, pre_firewalls, firewall):
+        """Remove the connections of the rules which changed
+
+        Namespaces the firewall group had no rules applied to are flushed.
+        """
+        jobs = []
+        for namespace, pre_firewall in pre_firewalls.items():
+            if not pre_firewall:
+                jobs.append((namespace, None))
+                continue
+            rules = self._find_conntrack_rules(pre_firewall, firewall)
+            if rules:
+                jobs.append((namespace, rules))
+        if jobs:
+            self.conntrack.delete_entries_batch(
+                jobs, cfg.CONF.fwaas.conntrack_workers)
+
+    def _find_conntrack_rules(self, pre_firewall, firewall):
+        """Return the rules changed, added or removed between two versions."""
+        rules = []
+        for fw_rule_list in ['egress_rule_list', 'ingress_rule_list']:
+            rules_by_id = dict((rule['id'], rule)
+                               for rule in firewall[fw_rule_list])
+            pre_rule_ids = set()
+            for pre_rule in pre_firewall[fw_rule_list]:
+                pre_rule_ids.add(pre_rule['id'])
+                rule = rules_by_id.get(pre_rule['id'])
+                if rule != pre_rule:
+                    rules.append(pre_rule)
+                    if rule is not None:
+                        rules.append(rule)
+            rules.extend(rule for rule in firewall[fw_rule_list]
+                         if rule['id'] not in pre_rule_ids)
+        return rules
+
+    def _get_chain_name(self, fwid, direction):
+        return '%s-%s' % (CHAIN_NAME_PREFIX[direction], fwid)
+
+    def _get_address_group_set_name(self, address_group, ip_version):
+        return '%s%s-v%d' % (ADDRESS_GROUP_SET_PREFIX, address_group['id'],
+                             ip_version)
+
+    def _render_table(self, firewall_groups):
+        """Render the table holding the firewall groups of a namespace."""
+        port_maps = {INGRESS_DIRECTION: [], EGRESS_DIRECTION: []}
+        interfaces = []
+        address_sets = collections.OrderedDict()
+        chains = []
+        for fwid, firewall_group in firewall_groups.items():
+            interfaces.extend(firewall_group['interfaces'])
+            firewall = firewall_group['firewall']
+            if firewall is None:
+                continue
+            for direction in [INGRESS_DIRECTION, EGRESS_DIRECTION]:
+                chain_name = self._get_chain_name(fwid, direction)
+                port_maps[direction].extend(
+                    '"%s" : jump %s' % (interface, chain_name)
+                    for interface in firewall_group['interfaces'])
+                rule_list = firewall['%s_rule_list' % direction]
+                chains.append((chain_name,
+                               self._render_chain(rule_list, address_sets)))
+
+        lines = ['table %s %s {' % (NFT_FAMILY, NFT_TABLE)]
+        lines += self._render_set(PORTS_SET, 'ifname', interfaces)
+        for direction in [INGRESS_DIRECTION, EGRESS_DIRECTION]:
+            lines += self._render_set(DIRECTION_PORT_MAPS[direction][1],
+                                      'ifname : verdict',
+                                      port_maps[direction])
+        for set_name, (ip_version, addresses) in address_sets.items():
+            lines += self._render_set(set_name, ADDRESS_TYPE[ip_version],
+                                      addresses, interval=True)
+        lines.append('chain forward {')
+        lines.append('type filter hook forward priority 0; policy accept;')
+        # a port is dropped unless the firewall group chain of one of the
+        # directions of the packet accepts it
+        for direction in [INGRESS_DIRECTION, EGRESS_DIRECTION]:
+            lines.append('%s vmap @%s' % DIRECTION_PORT_MAPS[direction])
+        for direction in [INGRESS_DIRECTION, EGRESS_DIRECTION]:
+            lines.append('%s @%s drop' % (DIRECTION_PORT_MAPS[direction][0],
+                                          PORTS_SET))
+        lines.append('}')
+        for chain_name, rules in chains:
+            lines.append('chain %s {' % chain_name)
+            lines += rules
+            lines.append('}')
+        lines.append('}')
+        return lines
+
+    def _render_set(self, name, set_type, elements, interval=False):
+        kind = 'map' if ':' in set_type else 'set'
+        lines = ['%s %s {' % (kind, name), 'type %s;' % set_type]
+        if interval:
+            # address groups may hold overlapping prefixes
+            lines.append('flags interval; auto-merge;')
+        if elements:
+            quoted = elements if kind == 'map' or interval else [
+                '"%s"' % element for element in elements]
+            lines.append('elements = { %s }' % ', '.join(quoted))
+        lines.append('}')
+        return lines
+
+    def _render_chain(self, rule_list, address_sets):
+        """Render the rules of a firewall group chain.
+
+        :param address_sets: dict filled with the (ip_version, addresses)
+                             of the address group sets the rules match
+        """
+        rules = ['ct state invalid drop',
+                 'ct state established,related accept']
+        for rule in rule_list:
+            if not rule['enabled']:
+                continue
+            rules += self._convert_fwaas_to_nft_rules(rule, address_sets)
+        return rules
+
+    def _get_address_matches(self, rule, direction, address_sets):
+        """Return the matches of the addresses of a rule direction.
+
+        :param direction: 'source' or 'destination'
+        :returns: list of matches, any of which the address must satisfy
+        """
+        family = ADDRESS_FAMILY[rule['ip_version']]
+        field = 'saddr' if direction == 'source' else 'daddr'
+        address_match = None
+        address = rule.get('%s_ip_address' % direction)
+        if address:
+            address_match = '%s %s %s' % (family, field,
+                                          address.replace(' ', ''))
+        matches = []
+        for address_group in rule.get('%s_address_groups' % direction) or []:
+            set_name = self._get_address_group_set_name(address_group,
+                                                        rule['ip_version'])
+            address_sets[set_name] = (rule['ip_version'], [
+                addr['ip_address'] for addr in address_group['ip_addresses']
+                if self._get_address_version(addr) == rule['ip_version']])
+            # the address must also be in one of the groups
+            matches.append(' '.join(
+                [m for m in (address_match,) if m] +
+                ['%s %s @%s' % (family, field, set_name)]))
+        return matches or [address_match]
+
+    @staticmethod
+    def _get_address_version(address):
+        if address.get('ip_version'):
+            return address['ip_version']
+        return 6 if ':' in address['ip_address'] else 4
+
+    def _get_service_matches(self, rule):
+        """Return the protocol and port matches of a rule.
+
+        The ports of the service groups of a protocol are matched with an
+        anonymous set, so a rule is rendered once per protocol.
+        """
+        protocol = rule.get('protocol')
+        sport = self._get_nft_port(rule.get('source_port'))
+        service_groups = rule.get('service_groups')
+        if not service_groups:
+            dport = self._get_nft_port(rule.get('destination_port'))
+            return [self._get_l4_match(protocol, sport, dport)]
+        # protocol -> destination ports, None once a service of the
+        # protocol matches any port
+        protocol_ports = collections.OrderedDict()
+        for service_group in service_groups:
+            for service in service_group['ports']:
+                if protocol and service['protocol'] != protocol:
+                    continue
+                ports = protocol_ports.setdefault(service['protocol'], [])
+                port = self._get_nft_port(service.get('port'))
+                if service['protocol'] not in PORT_PROTOCOLS or not port:
+                    protocol_ports[service['protocol']] = None
+                elif ports is not None and port not in ports:
+                    ports.append(port)
+        return [self._get_l4_match(service_protocol, sport,
+                                   '{ %s }' % ', '.join(ports)
+                                   if ports else None)
+                for service_protocol, ports in protocol_ports.items()]
+
+    @staticmethod
+    def _get_nft_port(port):
+        if not port:
+            return None
+        return str(port).replace(':', '-')
+
+    def _get_l4_match(self, protocol, sport, dport):
+        if not protocol:
+            return None
+        if protocol not in PORT_PROTOCOLS or not (sport or dport):
+            return 'meta l4proto %s' % protocol
+        matches = []
+        if sport:
+            matches.append('%s sport %s' % (protocol, sport))
+        if dport:
+            matches.append('%s dport %s' % (protocol, dport))
+        return ' '.join(matches)
+
+    def _convert_fwaas_to_nft_rules(self, rule, address_sets):
+        """Return the nftables rules of a firewall rule.
+
+        A rule matching address groups is rendered once per pair of its
+        source and destination matches, each group being a named set.
+        """
+        action = FWAAS_TO_NFT_ACTION_MAP[rule.get('action')]
+        prefix = 'meta nfproto %s' % NFPROTO[rule['ip_version']]
+        nft_rules = []
+        for src in self._get_address_matches(rule, 'source', address_sets):
+            for dst in self._get_address_matches(rule, 'destination',
+                                                 address_sets):
+                for l4 in self._get_service_matches(rule):
+                    matches = [prefix] + [m for m in (src, dst, l4) if m]
+                    nft_rules.append(' '.join(matches + [action]))
+        return nft_rules
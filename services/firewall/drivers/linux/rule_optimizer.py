@@ -0,0 +1,194 @@
+# Copyright (c) 2018
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import netaddr
+
+# protocols whose rules match source and destination ports
+PORT_PROTOCOLS = ('tcp', 'udp')
+ADDRESS_ATTRS = ('source_ip_address', 'destination_ip_address')
+PORT_ATTRS = ('source_port', 'destination_port')
+# rule attributes matching the address group sets and the service groups,
+# which are only known by their members
+GROUP_ATTRS = {'source_ip_address': 'source_address_groups',
+               'destination_ip_address': 'destination_address_groups',
+               'protocol': 'service_groups',
+               'destination_port': 'service_groups'}
+# attribute value of a rule not limiting the packets it matches
+ANY = None
+# placeholder of an attribute matching the members of groups
+GROUPS = object()
+
+
+def _port_range(port):
+    """Return the (lower, upper) bounds of a rule port range."""
+    ports = [int(bound) for bound in str(port).replace('-', ':').split(':')]
+    return min(ports[0], ports[-1]), max(ports[0], ports[-1])
+
+
+def _address_range(address):
+    """Return the (first, last) integer bounds of a rule address."""
+    if '-' in address:
+        first, last = address.split('-', 1)
+        ip_range = netaddr.IPRange(first.strip(), last.strip())
+    else:
+        ip_range = netaddr.IPNetwork(address)
+    return ip_range.first, ip_range.last
+
+
+def _get_match(rule):
+    """Return the packets matched by a rule
+
+    :returns: dict of the rule match attributes, values being ANY, GROUPS,
+              a protocol name, or the integer bounds of addresses and ports
+    """
+    match = {}
+    protocol = rule.get('protocol') or ANY
+    for attr in ('protocol',) + ADDRESS_ATTRS + PORT_ATTRS:
+        if rule.get(GROUP_ATTRS.get(attr)):
+            match[attr] = GROUPS
+        elif attr == 'protocol':
+            match[attr] = protocol
+        elif not rule.get(attr):
+            match[attr] = ANY
+        elif attr in ADDRESS_ATTRS:
+            match[attr] = _address_range(rule[attr])
+        elif protocol in PORT_PROTOCOLS:
+            match[attr] = _port_range(rule[attr])
+        else:
+            # ports are only rendered for the protocols having ports
+            match[attr] = ANY
+    return match
+
+
+def _covers(value, other):
+    """Return True if an attribute value matches all the other one does."""
+    if value is ANY:
+        return True
+    if value is GROUPS or other is ANY or other is GROUPS:
+        return False
+    if isinstance(value, tuple):
+        return value[0] <= other[0] and other[1] <= value[1]
+    return value == other
+
+
+def _shadows(match, other):
+    """Return True if a rule match is a superset of another one."""
+    return all(_covers(match[attr], other[attr]) for attr in match)
+
+
+def _merge_addresses(address, other):
+    """Return the CIDR of the union of two CIDRs, if there is one."""
+    if '-' in address or '-' in other:
+        return None
+    cidrs = netaddr.cidr_merge([address, other])
+    if len(cidrs) != 1:
+        return None
+    return str(cidrs[0])
+
+
+def _merge_ports(port, other):
+    """Return the port range of the union of two ranges, if there is one."""
+    lower, upper = _port_range(port)
+    other_lower, other_upper = _port_range(other)
+    if other_lower > upper + 1 or lower > other_upper + 1:
+        return None
+    lower, upper = min(lower, other_lower), max(upper, other_upper)
+    if lower == upper:
+        return str(lower)
+    return '%d:%d' % (lower, upper)
+
+
+def _merge(rule, other):
+    """Return a rule matching the packets of two consecutive rules
+
+    Rules taking the same action and only differing by a CIDR or a port
+    range are merged when the union of their values is a CIDR or a range.
+
+    :returns: the merged rule, or None if the rules can't be merged
+    """
+    if rule.get('action') != other.get('action'):
+        return None
+    if any(rule.get(attr) or other.get(attr)
+           for attr in set(GROUP_ATTRS.values())):
+        return None
+    if rule.get('protocol') != other.get('protocol'):
+        return None
+    differences = [attr for attr in ADDRESS_ATTRS + PORT_ATTRS
+                   if rule.get(attr) != other.get(attr)]
+    if len(differences) != 1:
+        return None
+    attr = differences[0]
+    if not rule.get(attr) or not other.get(attr):
+        return None
+    if attr in ADDRESS_ATTRS:
+        value = _merge_addresses(rule[attr], other[attr])
+    elif rule.get('protocol') in PORT_PROTOCOLS:
+        value = _merge_ports(rule[attr], other[attr])
+    else:
+        value = None
+    if value is None:
+        return None
+    merged = dict(rule)
+    merged[attr] = value
+    return merged
+
+
+def optimize_rules(rules):
+    """Remove the rules which can't change the verdict of a rule list
+
+    Rules of a single chain, i.e. of one direction and IP version, are
+    evaluated in order and the first matching one decides, so:
+      - a rule whose packets are all matched by an earlier rule is removed,
+        whatever their actions, as a duplicate or shadowed rule
+      - consecutive rules taking the same action and only differing by
+        a CIDR or a port range are merged into one rule when the union of
+        these values is itself a CIDR or a range
+    Rules matching address groups or service groups are only shadowed by
+    rules not limiting the addresses or services they match, and are never
+    merged. The result is not guaranteed to be the smallest equivalent list.
+
+    The given rules are not modified, merged rules being copies of the first
+    of the rules they replace.
+
+    :param rules: enabled firewall rules of a chain, in policy order
+    :returns: (rules, removed) tuple of the equivalent rule list and of the
+              list of (rule id, reason) tuples of the removed rules
+    """
+    optimized = []
+    matches = []
+    removed = []
+    for rule in rules:
+        match = _get_match(rule)
+        for kept, kept_match in zip(optimized, matches):
+            if _shadows(kept_match, match):
+                reason = ('duplicate of rule %s' if kept_match == match
+                          else 'shadowed by rule %s') % kept['id']
+                removed.append((rule['id'], reason))
+                break
+        else:
+            optimized.append(rule)
+            matches.append(match)
+            # a merged rule may in turn merge with the rule preceding it
+            while len(optimized) > 1:
+                merged = _merge(optimized[-2], optimized[-1])
+                if merged is None:
+                    break
+                removed.append((optimized[-1]['id'],
+                                'merged into rule %s' % merged['id']))
+                optimized.pop()
+                matches.pop()
+                optimized[-1] = merged
+                matches[-1] = _get_match(merged)
+    return optimized, removed
@@ -26,11 +26,24 @@ from oslo_config import cfg
 from oslo_log import log as logging
 import oslo_messaging
 
+from neutron_fwaas._i18n import _
 from neutron_fwaas.common import fwaas_constants
+from neutron_fwaas.common import rule_deltas
 from neutron_fwaas.db.firewall.v2 import firewall_db_v2
 
 LOG = logging.getLogger(__name__)
 
+firewall_plugin_v2_opts = [
+    cfg.BoolOpt('send_rule_deltas',
+                default=False,
+                help=_("Send the L3 agents the changes of the rules of "
+                       "firewall groups as deltas from the revisions they "
+                       "applied, rather than whole rule lists. Groups with "
+                       "ports of L2 agents are always sent whole. Only "
+                       "enable once every L3 agent supports it")),
+]
+cfg.CONF.register_opts(firewall_plugin_v2_opts, 'fwaas')
+
 
 def add_provider_configuration(type_manager, service_type):
     type_manager.add_provider_configuration(
@@ -64,9 +77,23 @@ class FirewallAgentApi(object):
                    firewall_group=firewall_group,
                    host=self.host)
 
+    def update_firewall_group_rules(self, context, firewall_group):
+        cctxt = self.client.prepare(fanout=True)
+        cctxt.cast(context, 'update_firewall_group_rules',
+                   firewall_group=firewall_group,
+                   host=self.host)
+
 
 class FirewallCallbacks(object):
-    target = oslo_messaging.Target(version='1.0')
+    """Plugin side of the agent to plugin RPC API.
+
+    API version history:
+        1.0 - Initial version.
+        1.1 - Add get_firewall_groups_for_host.
+        1.2 - Add get_firewall_group_for_host.
+    """
+
+    target = oslo_messaging.Target(version='1.2')
 
     def __init__(self, plugin):
         super(FirewallCallbacks, self).__init__()
@@ -115,24 +142,65 @@ class FirewallCallbacks(object):
             return True
 
     def get_firewall_groups_for_project(self, context, **kwargs):
-        """Gets all firewall_groups and rules on a project."""
+        """Gets all firewall_groups and rules on a project.
+
+        Agents giving their host only get the groups with ports on the
+        routers of their host.
+        """
         LOG.debug("get_firewall_groups_for_project() called")
-        fwg_list = []
-        for fwg in self.plugin.get_firewall_groups(context):
-            fwg_with_rules = self.plugin._make_firewall_group_dict_with_rules(
-                context, fwg['id'])
-            if fwg['status'] == nl_constants.PENDING_DELETE:
-                fwg_with_rules['add-port-ids'] = []
-                fwg_with_rules['del-port-ids'] = (
-                    self.plugin._get_ports_in_firewall_group(context,
-                        fwg['id']))
-            else:
-                fwg_with_rules['add-port-ids'] = (
-                    self.plugin._get_ports_in_firewall_group(context,
-                        fwg['id']))
-                fwg_with_rules['del-port-ids'] = []
-            fwg_list.append(fwg_with_rules)
-        return fwg_list
+        host = kwargs.get('host')
+        if host:
+            fwg_list = self.plugin.get_firewall_groups_on_host(context, host)
+        else:
+            fwg_list = self.plugin.get_firewall_groups(context)
+        return [self._make_firewall_group_dict_for_sync(context, fwg)
+                for fwg in fwg_list]
+
+    def get_firewall_groups_for_host(self, context, host, marker=None,
+                                     limit=None, **kwargs):
+        """Gets a page of the firewall_groups and rules of a host.
+
+        Only the groups with ports on the routers of the host are returned,
+        ordered by id, the next page starting after the id of the last group
+        of the previous one.
+        """
+        LOG.debug("get_firewall_groups_for_host() called")
+        ctx = context.elevated()
+        return [self._make_firewall_group_dict_for_sync(ctx, fwg)
+                for fwg in self.plugin.get_firewall_groups_on_host(
+                    ctx, host, marker=marker, limit=limit)]
+
+    def get_firewall_group_for_host(self, context, host, fwg_id, **kwargs):
+        """Gets a firewall_group and its rules, as synced to a host.
+
+        Agents fetch a group this way when the rule list deltas they were
+        sent don't apply to the rules they have. None is returned if the
+        group was deleted meanwhile.
+        """
+        LOG.debug("get_firewall_group_for_host() called")
+        ctx = context.elevated()
+        try:
+            fwg = self.plugin.get_firewall_group(ctx, fwg_id)
+        except f_exc.FirewallGroupNotFound:
+            return None
+        return self._make_firewall_group_dict_for_sync(ctx, fwg)
+
+    def _make_firewall_group_dict_for_sync(self, context, fwg):
+        """Make the dict of a firewall group and its rules for an agent.
+
+        The ports of a group are added, or deleted if the group is being
+        deleted. They are taken from the group dict rather than queried
+        again.
+        """
+        fwg_with_rules = self.plugin._add_firewall_group_rule_lists(
+            context, dict(fwg))
+        if fwg['status'] == nl_constants.PENDING_DELETE:
+            fwg_with_rules['add-port-ids'] = []
+            fwg_with_rules['del-port-ids'] = list(fwg['ports'])
+        else:
+            fwg_with_rules['add-port-ids'] = list(fwg['ports'])
+            fwg_with_rules['del-port-ids'] = []
+        return fwg_with_rules
 
     def get_projects_with_firewall_groups(self, context, **kwargs):
         """Get all projects that have firewall_groups."""
@@ -185,7 +253,8 @@ class FirewallPluginV2(
             fwaas_constants.FIREWALL_PLUGIN, self.endpoints, fanout=False)
         return self.conn.consume_in_threads()
 
-    def _rpc_update_firewall_group(self, context, fwg_id):
+    def _rpc_update_firewall_group(self, context, fwg_id,
+                                   old_rule_lists=None):
         status_update = {"firewall_group": {"status":
                          nl_constants.PENDING_UPDATE}}
         super(FirewallPluginV2, self).update_firewall_group(
@@ -199,15 +268,63 @@ class FirewallPluginV2(
         fwg_with_rules['del-port-ids'] = []
         fwg_with_rules['port_details'] = self._get_fwg_port_details(
             context, fwg_with_rules['add-port-ids'])
-        self.agent_rpc.update_firewall_group(context, fwg_with_rules)
+        if old_rule_lists and not self._has_l2_ports(fwg_with_rules):
+            self.agent_rpc.update_firewall_group_rules(
+                context, self._make_firewall_group_delta(fwg_with_rules,
+                                                         old_rule_lists))
+        else:
+            self.agent_rpc.update_firewall_group(context, fwg_with_rules)
 
-    def _rpc_update_firewall_policy(self, context, firewall_policy_id):
+    def _rpc_update_firewall_policy(self, context, firewall_policy_id,
+                                    old_rule_lists=None):
         firewall_policy = self.get_firewall_policy(context, firewall_policy_id)
         if firewall_policy:
             ing_fwg_ids, eg_fwg_ids = self._get_fwgs_with_policy(context,
                 firewall_policy_id)
             for fwg_id in list(set(ing_fwg_ids + eg_fwg_ids)):
-                self._rpc_update_firewall_group(context, fwg_id)
+                self._rpc_update_firewall_group(context, fwg_id,
+                                                old_rule_lists)
+
+    def _get_policy_rule_lists(self, context, fwp_ids):
+        """Get the revisions and rules of policies about to be changed
+
+        They are the bases of the deltas sent to the agents after the
+        change, and aren't needed if agents are sent whole rule lists.
+        """
+        if not cfg.CONF.fwaas.send_rule_deltas:
+            return {}
+        return dict((fwp_id, self._get_policy_rule_list(context, fwp_id))
+                    for fwp_id in fwp_ids)
+
+    @staticmethod
+    def _has_l2_ports(fwg_with_rules):
+        compute_prefix = nl_constants.DEVICE_OWNER_COMPUTE_PREFIX
+        return any(port_details['device_owner'].startswith(compute_prefix)
+                   for port_details in fwg_with_rules['port_details'].values())
+
+    def _make_firewall_group_delta(self, fwg_with_rules, old_rule_lists):
+        """Replace the rule lists of a firewall group by their deltas
+
+        The deltas apply to the rules of the policies before their change,
+        the deltas of unchanged policies being empty, and the group update
+        to the previous revision of the group.
+
+        :param old_rule_lists: (revision number, rules) tuples of the changed
+                               policies, by policy id
+        """
+        fwg_delta = dict(fwg_with_rules)
+        fwg_delta['base_revision_number'] = (
+            fwg_with_rules['revision_number'] - 1)
+        for direction in ('ingress', 'egress'):
+            rules = fwg_delta.pop('%s_rule_list' % direction)
+            base_revision_number, old_rules = old_rule_lists.get(
+                fwg_delta['%s_firewall_policy_id' % direction],
+                (fwg_delta['%s_firewall_policy_revision_number' % direction],
+                 rules))
+            fwg_delta['%s_rule_list_delta' % direction] = (
+                rule_deltas.make_rule_list_delta(base_revision_number,
+                                                 old_rules, rules))
+        return fwg_delta
 
     def _ensure_update_firewall_group(self, context, fwg_id):
         fwg = self.get_firewall_group(context, fwg_id)
@@ -419,31 +536,82 @@ class FirewallPluginV2(
     def update_firewall_policy(self, context, id, firewall_policy):
         LOG.debug("update_firewall_policy() called")
         self._ensure_update_firewall_policy(context, id)
+        old_rule_lists = self._get_policy_rule_lists(context, [id])
         fwp = super(FirewallPluginV2,
                     self).update_firewall_policy(context, id, firewall_policy)
-        self._rpc_update_firewall_policy(context, id)
+        self._rpc_update_firewall_policy(context, id, old_rule_lists)
         return fwp
 
     def update_firewall_rule(self, context, id, firewall_rule):
         LOG.debug("update_firewall_rule() called")
         self._ensure_update_firewall_rule(context, id)
+        fwp_ids = self._get_policies_with_rule(context, id)
+        old_rule_lists = self._get_policy_rule_lists(context, fwp_ids)
         fwr = super(FirewallPluginV2,
                     self).update_firewall_rule(context, id, firewall_rule)
-        fwp_ids = self._get_policies_with_rule(context, id)
-        for fwp_id in fwp_ids:
-            self._rpc_update_firewall_policy(context, fwp_id)
+        # a group whose ingress and egress policies both hold the rule is
+        # updated once, both deltas being based on the rules before the
+        # change
+        for fwg_id in self._get_fwgs_with_policies(context, fwp_ids):
+            self._rpc_update_firewall_group(context, fwg_id, old_rule_lists)
         return fwr
 
+    def _get_policies_with_rules(self, context, fwr_ids):
+        fwp_ids = set()
+        for fwr_id in fwr_ids:
+            fwp_ids.update(self._get_policies_with_rule(context, fwr_id))
+        return sorted(fwp_ids)
+
+    def _get_fwgs_with_policies(self, context, fwp_ids):
+        fwg_ids = set()
+        for fwp_id in fwp_ids:
+            ing_fwg_ids, eg_fwg_ids = self._get_fwgs_with_policy(
+                context, fwp_id)
+            fwg_ids.update(ing_fwg_ids + eg_fwg_ids)
+        return sorted(fwg_ids)
+
+    def update_address_group(self, context, id, address_group):
+        LOG.debug("update_address_group() called")
+        fwp_ids = self._get_policies_with_rules(
+            context, self._get_rules_with_address_group(context, id))
+        fwg_ids = self._get_fwgs_with_policies(context, fwp_ids)
+        for fwg_id in fwg_ids:
+            self._ensure_update_firewall_group(context, fwg_id)
+        old_rule_lists = self._get_policy_rule_lists(context, fwp_ids)
+        fwag = super(FirewallPluginV2,
+                     self).update_address_group(context, id, address_group)
+        # agents render address groups as ipsets, only their members are
+        # updated
+        for fwg_id in fwg_ids:
+            self._rpc_update_firewall_group(context, fwg_id, old_rule_lists)
+        return fwag
+
+    def update_service_group(self, context, id, service_group):
+        LOG.debug("update_service_group() called")
+        fwp_ids = self._get_policies_with_rules(
+            context, self._get_rules_with_service_group(context, id))
+        fwg_ids = self._get_fwgs_with_policies(context, fwp_ids)
+        for fwg_id in fwg_ids:
+            self._ensure_update_firewall_group(context, fwg_id)
+        old_rule_lists = self._get_policy_rule_lists(context, fwp_ids)
+        fwsg = super(FirewallPluginV2,
+                     self).update_service_group(context, id, service_group)
+        for fwg_id in fwg_ids:
+            self._rpc_update_firewall_group(context, fwg_id, old_rule_lists)
+        return fwsg
+
     def insert_rule(self, context, id, rule_info):
         LOG.debug("insert_rule() called")
         self._ensure_update_firewall_policy(context, id)
+        old_rule_lists = self._get_policy_rule_lists(context, [id])
         fwp = super(FirewallPluginV2, self).insert_rule(context, id, rule_info)
-        self._rpc_update_firewall_policy(context, id)
+        self._rpc_update_firewall_policy(context, id, old_rule_lists)
         return fwp
 
     def remove_rule(self, context, id, rule_info):
         LOG.debug("remove_rule() called")
         self._ensure_update_firewall_policy(context, id)
+        old_rule_lists = self._get_policy_rule_lists(context, [id])
         fwp = super(FirewallPluginV2, self).remove_rule(context, id, rule_info)
-        self._rpc_update_firewall_policy(context, id)
+        self._rpc_update_firewall_policy(context, id, old_rule_lists)
         return fwp
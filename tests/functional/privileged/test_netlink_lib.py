@@ -13,9 +13,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+
 from neutron.agent.linux import utils as linux_utils
 from neutron.tests.common import net_helpers
 from neutron.tests.functional import base as functional_base
+from oslo_utils import timeutils
+import testtools
 
 import neutron_fwaas.privileged.netlink_lib as nl_lib
 
@@ -113,3 +117,59 @@ class NetlinkLibTestCase(functional_base.BaseSudoTestCase):
         nl_lib.flush_entries(namespace)
         entries_list = nl_lib.list_entries(namespace)
         self.assertEqual((), entries_list)
+
+    def test_delete_entries_by_filters(self):
+        namespace = self.useFixture(net_helpers.NamespaceFixture()).name
+        self._create_entries(namespace, CONNTRACK_CMDS)
+        rule_filters = [(4, 'tcp', [], ['2', '2'], '1.1.1.0/24', []),
+                        (4, 'icmp', [], [], [], '2.2.2.2/32')]
+        deleted = nl_lib.delete_entries_by_filters(rule_filters,
+                                                   namespace=namespace)
+        self.assertEqual(2, deleted)
+        entries_list = nl_lib.list_entries(namespace)
+        self.assertEqual(((4, 'udp', 1, 2, '1.1.1.1', '2.2.2.2'),),
+                         entries_list)
+
+
+BENCHMARK_SIZES = os.environ.get('FWAAS_CONNTRACK_BENCHMARK_SIZES')
+
+
+@testtools.skipUnless(BENCHMARK_SIZES,
+                      'FWAAS_CONNTRACK_BENCHMARK_SIZES is not set, e.g. '
+                      '"10000,100000,1000000"; sizes above '
+                      'net.netfilter.nf_conntrack_max need it raised')
+class NetlinkLibListBenchmark(functional_base.BaseSudoTestCase):
+    """Compare listing entries from their text and binary representations
+
+    Entries are created one conntrack command at a time, which takes much
+    longer than listing them; only the listing is timed.
+    """
+
+    def _create_entries(self, namespace, size):
+        for i in range(size):
+            linux_utils.execute(
+                ['ip', 'netns', 'exec', namespace,
+                 'conntrack', '-I', '-p', 'udp',
+                 '-s', '10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                 '-d', '2.2.2.2', '--sport', '1', '--dport', '2',
+                 '--timeout', '1234'],
+                run_as_root=True, check_exit_code=True, extra_ok_codes=[1])
+
+    def _time_list_entries(self, namespace, text):
+        watch = timeutils.StopWatch()
+        watch.start()
+        entries = nl_lib.list_entries(namespace, text=text)
+        watch.stop()
+        return entries, watch.elapsed()
+
+    def test_list_entries_benchmark(self):
+        for size in [int(size) for size in BENCHMARK_SIZES.split(',')]:
+            namespace = self.useFixture(net_helpers.NamespaceFixture()).name
+            self._create_entries(namespace, size)
+            text_entries, text_time = self._time_list_entries(namespace,
+                                                              True)
+            entries, binary_time = self._time_list_entries(namespace, False)
+            self.assertEqual(text_entries, entries)
+            print('%(size)d entries listed in %(text).3fs from text, '
+                  '%(binary).3fs from attributes' %
+                  {'size': size, 'text': text_time, 'binary': binary_time})
@@ -0,0 +1,97 @@
+# Copyright (c) 2018
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+
+import mock
+from neutron.agent.linux import iptables_manager
+from neutron.tests.common import net_helpers
+from neutron.tests.functional import base as functional_base
+from oslo_utils import timeutils
+import testtools
+
+from neutron_fwaas.services.firewall.drivers.linux import iptables_fwaas_v2
+from neutron_fwaas.services.firewall.drivers.linux import nftables_fwaas_v2
+
+
+BENCHMARK_SIZES = os.environ.get('FWAAS_FIREWALL_BENCHMARK_SIZES')
+FAKE_PORT_IDS = ['fake-port-uuid']
+
+
+@testtools.skipUnless(BENCHMARK_SIZES,
+                      'FWAAS_FIREWALL_BENCHMARK_SIZES is not set, e.g. '
+                      '"100,1000,10000"')
+class FirewallDriverBenchmark(functional_base.BaseSudoTestCase):
+    """Compare programming firewall groups with iptables and nftables
+
+    Each driver creates a firewall group of the given number of rules in
+    its own namespace, then updates one of its rules; connections are not
+    cleaned up so that only the programming of the rules is timed.
+    """
+
+    def _get_rules(self, size):
+        return [{'id': 'fake-rule-%d' % i,
+                 'enabled': True,
+                 'action': 'allow',
+                 'ip_version': 4,
+                 'protocol': 'tcp',
+                 'source_ip_address': '10.%d.%d.0/24' % (
+                     i >> 8 & 255, i & 255),
+                 'destination_port': str(i % 65535 + 1)}
+                for i in range(size)]
+
+    def _get_firewall(self, rules):
+        return {'id': 'fake-fw-uuid',
+                'tenant_id': 'fake-tenant-uuid',
+                'admin_state_up': True,
+                'ingress_rule_list': rules,
+                'egress_rule_list': rules}
+
+    def _get_apply_list(self):
+        namespace = self.useFixture(net_helpers.NamespaceFixture()).name
+        router_info = mock.Mock()
+        router_info.router = {}
+        router_info.iptables_manager = iptables_manager.IptablesManager(
+            namespace=namespace, use_ipv6=True)
+        return [(router_info, FAKE_PORT_IDS)]
+
+    def _time(self, func, *args):
+        watch = timeutils.StopWatch()
+        watch.start()
+        func(*args)
+        watch.stop()
+        return watch.elapsed()
+
+    def _benchmark(self, driver, size):
+        driver.conntrack = mock.Mock()
+        apply_list = self._get_apply_list()
+        rules = self._get_rules(size)
+        create_time = self._time(driver.create_firewall_group, 'legacy',
+                                 apply_list, self._get_firewall(rules))
+        rules[size // 2] = dict(rules[size // 2], action='deny')
+        update_time = self._time(driver.update_firewall_group, 'legacy',
+                                 apply_list, self._get_firewall(rules))
+        return create_time, update_time
+
+    def test_firewall_driver_benchmark(self):
+        for size in [int(size) for size in BENCHMARK_SIZES.split(',')]:
+            for name, driver_cls in [
+                    ('iptables', iptables_fwaas_v2.IptablesFwaasDriver),
+                    ('nftables', nftables_fwaas_v2.NftablesFwaasDriver)]:
+                create_time, update_time = self._benchmark(driver_cls(), size)
+                print('%(name)s: %(size)d rules created in %(create).3fs, '
+                      'updated in %(update).3fs' %
+                      {'name': name, 'size': size, 'create': create_time,
+                       'update': update_time})
@@ -0,0 +1,60 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from neutron_fwaas.common import rule_deltas
+from neutron_fwaas.tests import base
+
+
+def _rules(*rule_ids):
+    return [{'id': rule_id, 'action': 'allow'} for rule_id in rule_ids]
+
+
+class RuleDeltasTestCase(base.BaseTestCase):
+
+    def _assert_delta(self, old_rules, new_rules, expected_delta):
+        delta = rule_deltas.make_rule_list_delta(1, old_rules, new_rules)
+        expected_delta['base_revision_number'] = 1
+        self.assertEqual(expected_delta, delta)
+        self.assertEqual(new_rules,
+                         rule_deltas.apply_rule_list_delta(old_rules, delta))
+
+    def test_no_change(self):
+        self._assert_delta(_rules('r1', 'r2'), _rules('r1', 'r2'),
+                           {'removed': [], 'changed': [], 'added': []})
+
+    def test_rules_added_and_removed(self):
+        new_rules = _rules('r0', 'r1', 'r4', 'r5', 'r3')
+        self._assert_delta(_rules('r1', 'r2', 'r3'), new_rules,
+                           {'removed': ['r2'], 'changed': [],
+                            'added': [[None, new_rules[0]],
+                                      ['r1', new_rules[2]],
+                                      ['r4', new_rules[3]]]})
+
+    def test_rule_changed(self):
+        new_rules = _rules('r1', 'r2')
+        new_rules[1]['action'] = 'deny'
+        self._assert_delta(_rules('r1', 'r2'), new_rules,
+                           {'removed': [], 'changed': [new_rules[1]],
+                            'added': []})
+
+    def test_rules_moved(self):
+        new_rules = _rules('r3', 'r1', 'r4')
+        self._assert_delta(_rules('r1', 'r2', 'r3'), new_rules,
+                           {'removed': ['r2'], 'changed': [],
+                            'added': [['r1', new_rules[2]]],
+                            'order': ['r3', 'r1', 'r4']})
+
+    def test_apply_keeps_rules(self):
+        old_rules = _rules('r1', 'r2')
+        delta = rule_deltas.make_rule_list_delta(1, old_rules, _rules('r2'))
+        rule_deltas.apply_rule_list_delta(old_rules, delta)
+        self.assertEqual(_rules('r1', 'r2'), old_rules)
@@ -409,6 +409,86 @@ class TestFirewallDBPluginV2(FirewallPluginV2DbTestCase):
                 observed_ids = [r['id'] for r in observeds]
                 self.assertEqual(expected_ids, observed_ids)
 
+    def test_get_policy_ordered_rules_with_address_groups(self):
+        ctx = self._get_admin_context()
+        address_group = self.plugin.create_address_group(
+            ctx, {'address_group': {
+                'tenant_id': self._tenant_id,
+                'name': 'ag1',
+                'description': DESCRIPTION,
+                'ip_addresses': [{'ip_address': '10.0.0.0/24',
+                                  'ip_version': 4}]}})
+        ag_id = address_group['id']
+        with self.firewall_rule(name='fwr1') as fwr1, \
+                self.firewall_rule(name='fwr2') as fwr2:
+            fwr_ids = [fwr['firewall_rule']['id'] for fwr in (fwr1, fwr2)]
+            self.plugin._set_address_groups_for_rule(
+                ctx, fwr_ids[0], {'firewall_rule': {
+                    'source_address_group_ids': [ag_id],
+                    'destination_address_group_ids': []}})
+            self.plugin._set_address_groups_for_rule(
+                ctx, fwr_ids[1], {'firewall_rule': {
+                    'source_address_group_ids': [],
+                    'destination_address_group_ids': [ag_id]}})
+            with self.firewall_policy(firewall_rules=fwr_ids) as fwp:
+                fwp_id = fwp['firewall_policy']['id']
+                observeds = self.plugin._get_policy_ordered_rules(ctx, fwp_id)
+                expected = {'id': ag_id,
+                            'name': 'ag1',
+                            'ip_addresses': [{'ip_address': '10.0.0.0/24',
+                                              'ip_version': 4}]}
+                self.assertEqual([expected],
+                                 observeds[0]['source_address_groups'])
+                self.assertEqual([],
+                                 observeds[0]['destination_address_groups'])
+                self.assertEqual([expected],
+                                 observeds[1]['destination_address_groups'])
+                # the rules share the dict of the address group
+                self.assertIs(observeds[0]['source_address_groups'][0],
+                              observeds[1]['destination_address_groups'][0])
+
+    def test_get_policy_rule_list_cached(self):
+        with self.firewall_rule(name='fwr1') as fwr1:
+            fwr_id = fwr1['firewall_rule']['id']
+            with self.firewall_policy(firewall_rules=[fwr_id]) as fwp:
+                ctx = self._get_admin_context()
+                fwp_id = fwp['firewall_policy']['id']
+                cache = self.plugin.policy_rules_cache
+                hits = cache.hits
+                revision, rules = self.plugin._get_policy_rule_list(
+                    ctx, fwp_id)
+                self.assertEqual(
+                    (revision, rules),
+                    self.plugin._get_policy_rule_list(ctx, fwp_id))
+                self.assertEqual(hits + 1, cache.hits)
+                # updating a rule of the policy invalidates its rules
+                data = {'firewall_rule': {'name': 'updated'}}
+                req = self.new_update_request('firewall_rules', data, fwr_id)
+                req.get_response(self.ext_api)
+                revision, rules = self.plugin._get_policy_rule_list(
+                    ctx, fwp_id)
+                self.assertEqual(['updated'], [r['name'] for r in rules])
+                # as does removing a rule from the policy
+                self.plugin.remove_rule(ctx, fwp_id,
+                                        {'firewall_rule_id': fwr_id})
+                self.assertEqual(
+                    (revision + 1, []),
+                    self.plugin._get_policy_rule_list(ctx, fwp_id))
+                self.assertEqual(hits + 1, cache.hits)
+
+    def test_get_policy_rule_list_in_transaction_not_cached(self):
+        with self.firewall_policy() as fwp:
+            ctx = self._get_admin_context()
+            fwp_id = fwp['firewall_policy']['id']
+            cache = self.plugin.policy_rules_cache
+            with ctx.session.begin():
+                self.plugin._get_policy_rule_list(ctx, fwp_id)
+            misses = cache.misses
+            self.plugin._get_policy_rule_list(ctx, fwp_id)
+            self.assertEqual(misses + 1, cache.misses)
+            self.plugin._get_policy_rule_list(ctx, fwp_id)
+            self.assertEqual(misses + 1, cache.misses)
+
     def test_create_firewall_policy(self):
         name = "firewall_policy1"
         attrs = self._get_test_firewall_policy_attrs(name)
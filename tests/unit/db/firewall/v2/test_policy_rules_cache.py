@@ -0,0 +1,61 @@
+# Copyright (c) 2018
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from neutron_fwaas.db.firewall.v2 import policy_rules_cache
+from neutron_fwaas.tests import base
+
+
+class PolicyRulesCacheTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(PolicyRulesCacheTestCase, self).setUp()
+        self.cache = policy_rules_cache.PolicyRulesCache(2)
+
+    def test_get_revision(self):
+        rules = [{'id': 'fwr1'}]
+        self.cache.set('fwp1', 1, rules)
+        self.assertEqual(rules, self.cache.get('fwp1', 1))
+        self.assertIsNone(self.cache.get('fwp1', 2))
+        self.assertIsNone(self.cache.get('fwp2', 1))
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 2,
+                          'hit_rate': 1.0 / 3}, self.cache.stats)
+
+    def test_rules_copied(self):
+        rules = [{'id': 'fwr1'}]
+        self.cache.set('fwp1', 1, rules)
+        rules[0]['id'] = 'changed'
+        self.cache.get('fwp1', 1)[0]['id'] = 'changed'
+        self.assertEqual([{'id': 'fwr1'}], self.cache.get('fwp1', 1))
+
+    def test_least_recently_used_evicted(self):
+        self.cache.set('fwp1', 1, [])
+        self.cache.set('fwp2', 1, [])
+        self.cache.get('fwp1', 1)
+        self.cache.set('fwp3', 1, [])
+        self.assertIsNone(self.cache.get('fwp2', 1))
+        self.assertEqual([], self.cache.get('fwp1', 1))
+        self.assertEqual([], self.cache.get('fwp3', 1))
+
+    def test_new_revision_replaces_entry(self):
+        self.cache.set('fwp1', 1, [{'id': 'fwr1'}])
+        self.cache.set('fwp1', 2, [])
+        self.assertEqual(1, self.cache.stats['size'])
+        self.assertEqual([], self.cache.get('fwp1', 2))
+
+    def test_disabled(self):
+        cache = policy_rules_cache.PolicyRulesCache(0)
+        cache.set('fwp1', 1, [])
+        self.assertIsNone(cache.get('fwp1', 1))
+        self.assertEqual(0, cache.stats['size'])
@@ -13,11 +13,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import ctypes
+import socket
+import struct
+
 import mock
 import testtools
 
 from neutron_lib import constants
 
+from neutron_fwaas import privileged
 from neutron_fwaas.privileged import netlink_constants as nl_constants
 from neutron_fwaas.privileged import netlink_lib as nl_lib
 from neutron_fwaas.tests import base
@@ -52,6 +57,24 @@ class NetlinkLibTestCase(base.BaseTestCase):
             nl_lib.nfct.nfct_open.assert_called_once()
         nl_lib.nfct.nfct_close.assert_called_once()
 
+    def test_pointer_prototypes(self):
+        nl_lib.ConntrackManager()
+        for function in ('nfct_open', 'nfct_new', 'nfct_get_attr',
+                         'nfct_filter_dump_create'):
+            self.assertEqual(ctypes.c_void_p,
+                             getattr(nl_lib.nfct, function).restype)
+        for function in ('nfct_close', 'nfct_destroy', 'nfct_query',
+                         'nfct_callback_unregister', 'nfct_get_attr_u16',
+                         'nfct_set_attr_u32', 'nfct_filter_dump_set_attr',
+                         'nfct_filter_dump_set_attr_u8',
+                         'nfct_filter_dump_destroy'):
+            self.assertEqual(ctypes.c_void_p,
+                             getattr(nl_lib.nfct, function).argtypes[0])
+        self.assertEqual(ctypes.c_void_p,
+                         nl_lib.nfct.nfct_query.argtypes[2])
+        self.assertEqual(ctypes.c_void_p,
+                         nl_lib.nfct.nfct_filter_dump_set_attr.argtypes[2])
+
     def test_conntrack_list_entries(self):
         with nl_lib.ConntrackManager() as conntrack:
             nl_lib.nfct.nfct_open.assert_called_once()
@@ -274,3 +297,247 @@ class NetlinkLibTestCase(base.BaseTestCase):
                                                            any_order=True)
             nl_lib.nfct.nfct_destroy.assert_called_once()
         nl_lib.nfct.nfct_close.assert_called_once()
+
+    def test_get_tcp_entry(self):
+        nl_lib.nfct.nfct_get_attr_u8.return_value = (
+            constants.IP_PROTOCOL_MAP['tcp'])
+        nl_lib.nfct.nfct_get_attr_u16.side_effect = [socket.htons(1),
+                                                     socket.htons(2)]
+        nl_lib.nfct.nfct_get_attr_u32.side_effect = [
+            struct.unpack('=I', socket.inet_aton(address))[0]
+            for address in ('1.1.1.1', '2.2.2.2')]
+        self.assertEqual((4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2'),
+                         nl_lib._get_entry(mock.sentinel.conntrack, 4))
+
+    def test_get_tcp_dnat_reply_entry(self):
+        nl_lib.nfct.nfct_get_attr_u8.return_value = (
+            constants.IP_PROTOCOL_MAP['tcp'])
+        nl_lib.nfct.nfct_get_attr_u16.side_effect = [socket.htons(22),
+                                                     socket.htons(1000)]
+        nl_lib.nfct.nfct_get_attr_u32.side_effect = [
+            struct.unpack('=I', socket.inet_aton(address))[0]
+            for address in ('10.0.0.5', '8.8.8.8')]
+        self.assertEqual((4, 'tcp', 22, 1000, '10.0.0.5', '8.8.8.8'),
+                         nl_lib._get_reply_entry(mock.sentinel.conntrack, 4))
+        nl_lib.nfct.nfct_get_attr_u16.assert_has_calls([
+            mock.call(mock.sentinel.conntrack,
+                      nl_constants.ATTR_REPL_PORT_SRC),
+            mock.call(mock.sentinel.conntrack,
+                      nl_constants.ATTR_REPL_PORT_DST)])
+        nl_lib.nfct.nfct_get_attr_u32.assert_has_calls([
+            mock.call(mock.sentinel.conntrack,
+                      nl_constants.ATTR_REPL_IPV4_SRC),
+            mock.call(mock.sentinel.conntrack,
+                      nl_constants.ATTR_REPL_IPV4_DST)])
+
+    def test_get_icmp_entry(self):
+        nl_lib.nfct.nfct_get_attr_u8.side_effect = [
+            constants.IP_PROTOCOL_MAP['icmp'], 8, 0]
+        nl_lib.nfct.nfct_get_attr_u16.return_value = socket.htons(1234)
+        nl_lib.nfct.nfct_get_attr_u32.side_effect = [
+            struct.unpack('=I', socket.inet_aton(address))[0]
+            for address in ('1.1.1.1', '2.2.2.2')]
+        self.assertEqual((4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234),
+                         nl_lib._get_entry(mock.sentinel.conntrack, 4))
+
+    def test_conntrack_delete_matching_entries(self):
+        entries = [(4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2'),
+                   (4, 'tcp', 1, 3, '1.1.1.1', '2.2.2.2'),
+                   (4, 'udp', 1, 2, '1.1.1.1', '2.2.2.2')]
+
+        def query(handler, query_type, data):
+            if query_type == nl_constants.NFCT_Q_DUMP_FILTER:
+                callback = nl_lib.nfct.nfct_callback_register.call_args[0][2]
+                for _entry in entries:
+                    callback(nl_constants.NFCT_T_UPDATE, None, None)
+            return 0
+
+        nl_lib.nfct.nfct_query.side_effect = query
+        matcher = mock.Mock()
+        matcher.match.side_effect = lambda entry, reply_entry: entry[3] == 2
+        family_socket = nl_constants.IPVERSION_SOCKET[4]
+        with mock.patch.object(nl_lib, '_get_entry',
+                               side_effect=entries), \
+                mock.patch.object(nl_lib, '_get_reply_entry',
+                                  return_value=mock.sentinel.reply_entry), \
+                nl_lib.ConntrackManager(family_socket) as conntrack, \
+                nl_lib.ConntrackManager(family_socket) as deleter:
+            deleted = conntrack.delete_matching_entries(matcher, deleter)
+        self.assertEqual(2, deleted)
+        matcher.match.assert_has_calls(
+            [mock.call(entry, mock.sentinel.reply_entry)
+             for entry in entries])
+        nl_lib.nfct.nfct_filter_dump_set_attr_u8.assert_called_once_with(
+            nl_lib.nfct.nfct_filter_dump_create.return_value,
+            nl_constants.NFCT_FILTER_DUMP_L3NUM, family_socket)
+        destroy_calls = [
+            call for call in nl_lib.nfct.nfct_query.call_args_list
+            if call[0][1] == nl_constants.NFCT_Q_DESTROY]
+        self.assertEqual(2, len(destroy_calls))
+        nl_lib.nfct.nfct_filter_dump_destroy.assert_called_once_with(
+            nl_lib.nfct.nfct_filter_dump_create.return_value)
+        nl_lib.nfct.nfct_callback_unregister.assert_called_once_with(
+            conntrack.conntrack_handler)
+
+    def test_conntrack_delete_matching_entries_with_mark(self):
+        nl_lib.nfct.nfct_query.return_value = 0
+        family_socket = nl_constants.IPVERSION_SOCKET[4]
+        with nl_lib.ConntrackManager(family_socket) as conntrack, \
+                nl_lib.ConntrackManager(family_socket) as deleter:
+            conntrack.delete_matching_entries(mock.Mock(), deleter,
+                                              (0x100, 0xff00))
+        dump_filter, attr, dump_mark = (
+            nl_lib.nfct.nfct_filter_dump_set_attr.call_args[0])
+        self.assertEqual(nl_lib.nfct.nfct_filter_dump_create.return_value,
+                         dump_filter)
+        self.assertEqual(nl_constants.NFCT_FILTER_DUMP_MARK, attr)
+        self.assertEqual((0x100, 0xff00),
+                         (dump_mark._obj.val, dump_mark._obj.mask))
+
+    def test_conntrack_list_parsed_entries(self):
+        entries = [(4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2'),
+                   (4, 'gre', None, None, '1.1.1.1', '2.2.2.2'),
+                   (4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234)]
+
+        def query(handler, query_type, data):
+            callback = nl_lib.nfct.nfct_callback_register.call_args[0][2]
+            for _entry in entries:
+                callback(nl_constants.NFCT_T_UPDATE, None, None)
+            return 0
+
+        nl_lib.nfct.nfct_query.side_effect = query
+        with mock.patch.object(nl_lib, '_get_entry', side_effect=entries), \
+                nl_lib.ConntrackManager(
+                    nl_constants.IPVERSION_SOCKET[4]) as conntrack:
+            self.assertEqual([entries[0], entries[2]],
+                             conntrack.list_parsed_entries())
+        nl_lib.nfct.nfct_snprintf.assert_not_called()
+        nl_lib.nfct.nfct_query.assert_called_once_with(
+            conntrack.conntrack_handler, nl_constants.NFCT_Q_DUMP_FILTER,
+            nl_lib.nfct.nfct_filter_dump_create.return_value)
+
+
+class ConntrackHandlerPoolTestCase(base.BaseTestCase):
+    def setUp(self):
+        super(ConntrackHandlerPoolTestCase, self).setUp()
+        nl_lib.nfct = mock.Mock()
+        nl_lib.libc = mock.Mock()
+        self.in_namespace = mock.patch.object(
+            nl_lib.fwaas_utils, 'in_namespace').start()
+        self.netns_inode = mock.patch.object(
+            nl_lib.fwaas_utils, 'netns_inode', return_value=1).start()
+        self.pool = nl_lib.ConntrackHandlerPool(idle_timeout=60)
+
+    def test_handler_reused(self):
+        with self.pool.get('ns', 2) as conntrack:
+            pass
+        with self.pool.get('ns', 2) as reused_conntrack:
+            self.assertIs(conntrack, reused_conntrack)
+        nl_lib.nfct.nfct_open.assert_called_once()
+        self.in_namespace.assert_called_once_with('ns')
+        nl_lib.nfct.nfct_close.assert_not_called()
+
+    def test_handler_checked_out_once(self):
+        with self.pool.get('ns', 2) as conntrack:
+            with self.pool.get('ns', 2) as other_conntrack:
+                self.assertIsNot(conntrack, other_conntrack)
+        self.assertEqual(2, nl_lib.nfct.nfct_open.call_count)
+
+    def test_handler_per_namespace_and_family(self):
+        for namespace, family_socket in [('ns', 2), ('ns', 10), ('ns2', 2)]:
+            with self.pool.get(namespace, family_socket):
+                pass
+        self.assertEqual(3, nl_lib.nfct.nfct_open.call_count)
+
+    def test_handler_of_recreated_namespace_discarded(self):
+        with self.pool.get('ns', 2):
+            pass
+        self.netns_inode.return_value = 2
+        with self.pool.get('ns', 2):
+            pass
+        self.assertEqual(2, nl_lib.nfct.nfct_open.call_count)
+        nl_lib.nfct.nfct_close.assert_called_once()
+
+    def test_idle_handler_closed(self):
+        with mock.patch.object(nl_lib.time, 'time', return_value=100):
+            with self.pool.get('ns', 2):
+                pass
+        with mock.patch.object(nl_lib.time, 'time', return_value=161):
+            with self.pool.get('ns2', 2):
+                pass
+        nl_lib.nfct.nfct_close.assert_called_once()
+
+    def test_untouched_namespace_handler_closed(self):
+        with mock.patch.object(nl_lib.time, 'time', return_value=100):
+            with self.pool.get('ns', 2):
+                pass
+            with self.pool.get('ns2', 2) as conntrack:
+                # ns is not used again, its handler expires meanwhile
+                nl_lib.time.time.return_value = 161
+            nl_lib.nfct.nfct_close.assert_called_once()
+            with self.pool.get('ns2', 2) as reused_conntrack:
+                self.assertIs(conntrack, reused_conntrack)
+
+    def test_release(self):
+        for namespace, family_socket in [('ns', 2), ('ns', 10), ('ns2', 2)]:
+            with self.pool.get(namespace, family_socket):
+                pass
+        self.pool.release('ns')
+        self.assertEqual(2, nl_lib.nfct.nfct_close.call_count)
+        with self.pool.get('ns2', 2):
+            pass
+        self.assertEqual(3, nl_lib.nfct.nfct_open.call_count)
+
+    def test_handler_closed_on_error(self):
+        with testtools.ExpectedException(RuntimeError):
+            with self.pool.get('ns', 2):
+                raise RuntimeError()
+        nl_lib.nfct.nfct_close.assert_called_once()
+        with self.pool.get('ns', 2):
+            pass
+        self.assertEqual(2, nl_lib.nfct.nfct_open.call_count)
+
+    def test_clear(self):
+        with self.pool.get('ns', 2):
+            pass
+        self.pool.clear()
+        nl_lib.nfct.nfct_close.assert_called_once()
+
+
+class NetlinkLibEntrypointsTestCase(base.BaseTestCase):
+    def setUp(self):
+        super(NetlinkLibEntrypointsTestCase, self).setUp()
+        self.flush = mock.patch.object(nl_lib, '_flush_entries').start()
+        self.delete = mock.patch.object(nl_lib, '_delete_entries_by_filters',
+                                        return_value=3).start()
+        # call the entrypoints in process
+        privileged.default.set_client_mode(False)
+        self.addCleanup(privileged.default.set_client_mode, True)
+
+    def test_delete_entries_batch(self):
+        rule_filters = [(4, 'tcp', [], ['22', '22'], [], [])]
+        results = nl_lib.delete_entries_batch(
+            [('ns1', None), ('ns2', rule_filters)])
+        self.assertEqual([None, 3], results)
+        self.flush.assert_called_once_with('ns1')
+        self.delete.assert_called_once_with(rule_filters, 'ns2')
+
+    def test_delete_entries_batch_with_marks(self):
+        rule_filters = [(4, 'tcp', [], ['22', '22'], [], [])]
+        marks = [[0x1, 0xff], [0x100, 0xff00]]
+        results = nl_lib.delete_entries_batch([('ns1', rule_filters, marks)])
+        self.assertEqual([3], results)
+        self.delete.assert_called_once_with(rule_filters, 'ns1', marks)
+
+    def test_release_namespace(self):
+        with mock.patch.object(nl_lib._handler_pool, 'release') as release:
+            nl_lib.release_namespace('ns1')
+        release.assert_called_once_with('ns1')
+
+    def test_delete_entries_batch_parallel(self):
+        jobs = [('ns%d' % i, [(4, 'tcp', [], [], [], [])]) for i in range(4)]
+        results = nl_lib.delete_entries_batch(jobs, workers=2)
+        self.assertEqual([3] * 4, results)
+        self.delete.assert_has_calls(
+            [mock.call(rule_filters, namespace)
+             for namespace, rule_filters in jobs], any_order=True)
@@ -95,3 +95,21 @@ class InNamespaceTest(base.BaseTestCase):
         with testtools.ExpectedException(utils.BackInNamespaceExit):
             with utils.in_namespace(self.NEW_NETNS):
                 pass
+
+
+class NetnsInodeTest(base.BaseTestCase):
+
+    @mock.patch('os.stat')
+    def test_netns_inode(self, stat):
+        stat.return_value.st_ino = 1234
+        self.assertEqual(1234, utils.netns_inode('newns'))
+        stat.assert_called_once_with('/var/run/netns/newns')
+
+    @mock.patch('os.stat')
+    def test_netns_inode_current_namespace(self, stat):
+        utils.netns_inode(None)
+        stat.assert_called_once_with(utils.PROCESS_NETNS)
+
+    @mock.patch('os.stat', side_effect=OSError)
+    def test_netns_inode_missing_namespace(self, stat):
+        self.assertIsNone(utils.netns_inode('newns'))
@@ -20,9 +20,12 @@ from neutron.agent.linux import ip_lib
 from neutron.conf.agent.l3 import config as l3_config
 from neutron_lib import context
 from oslo_config import cfg
+import oslo_messaging
+from oslo_serialization import jsonutils
 from oslo_utils import uuidutils
 
 from neutron_fwaas.common import fwaas_constants
+from neutron_fwaas.common import rule_deltas
 from neutron_fwaas.services.firewall.agents import firewall_agent_api
 from neutron_fwaas.services.firewall.agents.l3reference \
     import firewall_l3_agent_v2
@@ -311,6 +314,184 @@ class TestFWaaSL3AgentExtension(base.BaseTestCase):
             mock_firewall_group_deleted.assert_called_once_with(self.context,
                     firewall_group['id'])
 
+    def _prepare_services_sync(self):
+        self.api.host = 'myhost'
+        self.api.fwaas_enabled = True
+        self.api.services_sync_needed = True
+        self.api.fwplugin_rpc = mock.Mock()
+        self.api.update_firewall_group = mock.Mock()
+        self.api.delete_firewall_group = mock.Mock()
+
+    def test_process_services_sync_for_host(self):
+        self._prepare_services_sync()
+        cfg.CONF.set_override('sync_page_size', 2, 'fwaas')
+        fwgs = [{'id': 'fwg%d' % i, 'tenant_id': 'project',
+                 'status': status}
+                for i, status in enumerate(['PENDING_UPDATE', 'ACTIVE',
+                                            'PENDING_DELETE'])]
+        rpc = self.api.fwplugin_rpc
+        rpc.get_firewall_groups_for_host.side_effect = [fwgs[:2], fwgs[2:]]
+
+        with mock.patch.object(
+                self.api.fwaas_driver, 'batch_apply',
+                wraps=self.api.fwaas_driver.batch_apply) as batch_apply:
+            self.api.process_services_sync(self.context)
+
+        self.assertEqual(
+            [mock.call(self.context, limit=2),
+             mock.call(mock.ANY, marker='fwg1', limit=2)],
+            rpc.get_firewall_groups_for_host.call_args_list)
+        # each page is committed on its own
+        self.assertEqual(2, batch_apply.call_count)
+        rpc.get_projects_with_firewall_groups.assert_not_called()
+        self.api.update_firewall_group.assert_called_once_with(
+            mock.ANY, fwgs[0], self.api.host)
+        self.api.delete_firewall_group.assert_called_once_with(
+            mock.ANY, fwgs[2], self.api.host)
+        self.assertFalse(self.api.services_sync_needed)
+
+    def test_process_services_sync_page_failure(self):
+        self._prepare_services_sync()
+        cfg.CONF.set_override('sync_page_size', 1, 'fwaas')
+        fwg = {'id': 'fwg', 'tenant_id': 'project',
+               'status': 'PENDING_UPDATE'}
+        rpc = self.api.fwplugin_rpc
+        rpc.get_firewall_groups_for_host.return_value = [fwg]
+        self.api.update_firewall_group.side_effect = RuntimeError
+        with mock.patch.object(firewall_l3_agent_v2.eventlet,
+                               'spawn') as spawn:
+            self.api.process_services_sync(self.context)
+
+        # the fetch of the next page is abandoned
+        spawn.return_value.kill.assert_called_once_with()
+        spawn.return_value.wait.assert_not_called()
+        self.assertTrue(self.api.services_sync_needed)
+
+    def test_process_services_sync_for_projects(self):
+        self._prepare_services_sync()
+        fwg = {'id': 'fwg', 'tenant_id': 'project',
+               'status': 'PENDING_UPDATE'}
+        rpc = self.api.fwplugin_rpc
+        rpc.get_firewall_groups_for_host.side_effect = (
+            oslo_messaging.RemoteError('UnsupportedVersion'))
+        rpc.get_projects_with_firewall_groups.return_value = ['project']
+        rpc.get_firewall_groups_for_project.return_value = [fwg]
+
+        self.api.process_services_sync(self.context)
+
+        self.api.update_firewall_group.assert_called_once_with(
+            mock.ANY, fwg, self.api.host)
+        self.assertFalse(self.api.services_sync_needed)
+
+    def _fake_firewall_group_delta(self, base_revision_number=3):
+        old_rules = [{'id': 'fwr1'}, {'id': 'fwr2'}]
+        self.api._remember_rule_lists({
+            'id': 'fwg', 'revision_number': 3,
+            'ingress_firewall_policy_id': 'fwp',
+            'ingress_firewall_policy_revision_number': 5,
+            'ingress_rule_list': old_rules,
+            'egress_firewall_policy_id': None,
+            'egress_firewall_policy_revision_number': None,
+            'egress_rule_list': []})
+        new_rules = [{'id': 'fwr2'}, {'id': 'fwr3'}]
+        return {'id': 'fwg', 'admin_state_up': True, 'status': 'ACTIVE',
+                'revision_number': base_revision_number + 1,
+                'base_revision_number': base_revision_number,
+                'ingress_firewall_policy_id': 'fwp',
+                'ingress_firewall_policy_revision_number': 6,
+                'ingress_rule_list_delta': rule_deltas.make_rule_list_delta(
+                    5, old_rules, new_rules),
+                'egress_firewall_policy_id': None,
+                'egress_firewall_policy_revision_number': None,
+                'egress_rule_list_delta': rule_deltas.make_rule_list_delta(
+                    None, [], []),
+                'add-port-ids': [], 'del-port-ids': []}
+
+    def test_update_firewall_group_rules(self):
+        fwg_delta = self._fake_firewall_group_delta()
+        with mock.patch.object(self.api, '_get_firewall_group_ports',
+                               return_value=[mock.sentinel.router_info]), \
+                mock.patch.object(self.api, 'update_firewall_group'
+                                  ) as mock_update:
+            self.api.update_firewall_group_rules(self.context, fwg_delta,
+                                                 host='host')
+
+        firewall_group = mock_update.call_args[0][1]
+        self.assertEqual([{'id': 'fwr2'}, {'id': 'fwr3'}],
+                         firewall_group['ingress_rule_list'])
+        self.assertEqual([], firewall_group['egress_rule_list'])
+        self.assertNotIn('ingress_rule_list_delta', firewall_group)
+        self.assertNotIn('egress_rule_list_delta', firewall_group)
+        self.assertFalse(self.api.services_sync_needed)
+
+    def _update_firewall_group_rules_with_gap(self, **fetch):
+        fwg_delta = self._fake_firewall_group_delta(base_revision_number=2)
+        self.api.services_sync_needed = False
+        rpc = self.api.fwplugin_rpc = mock.Mock()
+        rpc.get_firewall_group_for_host.configure_mock(**fetch)
+        with mock.patch.object(self.api, '_get_firewall_group_ports',
+                               return_value=[mock.sentinel.router_info]), \
+                mock.patch.object(self.api, 'update_firewall_group'
+                                  ) as mock_update:
+            self.api.update_firewall_group_rules(self.context, fwg_delta,
+                                                 host='host')
+        rpc.get_firewall_group_for_host.assert_called_once_with(
+            self.context, 'fwg')
+        self.assertNotIn('fwg', self.api._applied_rule_lists)
+        return mock_update
+
+    def test_update_firewall_group_rules_revision_gap(self):
+        fwg = {'id': 'fwg', 'status': 'PENDING_UPDATE'}
+        mock_update = self._update_firewall_group_rules_with_gap(
+            return_value=fwg)
+
+        mock_update.assert_called_once_with(self.context, fwg, 'host')
+        self.assertFalse(self.api.services_sync_needed)
+
+    def test_update_firewall_group_rules_revision_gap_rpc_failure(self):
+        mock_update = self._update_firewall_group_rules_with_gap(
+            side_effect=oslo_messaging.MessagingTimeout())
+
+        mock_update.assert_not_called()
+        rpc = self.api.fwplugin_rpc
+        rpc.set_firewall_group_status.assert_called_once_with(
+            self.context, 'fwg', 'ERROR')
+
+    def test_update_firewall_group_rules_revision_gap_deleted(self):
+        mock_update = self._update_firewall_group_rules_with_gap(
+            return_value=None)
+
+        mock_update.assert_not_called()
+        self.api.fwplugin_rpc.set_firewall_group_status.assert_not_called()
+
+    def test_report_rule_counters(self):
+        counters = {'fwg-id': {'rule-id': {'packets': 2, 'bytes': 120}}}
+        cfg.CONF.set_override('rule_counters_file',
+                              '/fake/rule_counters.json', 'fwaas')
+        with mock.patch.object(self.api.fwaas_driver, 'get_rule_counters',
+                               return_value=counters), \
+                mock.patch('oslo_utils.fileutils.ensure_tree'
+                           ) as mock_ensure_tree, \
+                mock.patch('neutron.agent.linux.utils.replace_file'
+                           ) as mock_replace_file, \
+                mock.patch('oslo_utils.timeutils.utcnow_ts',
+                           return_value=1234):
+            self.api._report_rule_counters()
+        mock_ensure_tree.assert_called_once_with('/fake', mode=0o755)
+        mock_replace_file.assert_called_once_with(
+            '/fake/rule_counters.json', mock.ANY)
+        self.assertEqual({'timestamp': 1234, 'firewall_groups': counters},
+                         jsonutils.loads(mock_replace_file.call_args[0][1]))
+
+    def test_report_rule_counters_failure(self):
+        with mock.patch.object(self.api.fwaas_driver, 'get_rule_counters',
+                               side_effect=RuntimeError), \
+                mock.patch('neutron.agent.linux.utils.replace_file'
+                           ) as mock_replace_file:
+            # the looping call keeps running
+            self.api._report_rule_counters()
+        mock_replace_file.assert_not_called()
+
     def _prepare_router_data(self):
         return router_info.RouterInfo(self.api,
                                       self.router_id,
@@ -352,6 +533,16 @@ class TestFWaaSL3AgentExtension(base.BaseTestCase):
             ports_for_fw_actual = self.api._get_in_ns_ports(fw_port_ids)
             self.assertEqual(ports_for_fw_expected, ports_for_fw_actual)
 
+    def test_delete_router_releases_namespaces(self):
+        self.api.fwaas_enabled = True
+        with mock.patch.object(self.api.fwaas_driver,
+                               'release_namespace') as mock_release:
+            firewall_l3_agent_v2.L3WithFWaaS.delete_router(
+                self.api, self.context, {'id': self.router_id})
+        mock_release.assert_has_calls([
+            mock.call('qrouter-' + self.router_id),
+            mock.call('snat-' + self.router_id)])
+
     def test_add_router_for_check_input(self):
         fw_agent = _setup_test_agent_class([fwaas_constants.FIREWALL])
         cfg.CONF.set_override('enabled', True, 'fwaas')
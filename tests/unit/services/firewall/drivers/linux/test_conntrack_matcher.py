@@ -0,0 +1,108 @@
+# Copyright (c) 2018
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from neutron_fwaas.services.firewall.drivers.linux import conntrack_matcher
+from neutron_fwaas.tests import base
+
+ICMP_ENTRY = (4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234)
+ICMPV6_ENTRY = (6, 'icmpv6', 128, 0, 'fd00::1', 'fd00::2', 1234)
+TCP_ENTRY = (4, 'tcp', 1000, 22, '1.1.1.1', '2.2.2.2')
+UDP_ENTRY = (4, 'udp', 1000, 53, '1.1.1.1', '2.2.2.2')
+TCP6_ENTRY = (6, 'tcp', 1000, 22, 'fd00::1', 'fd00::2')
+
+
+class ConntrackMatcherTestCase(base.BaseTestCase):
+
+    def _select(self, rule_filters, entries):
+        return conntrack_matcher.ConntrackMatcher(rule_filters).select(
+            entries)
+
+    def test_no_filter(self):
+        self.assertEqual([], self._select([], [TCP_ENTRY]))
+
+    def test_protocol(self):
+        entries = [ICMP_ENTRY, TCP_ENTRY, UDP_ENTRY, TCP6_ENTRY]
+        self.assertEqual([TCP_ENTRY],
+                         self._select([(4, 'tcp', [], [], [], [])], entries))
+        self.assertEqual([ICMP_ENTRY, TCP_ENTRY, UDP_ENTRY],
+                         self._select([(4, None, [], [], [], [])], entries))
+
+    def test_ipv6_icmp_alias(self):
+        self.assertEqual(
+            [ICMPV6_ENTRY],
+            self._select([(6, 'ipv6-icmp', [], [], [], [])],
+                         [ICMPV6_ENTRY, TCP6_ENTRY]))
+
+    def test_overlapping_port_ranges(self):
+        rule_filters = [(4, 'tcp', [], ['20', '30']),
+                        (4, 'tcp', [], ['25', '80']),
+                        (4, 'tcp', ['1000'], ['443'])]
+        entries = [(4, 'tcp', 1, port, '1.1.1.1', '2.2.2.2')
+                   for port in (19, 20, 25, 30, 31, 80, 81, 443)]
+        entries.append((4, 'tcp', 1000, 443, '1.1.1.1', '2.2.2.2'))
+        self.assertEqual(
+            [entry for entry in entries
+             if 20 <= entry[3] <= 80 or entry[2] == 1000],
+            self._select(rule_filters, entries))
+
+    def test_reversed_port_range(self):
+        self.assertEqual(
+            [TCP_ENTRY],
+            self._select([(4, 'tcp', ['1001', '999'], ['22'])], [TCP_ENTRY]))
+
+    def test_port_filter_does_not_match_icmp(self):
+        self.assertEqual(
+            [], self._select([(4, None, [], ['8'], [], [])], [ICMP_ENTRY]))
+
+    def test_addresses(self):
+        entries = [TCP_ENTRY, (4, 'tcp', 1000, 22, '1.1.2.1', '2.2.2.2'),
+                   TCP6_ENTRY]
+        self.assertEqual(
+            [TCP_ENTRY],
+            self._select([(4, 'tcp', [], [], '1.1.1.0/24', [])], entries))
+        self.assertEqual(
+            entries[:2],
+            self._select([(4, 'tcp', [], [], '1.1.1.1-1.1.2.1',
+                           '2.2.2.2/32')], entries))
+        self.assertEqual(
+            [TCP6_ENTRY],
+            self._select([(6, 'tcp', [], [], [], 'fd00::/64')], entries))
+
+    def test_dnat_entry(self):
+        # Floating IP connection, the fixed IP is only in its reply tuple
+        entry = (4, 'tcp', 1000, 22, '8.8.8.8', '172.24.4.10')
+        reply_entry = (4, 'tcp', 22, 1000, '10.0.0.5', '8.8.8.8')
+        rule_filters = [(4, 'tcp', [], [], '8.8.8.0/24', '10.0.0.5')]
+        self.assertEqual([], self._select(rule_filters, [entry]))
+        self.assertEqual(
+            [entry],
+            conntrack_matcher.ConntrackMatcher(rule_filters).select(
+                [entry], {entry: reply_entry}))
+
+    def test_dnat_port_forwarding_entry(self):
+        entry = (4, 'tcp', 1000, 2222, '8.8.8.8', '172.24.4.10')
+        reply_entry = (4, 'tcp', 22, 1000, '10.0.0.5', '8.8.8.8')
+        matcher = conntrack_matcher.ConntrackMatcher(
+            [(4, 'tcp', [], ['22'], [], '10.0.0.0/24')])
+        self.assertTrue(matcher.match(entry, reply_entry))
+        self.assertFalse(matcher.match(entry))
+
+    def test_not_nated_reply_entry(self):
+        reply_entry = (4, 'tcp', 22, 1000, '2.2.2.2', '1.1.1.1')
+        self.assertIsNone(
+            conntrack_matcher.get_translated_entry(TCP_ENTRY, reply_entry))
+        self.assertFalse(conntrack_matcher.ConntrackMatcher(
+            [(4, 'tcp', [], [], [], '10.0.0.5')]).match(
+                TCP_ENTRY, reply_entry))
@@ -0,0 +1,97 @@
+# Copyright (c) 2018
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from neutron_fwaas.services.firewall.drivers.linux import conntrack_queue
+from neutron_fwaas.tests import base
+
+RULE1 = {'id': 'rule1', 'ip_version': 4, 'protocol': 'tcp'}
+RULE2 = {'id': 'rule2', 'ip_version': 4, 'protocol': 'udp'}
+MARKS1 = [(0x1, 0xff), (0x100, 0xff00)]
+MARKS2 = [(0x2, 0xff), (0x200, 0xff00)]
+
+
+class ConntrackCleanupQueueTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(ConntrackCleanupQueueTestCase, self).setUp()
+        self.conntrack = mock.Mock()
+        self.conntrack.delete_entries.return_value = 2
+        self.on_failure = mock.Mock()
+        self.queue = conntrack_queue.ConntrackCleanupQueue(
+            self.conntrack, workers=2, on_failure=self.on_failure)
+
+    def test_enqueue_does_not_block(self):
+        self.queue.enqueue('ns1', [RULE1])
+        self.assertEqual(1, len(self.queue))
+        self.conntrack.delete_entries.assert_not_called()
+        self.queue.wait()
+        self.assertEqual(0, len(self.queue))
+        self.conntrack.delete_entries.assert_called_once_with([RULE1],
+                                                              'ns1')
+        self.assertEqual(1, self.queue.stats['completed'])
+        self.assertEqual(2, self.queue.stats['deleted'])
+
+    def test_requests_coalesced_per_namespace(self):
+        self.queue.enqueue('ns1', [RULE1], MARKS1)
+        self.queue.enqueue('ns2', [RULE1])
+        self.queue.enqueue('ns1', [RULE2], MARKS2 + MARKS1[:1])
+        self.queue.wait()
+        self.conntrack.delete_entries.assert_has_calls([
+            mock.call([RULE1, RULE2], 'ns1', MARKS1 + MARKS2),
+            mock.call([RULE1], 'ns2')])
+        self.assertEqual(2, self.conntrack.delete_entries.call_count)
+        self.assertEqual(3, self.queue.stats['enqueued'])
+        self.assertEqual(1, self.queue.stats['coalesced'])
+
+    def test_flush_supersedes_deletion(self):
+        self.queue.enqueue('ns1', [RULE1], MARKS1)
+        self.queue.enqueue('ns1', None)
+        self.queue.enqueue('ns1', [RULE2])
+        self.queue.wait()
+        self.conntrack.flush_entries.assert_called_once_with('ns1')
+        self.conntrack.delete_entries.assert_not_called()
+
+    def test_unscoped_request_drops_marks(self):
+        self.queue.enqueue('ns1', [RULE1], MARKS1)
+        self.queue.enqueue('ns1', [RULE2])
+        self.queue.wait()
+        self.conntrack.delete_entries.assert_called_once_with(
+            [RULE1, RULE2], 'ns1')
+
+    def test_request_during_cleanup_processed_after(self):
+        def delete_entries(rules, namespace):
+            if rules == [RULE1]:
+                self.queue.enqueue('ns1', [RULE2])
+            return 1
+
+        self.conntrack.delete_entries.side_effect = delete_entries
+        self.queue.enqueue('ns1', [RULE1])
+        self.queue.wait()
+        self.assertEqual([mock.call([RULE1], 'ns1'),
+                          mock.call([RULE2], 'ns1')],
+                         self.conntrack.delete_entries.call_args_list)
+        self.assertEqual(2, self.queue.stats['completed'])
+
+    def test_failure_reported(self):
+        self.conntrack.delete_entries.side_effect = RuntimeError
+        self.queue.enqueue('ns1', [RULE1])
+        self.queue.enqueue('ns2', None)
+        self.queue.wait()
+        self.on_failure.assert_called_once_with('ns1')
+        self.conntrack.flush_entries.assert_called_once_with('ns2')
+        self.assertEqual(1, self.queue.stats['failed'])
+        self.assertEqual(1, self.queue.stats['completed'])
@@ -44,6 +44,8 @@ class IptablesFwaasTestCase(base.BaseTestCase):
         self.iptables_cls_p.start()
         self.firewall = fwaas.IptablesFwaasDriver()
         self.firewall.conntrack = self.conntrack_driver
+        self.delete_entries_batch = mock.patch.object(
+            self.conntrack_driver, 'delete_entries_batch').start()
 
     def _fake_rules_v4(self, fwid, apply_list):
         rule_list = []
@@ -282,14 +284,16 @@ class IptablesFwaasTestCase(base.BaseTestCase):
         self._setup_firewall_with_rules(self.firewall.update_firewall,
             distributed=True, distributed_mode='dvr')
 
+    def _get_conntrack_jobs(self, apply_list, rules):
+        return [(router_info_inst.iptables_manager.namespace, rules)
+                for router_info_inst in apply_list]
+
     def test_remove_conntrack_new_firewall(self):
         apply_list = self._fake_apply_list()
         firewall = self._fake_firewall_no_rule()
         self.firewall.create_firewall(FW_LEGACY, apply_list, firewall)
-        for router_info_inst in apply_list:
-            namespace = router_info_inst.iptables_manager.namespace
-            calls = [mock.call(namespace)]
-            self.conntrack_driver.flush_entries.assert_has_calls(calls)
+        self.delete_entries_batch.assert_called_once_with(
+            self._get_conntrack_jobs(apply_list, None), mock.ANY)
 
     def test_remove_conntrack_inserted_rule(self):
         apply_list = self._fake_apply_list()
@@ -329,11 +333,9 @@ class IptablesFwaasTestCase(base.BaseTestCase):
              'action': 'deny',
              'position': '2'}
         ]
-        for router_info_inst in apply_list:
-            namespace = router_info_inst.iptables_manager.namespace
-            self.conntrack_driver.delete_entries.assert_called_once_with(
-                rules_changed + rules_inserted, namespace
-            )
+        jobs = self._get_conntrack_jobs(apply_list,
+                                        rules_changed + rules_inserted)
+        self.delete_entries_batch.assert_called_with(jobs, mock.ANY)
 
     def test_remove_conntrack_removed_rule(self):
         apply_list = self._fake_apply_list()
@@ -370,11 +372,9 @@ class IptablesFwaasTestCase(base.BaseTestCase):
              'action': 'deny',
              'destination_port': '22'}
         ]
-        for router_info_inst in apply_list:
-            namespace = router_info_inst.iptables_manager.namespace
-            self.conntrack_driver.delete_entries.assert_called_once_with(
-                rules_changed + rules_removed, namespace
-            )
+        jobs = self._get_conntrack_jobs(apply_list,
+                                        rules_changed + rules_removed)
+        self.delete_entries_batch.assert_called_with(jobs, mock.ANY)
 
     def test_remove_conntrack_changed_rule(self):
         apply_list = self._fake_apply_list()
@@ -404,8 +404,5 @@ class IptablesFwaasTestCase(base.BaseTestCase):
              'ip_version': 4,
              'protocol': 'tcp'}
         ]
-        for router_info_inst in apply_list:
-            namespace = router_info_inst.iptables_manager.namespace
-            self.conntrack_driver.delete_entries.assert_called_once_with(
-                rules_changed, namespace
-            )
+        self.delete_entries_batch.assert_called_with(
+            self._get_conntrack_jobs(apply_list, rules_changed), mock.ANY)
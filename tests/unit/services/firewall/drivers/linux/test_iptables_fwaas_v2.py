@@ -18,6 +18,7 @@ import copy
 import mock
 from neutron.tests import base
 from neutron.tests.unit.api.v2 import test_base as test_api_v2
+from oslo_config import cfg
 
 import neutron_fwaas.services.firewall.drivers.linux.iptables_fwaas_v2 as fwaas
 
@@ -168,12 +169,12 @@ class IptablesFwaasTestCase(base.BaseTestCase):
                      mock.call.add_chain(ingress_chain),
                      mock.call.add_rule(ingress_chain, invalid_rule),
                      mock.call.add_rule(ingress_chain, est_rule),
-                     mock.call.add_chain(egress_chain),
-                     mock.call.add_rule(egress_chain, invalid_rule),
-                     mock.call.add_rule(egress_chain, est_rule),
                      mock.call.add_rule(ingress_chain, rule1),
                      mock.call.add_rule(ingress_chain, rule2),
                      mock.call.add_rule(ingress_chain, rule3),
+                     mock.call.add_chain(egress_chain),
+                     mock.call.add_rule(egress_chain, invalid_rule),
+                     mock.call.add_rule(egress_chain, est_rule),
                      mock.call.add_rule(egress_chain, rule1),
                      mock.call.add_rule(egress_chain, rule2),
                      mock.call.add_rule(egress_chain, rule3)]
@@ -311,7 +312,6 @@ class IptablesFwaasTestCase(base.BaseTestCase):
         rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
         firewall = self._fake_firewall(rule_list)
         self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
-        self.firewall.pre_firewall = dict(firewall)
         insert_rule = {'enabled': True,
                  'action': 'deny',
                  'ip_version': 4,
@@ -355,7 +355,6 @@ class IptablesFwaasTestCase(base.BaseTestCase):
         rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
         firewall = self._fake_firewall(rule_list)
         self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
-        self.firewall.pre_firewall = dict(firewall)
         remove_rule = rule_list[1]
         rule_list.remove(remove_rule)
         firewall = self._fake_firewall(rule_list)
@@ -424,3 +423,674 @@ class IptablesFwaasTestCase(base.BaseTestCase):
             self.firewall.conntrack.delete_entries.assert_called_once_with(
                 rules_changed, namespace
             )
+
+    def _fake_v6_chains(self, fwid, apply_list):
+        for router_info_inst, port_ids in apply_list:
+            v6filter_inst = router_info_inst.iptables_manager.ipv6['filter']
+            v6filter_inst.chains.append(('iv6%s' % fwid)[:11])
+            v6filter_inst.chains.append(('ov6%s' % fwid)[:11])
+
+    def _enable_incremental_chain_update(self):
+        cfg.CONF.set_override('incremental_chain_update', True, 'fwaas')
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack.delete_entries = mock.Mock()
+        self.firewall.conntrack.flush_entries = mock.Mock()
+
+    def test_update_firewall_group_incremental_changed_rule(self):
+        self._enable_incremental_chain_update()
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        self._fake_v6_chains(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        v4filter_inst = apply_list[0][0].iptables_manager.ipv4['filter']
+        v4filter_inst.reset_mock()
+
+        rule_list[2] = dict(rule_list[2], destination_port='24')
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+
+        ingress_chain = 'iv4%s' % FAKE_FW_ID
+        egress_chain = 'ov4%s' % FAKE_FW_ID
+        old_rule = '-p tcp -m tcp --dport 23 -j REJECT'
+        new_rule = '-p tcp -m tcp --dport 24 -j REJECT'
+        v4filter_inst.assert_has_calls([
+            mock.call.remove_rule(ingress_chain, old_rule),
+            mock.call.add_rule(ingress_chain, new_rule),
+            mock.call.remove_rule(egress_chain, old_rule),
+            mock.call.add_rule(egress_chain, new_rule)])
+        self.assertEqual(2, v4filter_inst.add_rule.call_count)
+        v4filter_inst.remove_chain.assert_not_called()
+
+    def test_update_firewall_group_incremental_added_port(self):
+        self._enable_incremental_chain_update()
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        self._fake_v6_chains(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        ri = apply_list[0][0]
+        self.firewall.create_firewall_group(
+            FW_LEGACY, [(ri, FAKE_PORT_IDS[:1])], firewall)
+        v4filter_inst = ri.iptables_manager.ipv4['filter']
+        v4filter_inst.reset_mock()
+
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+
+        bname = fwaas.iptables_manager.binary_name
+        intf_name = self._get_intf_name('qr-', FAKE_PORT_IDS[1])
+        v4filter_inst.assert_has_calls([
+            mock.call.add_rule('FORWARD', '-o %s -j %s-%s' % (
+                intf_name, bname, ('iv4%s' % FAKE_FW_ID)[:11])),
+            mock.call.add_rule('FORWARD', '-i %s -j %s-%s' % (
+                intf_name, bname, ('ov4%s' % FAKE_FW_ID)[:11])),
+            mock.call.add_rule('FORWARD', '-o %s -j %s-fwaas-defau' % (
+                intf_name, bname)),
+            mock.call.add_rule('FORWARD', '-i %s -j %s-fwaas-defau' % (
+                intf_name, bname))])
+        self.assertEqual(4, v4filter_inst.add_rule.call_count)
+        v4filter_inst.remove_rule.assert_not_called()
+
+    def test_update_firewall_group_incremental_new_ipt_mgr(self):
+        self._enable_incremental_chain_update()
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+
+        # router re-created with a fresh iptables manager
+        apply_list = self._fake_apply_list()
+        self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        v4filter_inst = apply_list[0][0].iptables_manager.ipv4['filter']
+        v4filter_inst.remove_chain.assert_has_calls([
+            mock.call('iv4fake-fw-uuid'),
+            mock.call('ov4fake-fw-uuid'),
+            mock.call('fwaas-default-policy')])
+
+    def test_batch_apply_commits_namespace_once(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        other_firewall = dict(self._fake_firewall_no_rule(),
+                              id='other-fw-uuid')
+        with self.firewall.batch_apply() as failed_fwids:
+            self.firewall.update_firewall_group(FW_LEGACY, apply_list,
+                                                firewall)
+            self.firewall.update_firewall_group(FW_LEGACY, apply_list,
+                                                other_firewall)
+            ipt_mgr.defer_apply_off.assert_not_called()
+            self.firewall.conntrack.flush_entries.assert_not_called()
+        ipt_mgr.defer_apply_off.assert_called_once_with()
+        self.assertEqual(set(), failed_fwids)
+        self.firewall.conntrack.flush_entries.assert_called_with(
+            ipt_mgr.namespace)
+
+    def test_batch_apply_commit_failure(self):
+        apply_list = self._fake_apply_list(router_count=2)
+        failed_ipt_mgr = apply_list[1][0].iptables_manager
+        failed_ipt_mgr.defer_apply_off.side_effect = RuntimeError
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        with self.firewall.batch_apply() as failed_fwids:
+            self.firewall.update_firewall_group(FW_LEGACY, apply_list,
+                                                firewall)
+        ipt_mgr = apply_list[0][0].iptables_manager
+        ipt_mgr.defer_apply_off.assert_called_once_with()
+        self.assertEqual({FAKE_FW_ID}, failed_fwids)
+        # connections are only cleaned up once the rules are in place
+        self.firewall.conntrack.flush_entries.assert_not_called()
+
+    def test_rule_cache_shared_across_routers(self):
+        apply_list = self._fake_apply_list(router_count=2)
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        with mock.patch.object(
+                self.firewall, '_compile_fwaas_to_iptables_rule',
+                wraps=self.firewall._compile_fwaas_to_iptables_rule) as comp:
+            self.firewall.create_firewall_group(FW_LEGACY, apply_list,
+                                                firewall)
+            self.assertEqual(len(rule_list), comp.call_count)
+        self.assertEqual(len(rule_list), self.firewall.rule_cache_misses)
+        # ingress and egress of the second router, egress of the first one
+        self.assertEqual(3 * len(rule_list), self.firewall.rule_cache_hits)
+
+    def test_rule_cache_eviction(self):
+        cfg.CONF.set_override('rule_cache_size', 2, 'fwaas')
+        self.firewall = fwaas.IptablesFwaasDriver()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, [])
+        for rule in rule_list + rule_list[:1]:
+            self.firewall._convert_fwaas_to_iptables_rule(rule)
+        self.assertEqual(4, self.firewall.rule_cache_misses)
+        self.assertEqual(0, self.firewall.rule_cache_hits)
+        self.assertEqual(2, len(self.firewall._rule_cache))
+        iptables_rule = self.firewall._convert_fwaas_to_iptables_rule(
+            rule_list[2])
+        self.assertEqual('-p tcp -m tcp --dport 23 -j REJECT', iptables_rule)
+        self.assertEqual(1, self.firewall.rule_cache_hits)
+
+    def test_rule_cache_disabled(self):
+        cfg.CONF.set_override('rule_cache_size', 0, 'fwaas')
+        self.firewall = fwaas.IptablesFwaasDriver()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, [])
+        self.firewall._convert_fwaas_to_iptables_rule(rule_list[0])
+        self.firewall._convert_fwaas_to_iptables_rule(rule_list[0])
+        self.assertEqual(0, len(self.firewall._rule_cache))
+        self.assertEqual(0, self.firewall.rule_cache_misses)
+
+    def test_remove_conntrack_per_firewall_group(self):
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        other_firewall = dict(self._fake_firewall_no_rule(),
+                              id='other-fw-uuid')
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list,
+                                            other_firewall)
+        self.firewall.conntrack.flush_entries.reset_mock()
+
+        # unchanged firewall group: diffed against its own baseline
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.firewall.conntrack.delete_entries.assert_not_called()
+        self.firewall.conntrack.flush_entries.assert_not_called()
+
+    def test_remove_conntrack_updated_firewall_no_baseline(self):
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        namespace = apply_list[0][0].iptables_manager.namespace
+        self.firewall.conntrack.flush_entries.assert_called_once_with(
+            namespace)
+        self.firewall.conntrack.delete_entries.assert_not_called()
+
+    def test_delete_firewall_group_forgets_baseline(self):
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual({}, self.firewall._applied_firewalls)
+
+    def test_delete_firewall_group_releases_namespace(self):
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        with mock.patch.object(self.firewall.conntrack,
+                               'release_namespace') as release:
+            self.firewall.delete_firewall_group(FW_LEGACY, apply_list,
+                                                firewall)
+        release.assert_called_once_with(
+            apply_list[0][0].iptables_manager.namespace)
+
+    def test_release_namespace(self):
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        namespace = apply_list[0][0].iptables_manager.namespace
+        with mock.patch.object(self.firewall.conntrack,
+                               'release_namespace') as release:
+            self.firewall.release_namespace(namespace)
+        release.assert_called_once_with(namespace)
+        self.assertEqual({}, self.firewall._applied_firewalls)
+
+    def test_remove_conntrack_updated_firewall_diffs_once(self):
+        apply_list = self._fake_apply_list(router_count=2)
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        del rule_list[1]
+        firewall = self._fake_firewall(rule_list)
+        with mock.patch.object(
+                self.firewall, '_find_conntrack_rules',
+                wraps=self.firewall._find_conntrack_rules) as find_rules:
+            self.firewall.update_firewall_group(FW_LEGACY, apply_list,
+                                                firewall)
+        find_rules.assert_called_once_with(mock.ANY, firewall)
+        self.assertEqual(2, self.firewall.conntrack.delete_entries.call_count)
+
+    def test_find_changed_rules_keeps_order(self):
+        rules = [{'id': 'rule%d' % i, 'position': i} for i in range(3)]
+        pre_firewall = {'egress_rule_list': rules,
+                        'ingress_rule_list': []}
+        firewall = {'egress_rule_list': [dict(rules[2], position=0),
+                                         rules[1],
+                                         dict(rules[0], position=2)],
+                    'ingress_rule_list': []}
+        self.assertEqual(
+            [rules[0], firewall['egress_rule_list'][2],
+             rules[2], firewall['egress_rule_list'][0]],
+            self.firewall._find_changed_rules(pre_firewall, firewall))
+
+    def _enable_conntrack_port_marks(self, apply_list):
+        cfg.CONF.set_override('conntrack_port_marks', True, 'fwaas')
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack.delete_entries = mock.Mock(return_value=0)
+        self.firewall.conntrack.flush_entries = mock.Mock()
+        for router_info_inst, port_ids in apply_list:
+            ipt_mgr = router_info_inst.iptables_manager
+            ipt_mgr.ipv4['mangle'] = mock.Mock()
+            ipt_mgr.ipv6['mangle'] = mock.Mock()
+
+    def test_parse_mark_mask(self):
+        self.assertEqual((0, 8), self.firewall._parse_mark_mask('0xffff'))
+        self.assertEqual((8, 4), self.firewall._parse_mark_mask('0xff00'))
+        for mask in ('0x7ff', '0xf0f', '0', 'fff', '0x1ffffffff00'):
+            self.assertRaises(ValueError,
+                              self.firewall._parse_mark_mask, mask)
+
+    def test_setup_port_marks(self):
+        apply_list = self._fake_apply_list()
+        self._enable_conntrack_port_marks(apply_list)
+        firewall = self._fake_firewall_no_rule()
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        bname = fwaas.iptables_manager.binary_name
+        mark_chain = 'mv4%s' % FAKE_FW_ID
+        intf_names = [self._get_intf_name('qr-', port_id)
+                      for port_id in FAKE_PORT_IDS]
+        calls = [
+            mock.call.remove_chain(mark_chain),
+            mock.call.add_chain(mark_chain),
+            mock.call.add_rule(
+                mark_chain, '-i %s -m connmark --mark 0x0/0xff '
+                '-j CONNMARK --set-xmark 0x1/0xff' % intf_names[0]),
+            mock.call.add_rule(
+                mark_chain, '-o %s -m connmark --mark 0x0/0xff00 '
+                '-j CONNMARK --set-xmark 0x100/0xff00' % intf_names[0]),
+            mock.call.add_rule(
+                mark_chain, '-i %s -m connmark --mark 0x0/0xff '
+                '-j CONNMARK --set-xmark 0x2/0xff' % intf_names[1]),
+            mock.call.add_rule(
+                mark_chain, '-o %s -m connmark --mark 0x0/0xff00 '
+                '-j CONNMARK --set-xmark 0x200/0xff00' % intf_names[1]),
+            mock.call.add_rule('FORWARD',
+                               '-j %s-%s' % (bname, mark_chain[:11]))]
+        mangle = apply_list[0][0].iptables_manager.ipv4['mangle']
+        mangle.assert_has_calls(calls)
+
+    def test_remove_conntrack_scoped_by_port_marks(self):
+        apply_list = self._fake_apply_list()
+        self._enable_conntrack_port_marks(apply_list)
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        namespace = apply_list[0][0].iptables_manager.namespace
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.firewall.conntrack.flush_entries.assert_called_once_with(
+            namespace)
+        del rule_list[1]
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.firewall.conntrack.delete_entries.assert_called_once_with(
+            mock.ANY, namespace,
+            [(0x1, 0xff), (0x100, 0xff00), (0x2, 0xff), (0x200, 0xff00)])
+
+    def test_remove_conntrack_added_port_not_scoped(self):
+        apply_list = self._fake_apply_list()
+        self._enable_conntrack_port_marks(apply_list)
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        router_info_inst = apply_list[0][0]
+        self.firewall.create_firewall_group(
+            FW_LEGACY, [(router_info_inst, FAKE_PORT_IDS[:1])], firewall)
+        del rule_list[1]
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        # the connections of the added port predate its mark
+        self.firewall.conntrack.delete_entries.assert_called_once_with(
+            mock.ANY, router_info_inst.iptables_manager.namespace)
+        # idle ones may still not carry it
+        del rule_list[0]
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.firewall.conntrack.delete_entries.assert_called_with(
+            mock.ANY, router_info_inst.iptables_manager.namespace)
+
+    def test_remove_conntrack_not_scoped_for_many_ports(self):
+        port_ids = ['%d_fake-port-uuid' % i
+                    for i in range(fwaas.CONNTRACK_MARKS_MAX_PORTS + 1)]
+        router_info_inst = self._fake_apply_list()[0][0]
+        apply_list = [(router_info_inst, port_ids)]
+        self._enable_conntrack_port_marks(apply_list)
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        del rule_list[1]
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.firewall.conntrack.delete_entries.assert_called_once_with(
+            mock.ANY, router_info_inst.iptables_manager.namespace)
+
+    def test_port_marks_kept_until_flush(self):
+        apply_list = self._fake_apply_list()
+        self._enable_conntrack_port_marks(apply_list)
+        router_info_inst = apply_list[0][0]
+        namespace = router_info_inst.iptables_manager.namespace
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        # the removed port connections may still carry its index
+        self.firewall.update_firewall_group(
+            FW_LEGACY, [(router_info_inst, FAKE_PORT_IDS[:1])], firewall)
+        self.assertEqual({FAKE_PORT_IDS[0]: 1, FAKE_PORT_IDS[1]: 2},
+                         self.firewall._port_marks[namespace])
+        # and gets it back, without being trusted until the next flush
+        del rule_list[1]
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual({FAKE_PORT_IDS[0]: 1, FAKE_PORT_IDS[1]: 2},
+                         self.firewall._port_marks[namespace])
+        self.firewall.conntrack.delete_entries.assert_called_once_with(
+            mock.ANY, namespace)
+        # flushing the namespace frees the indexes of unmarked ports, once
+        # the new ones are marked
+        self.firewall.update_firewall_group(
+            FW_LEGACY, [(router_info_inst, FAKE_PORT_IDS[:1])], firewall)
+        self.firewall.create_firewall_group(
+            FW_LEGACY, [(router_info_inst, ['3_fake-port-uuid'])],
+            dict(self._fake_firewall(rule_list), id='fake-fw-uuid2'))
+        self.assertEqual({FAKE_PORT_IDS[0]: 1, '3_fake-port-uuid': 3},
+                         self.firewall._port_marks[namespace])
+        self.assertEqual({FAKE_PORT_IDS[0], '3_fake-port-uuid'},
+                         self.firewall._marked_ports[namespace])
+
+    def test_delete_firewall_group_releases_port_marks(self):
+        apply_list = self._fake_apply_list()
+        self._enable_conntrack_port_marks(apply_list)
+        firewall = self._fake_firewall_no_rule()
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(1, len(self.firewall._port_marks))
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual({}, self.firewall._port_marks)
+        self.assertEqual({}, self.firewall._marked_ports)
+        mangle = apply_list[0][0].iptables_manager.ipv6['mangle']
+        mangle.remove_chain.assert_called_with('mv6%s' % FAKE_FW_ID)
+
+    def test_remove_conntrack_async(self):
+        cfg.CONF.set_override('conntrack_async_cleanup', True, 'fwaas')
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack.delete_entries = mock.Mock(return_value=1)
+        self.firewall.conntrack.flush_entries = mock.Mock()
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        namespace = apply_list[0][0].iptables_manager.namespace
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        del rule_list[1]
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        # both requests are merged into the flush queued first
+        self.firewall.conntrack.flush_entries.assert_not_called()
+        self.firewall.conntrack_cleanup_queue.wait()
+        self.firewall.conntrack.flush_entries.assert_called_once_with(
+            namespace)
+        self.firewall.conntrack.delete_entries.assert_not_called()
+
+    def test_remove_conntrack_async_failure_forgets_namespace(self):
+        cfg.CONF.set_override('conntrack_async_cleanup', True, 'fwaas')
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack.flush_entries = mock.Mock(
+            side_effect=RuntimeError)
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall_no_rule()
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(1, len(self.firewall._applied_firewalls))
+        self.firewall.conntrack_cleanup_queue.wait()
+        self.assertEqual({}, self.firewall._applied_firewalls)
+
+    def _fake_address_group_rules(self):
+        address_group = {'id': 'fake-ag-uuid',
+                         'name': 'fake-ag',
+                         'ip_addresses': [
+                             {'ip_address': '10.0.0.0/24', 'ip_version': 4},
+                             {'ip_address': '2001:db8::/64', 'ip_version': 6},
+                             {'ip_address': '10.1.0.1'}]}
+        rule = {'enabled': True,
+                'action': 'allow',
+                'ip_version': 4,
+                'protocol': 'tcp',
+                'destination_port': '80',
+                'source_address_groups': [address_group],
+                'id': 'fake-fw-rule1'}
+        return [rule]
+
+    def _mock_ipset_manager(self):
+        ipset_cls = mock.patch(
+            'neutron.agent.linux.ipset_manager.IpsetManager').start()
+        ipset_cls.get_name.side_effect = lambda id, ethertype: (
+            ('N%s%s' % (ethertype, id))[:31])
+        return ipset_cls
+
+    def test_create_firewall_group_with_address_groups(self):
+        ipset_cls = self._mock_ipset_manager()
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_address_group_rules()
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        ipt_mgr = apply_list[0][0].iptables_manager
+        ipset_cls.assert_called_once_with(namespace=ipt_mgr.namespace)
+        ipset_cls.return_value.set_members.assert_called_once_with(
+            'fwagfake-ag-uuid', 'IPv4', ['10.0.0.0/24', '10.1.0.1'])
+        ipt_mgr.ipv4['filter'].add_rule.assert_any_call(
+            'iv4%s' % FAKE_FW_ID,
+            '-p tcp -m set --match-set NIPv4fwagfake-ag-uuid src '
+            '-m tcp --dport 80 -j ACCEPT')
+
+    def test_update_address_group_members(self):
+        ipset_cls = self._mock_ipset_manager()
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_address_group_rules()
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        rule_list[0]['source_address_groups'][0]['ip_addresses'].pop()
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list, firewall)
+        ipset_cls.return_value.set_members.assert_called_with(
+            'fwagfake-ag-uuid', 'IPv4', ['10.0.0.0/24'])
+        ipset_cls.return_value.destroy.assert_not_called()
+
+    def test_delete_firewall_group_destroys_address_groups(self):
+        ipset_cls = self._mock_ipset_manager()
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_address_group_rules())
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list, firewall)
+        ipset_cls.return_value.destroy.assert_called_once_with(
+            'fwagfake-ag-uuid', 'IPv4')
+        self.assertEqual({}, self.firewall._ipset_managers)
+        self.assertEqual({}, self.firewall._address_group_sets)
+
+    def _fake_service_group_rule(self, ports, protocol=None):
+        service_group = {'id': 'fake-sg-uuid',
+                         'name': 'fake-sg',
+                         'ports': ports}
+        return {'enabled': True,
+                'action': 'allow',
+                'ip_version': 4,
+                'protocol': protocol,
+                'source_port': None,
+                'destination_port': None,
+                'service_groups': [service_group],
+                'id': 'fake-fw-rule1'}
+
+    def test_convert_rule_with_service_groups(self):
+        rule = self._fake_service_group_rule(
+            [{'protocol': 'tcp', 'port': '80'},
+             {'protocol': 'tcp', 'port': '8080-8090'},
+             {'protocol': 'udp', 'port': '53'},
+             {'protocol': 'tcp', 'port': '80'},
+             {'protocol': 'icmp', 'port': None},
+             {'protocol': 'udp', 'port': None},
+             {'protocol': 'udp', 'port': '123'}])
+        # a service without port matches any port of its protocol
+        self.assertEqual(
+            ['-p tcp -m multiport --dports 80,8080:8090 -j ACCEPT',
+             '-p udp -j ACCEPT',
+             '-p icmp -j ACCEPT'],
+            self.firewall._convert_fwaas_to_iptables_rules(rule))
+
+    def test_convert_rule_with_service_groups_filtered_by_protocol(self):
+        rule = self._fake_service_group_rule(
+            [{'protocol': 'tcp', 'port': '80'},
+             {'protocol': 'udp', 'port': '53'}], protocol='udp')
+        self.assertEqual(
+            ['-p udp -m multiport --dports 53 -j ACCEPT'],
+            self.firewall._convert_fwaas_to_iptables_rules(rule))
+
+    def test_convert_rule_with_service_groups_multiport_chunks(self):
+        ports = [{'protocol': 'tcp', 'port': str(port)}
+                 for port in range(1, 15)]
+        ports.append({'protocol': 'tcp', 'port': '100-200'})
+        rule = self._fake_service_group_rule(ports)
+        # a range counts as two of the 15 ports of a multiport match
+        self.assertEqual(
+            ['-p tcp -m multiport --dports %s -j ACCEPT' %
+             ','.join(str(port) for port in range(1, 15)),
+             '-p tcp -m multiport --dports 100:200 -j ACCEPT'],
+            self.firewall._convert_fwaas_to_iptables_rules(rule))
+
+    def _enable_forward_dispatch_chains(self):
+        cfg.CONF.set_override('forward_dispatch_chains', True, 'fwaas')
+        self.firewall = fwaas.IptablesFwaasDriver()
+        self.firewall.conntrack.delete_entries = mock.Mock()
+        self.firewall.conntrack.flush_entries = mock.Mock()
+
+    def test_create_firewall_group_with_dispatch_chains(self):
+        self._enable_forward_dispatch_chains()
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+
+        bname = fwaas.iptables_manager.binary_name
+        v4filter_inst = apply_list[0][0].iptables_manager.ipv4['filter']
+        # a jump and a default dispatch chain per direction and character
+        self.assertEqual(64, len([
+            call for call in v4filter_inst.add_chain.call_args_list
+            if call[0][0].startswith(('fwj', 'fwd'))]))
+        forward_rules = [call[0][1]
+                         for call in v4filter_inst.add_rule.call_args_list
+                         if call[0][0] == 'FORWARD']
+        self.assertEqual(64, len(forward_rules))
+        self.assertEqual(['-o qr-0+ -j %s-fwjoqr-0' % bname,
+                          '-o qr-1+ -j %s-fwjoqr-1' % bname],
+                         forward_rules[:2])
+        self.assertIn('-i qr-f+ -j %s-fwdiqr-f' % bname, forward_rules)
+        calls = []
+        for direction, chain in [('o', 'iv4'), ('i', 'ov4')]:
+            for port_id in FAKE_PORT_IDS:
+                intf_name = self._get_intf_name('qr-', port_id)
+                calls.append(mock.call.add_rule(
+                    'fwj%sqr-%s' % (direction, port_id[0]),
+                    '-%s %s -j %s-%s' % (direction, intf_name, bname,
+                                         ('%s%s' % (chain, FAKE_FW_ID))[:11])))
+        for direction in ['o', 'i']:
+            for port_id in FAKE_PORT_IDS:
+                intf_name = self._get_intf_name('qr-', port_id)
+                calls.append(mock.call.add_rule(
+                    'fwd%sqr-%s' % (direction, port_id[0]),
+                    '-%s %s -j %s-fwaas-defau' % (direction, intf_name,
+                                                  bname)))
+        v4filter_inst.assert_has_calls(calls)
+
+    def test_dispatch_chains_created_once(self):
+        self._enable_forward_dispatch_chains()
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        self._fake_v6_chains(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        ipt_mgr = apply_list[0][0].iptables_manager
+        for table in [ipt_mgr.ipv4['filter'], ipt_mgr.ipv6['filter']]:
+            table.chains.append('fwjoqr-0')
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+
+        v4filter_inst = ipt_mgr.ipv4['filter']
+        self.assertEqual(
+            [mock.call('fwaas-default-policy'),
+             mock.call('iv4fake-fw-uuid'),
+             mock.call('ov4fake-fw-uuid')],
+            v4filter_inst.add_chain.call_args_list)
+        v4filter_inst.add_rule.assert_has_calls([
+            mock.call('fwjoqr-1', mock.ANY),
+            mock.call('fwdoqr-1', mock.ANY)], any_order=True)
+        self.assertNotIn('FORWARD', [
+            call[0][0] for call in v4filter_inst.add_rule.call_args_list])
+
+    def test_get_dispatch_chain_name(self):
+        self._enable_forward_dispatch_chains()
+        self.assertEqual('fwjoqr-a', self.firewall._get_dispatch_chain_name(
+            'fwj', '-o', 'qr-', 'qr-abcdef01-23'))
+        self.assertEqual('fwdirfp-0', self.firewall._get_dispatch_chain_name(
+            'fwd', '-i', 'rfp-', 'rfp-0bcdef01-2'))
+        # interfaces not named after a port id stay in FORWARD
+        self.assertEqual('FORWARD', self.firewall._get_dispatch_chain_name(
+            'fwj', '-o', 'qr-', 'qr-xyz'))
+
+    def test_create_firewall_group_with_optimized_rules(self):
+        cfg.CONF.set_override('optimize_rules', True, 'fwaas')
+        self.firewall = fwaas.IptablesFwaasDriver()
+        apply_list = self._fake_apply_list()
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        rule_list.insert(0, dict(rule_list[1], id='fake-fw-rule0',
+                                 action='allow'))
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+
+        v4filter_inst = apply_list[0][0].iptables_manager.ipv4['filter']
+        ingress_rules = [call[0][1]
+                         for call in v4filter_inst.add_rule.call_args_list
+                         if call[0][0] == 'iv4%s' % FAKE_FW_ID]
+        # the deny rule of port 22 is shadowed by the allow one
+        self.assertEqual(
+            ['-m state --state INVALID -j DROP',
+             '-m state --state RELATED,ESTABLISHED -j ACCEPT',
+             '-p tcp -m tcp --dport 22 -j ACCEPT',
+             '-p tcp -s 10.24.4.2/32 -m tcp --dport 80 -j ACCEPT',
+             '-p tcp -m tcp --dport 23 -j REJECT'],
+            ingress_rules)
+        # the rules of the firewall group are left as they are
+        self.assertEqual(4, len(firewall['ingress_rule_list']))
+
+    def test_get_rule_counters(self):
+        apply_list = self._fake_apply_list()
+        ipt_mgr = apply_list[0][0].iptables_manager
+        ipt_mgr.namespace = 'qrouter-fake-uuid'
+        rule_list = self._fake_rules_v4(FAKE_FW_ID, apply_list)
+        firewall = self._fake_firewall(rule_list)
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+
+        bname = fwaas.iptables_manager.binary_name
+        ingress_chain = '%s-%s' % (bname, ('iv4%s' % FAKE_FW_ID)[:11])
+        egress_chain = '%s-%s' % (bname, ('ov4%s' % FAKE_FW_ID)[:11])
+        v4_output = '\n'.join(
+            ['*filter',
+             ':%s - [0:0]' % ingress_chain,
+             '[5:300] -A %s-FORWARD -o qr-1_fake-port -j %s' % (
+                 bname, ingress_chain)] +
+            ['[%d:%d] -A %s -j ACCEPT' % (packets, packets * 60, chain)
+             for chain, packets in [(ingress_chain, 1), (ingress_chain, 9),
+                                    (ingress_chain, 3), (ingress_chain, 0),
+                                    (ingress_chain, 2), (egress_chain, 1),
+                                    (egress_chain, 0), (egress_chain, 4),
+                                    (egress_chain, 1), (egress_chain, 0)]] +
+            ['COMMIT'])
+
+        def _execute(cmd, run_as_root):
+            self.assertEqual(['ip', 'netns', 'exec', 'qrouter-fake-uuid'],
+                             cmd[:4])
+            # the IPv6 chains don't match their rendering and are skipped
+            return v4_output if cmd[4] == 'iptables-save' else ''
+
+        with mock.patch('neutron.agent.linux.utils.execute',
+                        side_effect=_execute) as execute:
+            self.assertEqual(
+                {FAKE_FW_ID: {
+                    'fake-fw-rule1': {'packets': 7, 'bytes': 420},
+                    'fake-fw-rule2': {'packets': 1, 'bytes': 60},
+                    'fake-fw-rule3': {'packets': 2, 'bytes': 120}}},
+                self.firewall.get_rule_counters())
+            self.assertEqual(2, execute.call_count)
+
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual({}, self.firewall.get_rule_counters())
@@ -17,6 +17,9 @@ import mock
 import testtools
 
 from neutron.tests import base
+from oslo_config import cfg
+
+from neutron_fwaas.services.firewall.agents import firewall_agent_api  # noqa
 from neutron_fwaas.services.firewall.drivers.linux import legacy_conntrack
 
 
@@ -91,10 +94,10 @@ class ConntrackLegacyTestCase(base.BaseTestCase):
         self.conntrack_driver = legacy_conntrack.ConntrackLegacy()
         self.conntrack_driver.initialize(execute=self.utils_exec)
 
-        list_entries_mock = mock.patch(
+        iter_entries_mock = mock.patch(
             'neutron_fwaas.services.firewall.drivers.linux'
-            '.legacy_conntrack.ConntrackLegacy.list_entries')
-        self.list_entries = list_entries_mock.start()
+            '.legacy_conntrack.ConntrackLegacy.iter_entries')
+        self.iter_entries = iter_entries_mock.start()
 
     def test_excecute_command_failed(self):
         with testtools.ExpectedException(RuntimeError):
@@ -111,7 +114,7 @@ class ConntrackLegacyTestCase(base.BaseTestCase):
                 run_as_root=True)
 
     def test_delete_entries(self):
-        self.conntrack_driver.list_entries.return_value = [
+        self.conntrack_driver.iter_entries.return_value = [
             ICMP_ENTRY, TCP_ENTRY, UDP_ENTRY]
         self.conntrack_driver.delete_entries(FW_RULES, ROUTER_NAMESPACE)
         calls = [
@@ -139,3 +142,226 @@ class ConntrackLegacyTestCase(base.BaseTestCase):
 
         ]
         self.utils_exec.assert_has_calls(calls)
+
+    def test_delete_icmpv6_entries(self):
+        rules = [{'protocol': 'ipv6-icmp', 'ip_version': 6}]
+        self.conntrack_driver.iter_entries.return_value = [
+            (6, 'icmpv6', 128, 0, 'fd00::1', 'fd00::2', 1234),
+            (6, 'tcp', 1, 2, 'fd00::1', 'fd00::2')]
+        self.assertEqual(1, self.conntrack_driver.delete_entries(
+            rules, ROUTER_NAMESPACE))
+        self._assert_conntrack_calls([
+            ['conntrack', '-D', '-f', 'ipv6', '-p', 'icmpv6',
+             '--icmpv6-type', 128, '--icmpv6-code', 0,
+             '-s', 'fd00::1', '-d', 'fd00::2', '--icmpv6-id', 1234]])
+
+    def test_delete_icmpv6_entries_by_type(self):
+        cfg.CONF.set_override('conntrack_max_processes', 1, 'fwaas')
+        rules = [{'protocol': 'ipv6-icmp', 'ip_version': 6}]
+        self.conntrack_driver.iter_entries.return_value = [
+            (6, 'icmpv6', 128, 0, 'fd00::1', 'fd00::2', 1234),
+            (6, 'icmpv6', 128, 0, 'fd00::3', 'fd00::2', 1234)]
+        self.conntrack_driver.delete_entries(rules, ROUTER_NAMESPACE)
+        self._assert_conntrack_calls([
+            ['conntrack', '-D', '-f', 'ipv6', '-p', 'icmpv6',
+             '--icmpv6-type', 128, '--icmpv6-code', 0]])
+
+    def test_delete_entries_batch(self):
+        self.conntrack_driver.iter_entries.return_value = [TCP_ENTRY]
+        for workers in (1, 2):
+            self.utils_exec.reset_mock()
+            counts = self.conntrack_driver.delete_entries_batch(
+                [('ns1', None), ('ns2', FW_RULES)], workers)
+            self.assertEqual({'ns1': None, 'ns2': 1}, counts)
+            self.utils_exec.assert_any_call(
+                ['ip', 'netns', 'exec', 'ns1', 'conntrack', '-D'],
+                check_exit_code=True,
+                extra_ok_codes=[1],
+                run_as_root=True)
+            self.utils_exec.assert_any_call(
+                ['ip', 'netns', 'exec', 'ns2',
+                 'conntrack', '-D', '-f', 'ipv4', '-p', 'tcp',
+                 '--sport', 1, '--dport', 2,
+                 '-s', '1.1.1.1', '-d', '2.2.2.2'],
+                check_exit_code=True,
+                extra_ok_codes=[1],
+                run_as_root=True)
+
+    def _assert_conntrack_calls(self, cmds):
+        self.assertEqual(
+            [mock.call(['ip', 'netns', 'exec', ROUTER_NAMESPACE] + cmd,
+                       check_exit_code=True,
+                       extra_ok_codes=[1],
+                       run_as_root=True)
+             for cmd in cmds],
+            self.utils_exec.call_args_list)
+
+    def test_delete_entries_by_destination_port(self):
+        cfg.CONF.set_override('conntrack_max_processes', 2, 'fwaas')
+        self.conntrack_driver.iter_entries.return_value = [
+            ICMP_ENTRY, TCP_ENTRY, (4, 'tcp', 3, 2, '1.1.1.2', '2.2.2.2')]
+        count = self.conntrack_driver.delete_entries(FW_RULES,
+                                                     ROUTER_NAMESPACE)
+        self.assertEqual(3, count)
+        self._assert_conntrack_calls([
+            ['conntrack', '-D', '-f', 'ipv4', '-p', 'icmp',
+             '--icmp-type', 8, '--icmp-code', 0],
+            ['conntrack', '-D', '-f', 'ipv4', '-p', 'tcp', '--dport', 2]])
+
+    def test_delete_entries_by_protocol(self):
+        cfg.CONF.set_override('conntrack_max_processes', 2, 'fwaas')
+        self.conntrack_driver.iter_entries.return_value = [
+            TCP_ENTRY, (4, 'tcp', 1, 3, '1.1.1.1', '2.2.2.2'),
+            (4, 'tcp', 1, 4, '1.1.1.1', '2.2.2.2')]
+        self.conntrack_driver.delete_entries(FW_RULES, ROUTER_NAMESPACE)
+        self._assert_conntrack_calls([
+            ['conntrack', '-D', '-f', 'ipv4', '-p', 'tcp']])
+
+    def test_delete_entries_by_protocol_with_marks(self):
+        cfg.CONF.set_override('conntrack_max_processes', 2, 'fwaas')
+        marks = [(0x1, 0xff), (0x100, 0xff00)]
+        self.conntrack_driver.iter_entries.return_value = [
+            TCP_ENTRY, (4, 'tcp', 1, 3, '1.1.1.1', '2.2.2.2'),
+            (4, 'tcp', 1, 4, '1.1.1.1', '2.2.2.2')]
+        self.conntrack_driver.delete_entries(FW_RULES, ROUTER_NAMESPACE,
+                                             marks)
+        self.conntrack_driver.iter_entries.assert_called_once_with(
+            ROUTER_NAMESPACE, marks, {})
+        self._assert_conntrack_calls([
+            ['conntrack', '-D', '-f', 'ipv4', '-p', 'tcp',
+             '--mark', '0x1/0xff'],
+            ['conntrack', '-D', '-f', 'ipv4', '-p', 'tcp',
+             '--mark', '0x100/0xff00']])
+
+    def test_delete_entries_flush_marks(self):
+        cfg.CONF.set_override('conntrack_max_processes', 1, 'fwaas')
+        marks = [(0x1, 0xff), (0x100, 0xff00)]
+        self.conntrack_driver.iter_entries.return_value = [
+            ICMP_ENTRY, TCP_ENTRY, UDP_ENTRY]
+        self.conntrack_driver.delete_entries(FW_RULES, ROUTER_NAMESPACE,
+                                             marks)
+        self._assert_conntrack_calls([
+            ['conntrack', '-D', '--mark', '0x1/0xff'],
+            ['conntrack', '-D', '--mark', '0x100/0xff00']])
+
+    def test_delete_entries_flush(self):
+        cfg.CONF.set_override('conntrack_max_processes', 1, 'fwaas')
+        self.conntrack_driver.iter_entries.return_value = [
+            ICMP_ENTRY, TCP_ENTRY, UDP_ENTRY]
+        count = self.conntrack_driver.delete_entries(FW_RULES,
+                                                     ROUTER_NAMESPACE)
+        self.assertEqual(3, count)
+        self._assert_conntrack_calls([['conntrack', '-D']])
+
+
+class ConntrackLegacyListTestCase(base.BaseTestCase):
+    def setUp(self):
+        super(ConntrackLegacyListTestCase, self).setUp()
+        self.conntrack_driver = legacy_conntrack.ConntrackLegacy()
+        self.conntrack_driver.initialize(execute=mock.Mock())
+        self.create_process = mock.patch(
+            'neutron.agent.linux.utils.create_process').start()
+        self.outputs = {
+            'ipv4': [b'tcp      6 431999 ESTABLISHED src=1.1.1.1 '
+                     b'dst=2.2.2.2 sport=1 dport=2 src=2.2.2.2 '
+                     b'dst=1.1.1.1 sport=2 dport=1 [ASSURED] mark=0 use=1\n',
+                     b'icmp     1 29 src=1.1.1.1 dst=2.2.2.2 type=8 code=0 '
+                     b'id=1234 src=2.2.2.2 dst=1.1.1.1 type=0 code=0 '
+                     b'id=1234 mark=0 use=1\n'],
+            'ipv6': []}
+        self.returncode = 0
+        self.create_process.side_effect = self._create_process
+
+    def _create_process(self, cmd, run_as_root=False):
+        process = mock.Mock()
+        process.stdout = iter(self.outputs[cmd[cmd.index('-f') + 1]])
+        process.wait.return_value = self.returncode
+        return process, cmd
+
+    def test_iter_entries(self):
+        entries = self.conntrack_driver.iter_entries(ROUTER_NAMESPACE)
+        self.assertFalse(self.create_process.called)
+        self.assertEqual((4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2'),
+                         next(entries))
+        self.assertEqual([(4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234)],
+                         list(entries))
+        self.create_process.assert_has_calls([
+            mock.call(['ip', 'netns', 'exec', ROUTER_NAMESPACE,
+                       'conntrack', '-L', '-f', 'ipv4'], run_as_root=True),
+            mock.call(['ip', 'netns', 'exec', ROUTER_NAMESPACE,
+                       'conntrack', '-L', '-f', 'ipv6'], run_as_root=True)])
+
+    def test_iter_entries_failed(self):
+        self.returncode = 2
+        with testtools.ExpectedException(RuntimeError):
+            list(self.conntrack_driver.iter_entries(ROUTER_NAMESPACE))
+
+    def test_iter_entries_with_marks(self):
+        marks = [(0x1, 0xff), (0x100, 0xff00)]
+        entries = list(self.conntrack_driver.iter_entries(ROUTER_NAMESPACE,
+                                                          marks))
+        self.assertEqual(4, len(entries))
+        self.create_process.assert_has_calls([
+            mock.call(['ip', 'netns', 'exec', ROUTER_NAMESPACE,
+                       'conntrack', '-L', '-f', 'ipv4',
+                       '--mark', '0x1/0xff'], run_as_root=True),
+            mock.call(['ip', 'netns', 'exec', ROUTER_NAMESPACE,
+                       'conntrack', '-L', '-f', 'ipv4',
+                       '--mark', '0x100/0xff00'], run_as_root=True)])
+
+    def test_delete_entries_with_marks_listed_once(self):
+        marks = [(0x1, 0xff), (0x100, 0xff00)]
+        count = self.conntrack_driver.delete_entries(
+            FW_RULES, ROUTER_NAMESPACE, marks)
+        # entries having both marks are deleted once
+        self.assertEqual(2, count)
+
+    def test_list_entries(self):
+        self.assertEqual(
+            [(4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', 1234),
+             (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')],
+            self.conntrack_driver.list_entries(ROUTER_NAMESPACE))
+
+    def test_iter_entries_nat(self):
+        self.outputs['ipv4'] = [
+            b'tcp      6 431999 ESTABLISHED src=8.8.8.8 dst=172.24.4.10 '
+            b'sport=1000 dport=22 src=10.0.0.5 dst=8.8.8.8 sport=22 '
+            b'dport=1000 [ASSURED] mark=0 use=1\n',
+            b'tcp      6 431999 ESTABLISHED src=1.1.1.1 '
+            b'dst=2.2.2.2 sport=1 dport=2 src=2.2.2.2 '
+            b'dst=1.1.1.1 sport=2 dport=1 [ASSURED] mark=0 use=1\n']
+        reply_entries = {}
+        entries = list(self.conntrack_driver.iter_entries(
+            ROUTER_NAMESPACE, reply_entries=reply_entries))
+        self.assertEqual(
+            {entries[0]: (4, 'tcp', 22, 1000, '10.0.0.5', '8.8.8.8')},
+            reply_entries)
+
+    def test_delete_entries_dnat(self):
+        self.outputs['ipv4'] = [
+            b'tcp      6 431999 ESTABLISHED src=8.8.8.8 dst=172.24.4.10 '
+            b'sport=1000 dport=22 src=10.0.0.5 dst=8.8.8.8 sport=22 '
+            b'dport=1000 [ASSURED] mark=0 use=1\n']
+        rules = [{'protocol': 'tcp', 'ip_version': 4,
+                  'destination_ip_address': '10.0.0.5'}]
+        self.assertEqual(1, self.conntrack_driver.delete_entries(
+            rules, ROUTER_NAMESPACE))
+        self.conntrack_driver.execute.assert_called_once_with(
+            ['ip', 'netns', 'exec', ROUTER_NAMESPACE,
+             'conntrack', '-D', '-f', 'ipv4', '-p', 'tcp',
+             '--sport', 1000, '--dport', 22,
+             '-s', '8.8.8.8', '-d', '172.24.4.10'],
+            check_exit_code=True, extra_ok_codes=[1], run_as_root=True)
+
+    def test_delete_entries_streamed(self):
+        self.outputs['ipv4'] = self.outputs['ipv4'] * 3
+        self.conntrack_driver.delete_entries(FW_RULES, ROUTER_NAMESPACE)
+        self.assertEqual(
+            3, self.conntrack_driver.execute.call_args_list.count(
+                mock.call(['ip', 'netns', 'exec', ROUTER_NAMESPACE,
+                           'conntrack', '-D', '-f', 'ipv4', '-p', 'tcp',
+                           '--sport', 1, '--dport', 2,
+                           '-s', '1.1.1.1', '-d', '2.2.2.2'],
+                          check_exit_code=True,
+                          extra_ok_codes=[1],
+                          run_as_root=True)))
@@ -15,6 +15,7 @@
 
 import mock
 
+from neutron_fwaas.services.firewall.drivers.linux import conntrack_matcher
 from neutron_fwaas.services.firewall.drivers.linux import netlink_conntrack
 from neutron_fwaas.tests import base
 
@@ -74,85 +75,67 @@ class ConntrackNetlinkTestCase(base.BaseTestCase):
         nl_flush_entries = mock.patch('neutron_fwaas.privileged.'
                                       'netlink_lib.flush_entries')
         self.flush_entries = nl_flush_entries.start()
-        nl_list_entries = mock.patch('neutron_fwaas.privileged.'
-                                     'netlink_lib.list_entries')
-        self.list_entries = nl_list_entries.start()
         nl_delete_entries = mock.patch('neutron_fwaas.privileged.'
-                                     'netlink_lib.delete_entries')
+                                       'netlink_lib.delete_entries_by_filters',
+                                       return_value=0)
         self.delete_entries = nl_delete_entries.start()
 
     def test_flush_entries(self):
         self.conntrack_driver.flush_entries(ROUTER_NAMESPACE)
         self.flush_entries.assert_called_with(ROUTER_NAMESPACE)
 
-    def test_delete_with_empty_conntrack_entries(self):
-        self.list_entries.return_value = []
+    def test_release_namespace(self):
+        with mock.patch('neutron_fwaas.privileged.netlink_lib.'
+                        'release_namespace') as release_namespace:
+            self.conntrack_driver.release_namespace(ROUTER_NAMESPACE)
+        release_namespace.assert_called_once_with(ROUTER_NAMESPACE)
+
+    def test_delete_without_rules(self):
         self.conntrack_driver.delete_entries([], ROUTER_NAMESPACE)
-        self.list_entries.assert_called_with(ROUTER_NAMESPACE)
         self.delete_entries.assert_not_called()
 
-    def test_delete_icmp_entry(self):
-        """Testing delete an icmp entry
-
-        The icmp entry can be deleted if there is an icmp conntrack entry
-        matched with an icmp firewall rule.
-        The information passing to nl_lib.kill_entry will include:
-        (ipversion, protocol, icmp_type, icmp_code, src_address, dst_addres,
-        icmp_ip)
-        """
-        self.list_entries.return_value = [ICMP_ENTRY]
-        self.conntrack_driver.delete_entries(FW_RULES, ROUTER_NAMESPACE)
-        self.list_entries.assert_called_with(ROUTER_NAMESPACE)
-        self.delete_entries.assert_called_with([(4, 'icmp', 8, 0,
-                                                 '1.1.1.1', '2.2.2.2',
-                                                 '1234')], ROUTER_NAMESPACE)
-
-    def test_delete_tcp_entry(self):
-        """Testing delete a tcp entry
-
-        The tcp entry can be deleted if there is a tcp conntrack entry
-        matched with a tcp firewall rule.
-        The information passing to nl_lib.kill_entry will include:
-        (ipversion, protocol, src_port, dst_port, src_address, dst_addres)
-        """
-        self.list_entries.return_value = [TCP_ENTRY]
-        self.conntrack_driver.delete_entries(FW_RULES, ROUTER_NAMESPACE)
-        self.list_entries.assert_called_with(ROUTER_NAMESPACE)
-        self.delete_entries.assert_called_with(
-                [(4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')], ROUTER_NAMESPACE)
-
-    def test_delete_udp_entry(self):
-        """Testing delete an udp entry
+    def test_delete_entries(self):
+        """Testing delete entries matching firewall rules
 
-        The udp entry can be deleted if there is an udp conntrack entry
-        matched with an udp firewall rule.
-        The information passing to nl_lib.kill_entry will include:
-        (ipversion, protocol, src_port, dst_port, src_address, dst_addres)
+        The filters parsed from the firewall rules are passed down to
+        nl_lib.delete_entries_by_filters which matches and deletes the
+        entries in the namespace.
         """
-        self.list_entries.return_value = [UDP_ENTRY]
-        self.conntrack_driver.delete_entries(FW_RULES, ROUTER_NAMESPACE)
-        self.list_entries.assert_called_with(ROUTER_NAMESPACE)
-        self.delete_entries.assert_called_with(
-                [(4, 'udp', 1, 2, '1.1.1.1', '2.2.2.2')], ROUTER_NAMESPACE)
-
-    def test_delete_multiple_entries(self):
-        self.list_entries.return_value = [ICMP_ENTRY, TCP_ENTRY, UDP_ENTRY]
         self.conntrack_driver.delete_entries(FW_RULES, ROUTER_NAMESPACE)
-        self.list_entries.assert_called_with(ROUTER_NAMESPACE)
-        self.delete_entries.assert_called_with(
-                [(4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', '1234'),
-                 (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2'),
-                 (4, 'udp', 1, 2, '1.1.1.1', '2.2.2.2')], ROUTER_NAMESPACE)
+        self.delete_entries.assert_called_once_with(
+            [(4, 'icmp', [], [], [], []),
+             (4, 'tcp', ['0', '10'], ['0', '10'], [], []),
+             (4, 'udp', ['0', '10'], ['0', '20'], [], []),
+             (4, 'tcp', [], ['0', '10'], [], []),
+             (4, 'udp', ['0', '10'], [], [], [])], ROUTER_NAMESPACE, None)
+
+    def test_delete_entries_with_address_filter(self):
+        fw_rule = {'protocol': 'tcp',
+                   'ip_version': 4,
+                   'destination_port': '2',
+                   'source_ip_address': '1.1.1.0/24',
+                   'id': 'fake-fw-rule'}
+        self.conntrack_driver.delete_entries([fw_rule], ROUTER_NAMESPACE)
+        self.delete_entries.assert_called_once_with(
+            [(4, 'tcp', [], ['2', '2'], '1.1.1.0/24', [])], ROUTER_NAMESPACE,
+            None)
+
+    def test_delete_entries_with_marks(self):
+        marks = [(0x1, 0xff), (0x100, 0xff00)]
+        self.conntrack_driver.delete_entries(FW_RULES[:1], ROUTER_NAMESPACE,
+                                             marks)
+        self.delete_entries.assert_called_once_with(
+            [(4, 'icmp', [], [], [], [])], ROUTER_NAMESPACE, marks)
 
     def _test_entry_to_delete(self, rule_filter, entry, expect_result):
-        is_entry_to_delete = (
-            self.conntrack_driver._compare_entry_and_rule(rule_filter, entry))
-        self.assertEqual(expect_result, is_entry_to_delete)
+        matcher = conntrack_matcher.ConntrackMatcher([rule_filter])
+        entries_to_delete = matcher.select([entry])
+        self.assertEqual([entry] if expect_result else [], entries_to_delete)
 
     def test_icmp_entry_match_rule(self):
         entry = (4, 'icmp', 8, 0, '1.1.1.1', '2.2.2.2', '1234')
         rule_filter = (4, 'icmp', None, None)
-        self._test_entry_to_delete(rule_filter, entry, 0)
+        self._test_entry_to_delete(rule_filter, entry, True)
 
     def test_tcp_entry_match_rule(self):
         entry = (4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2')
@@ -162,7 +145,7 @@ class ConntrackNetlinkTestCase(base.BaseTestCase):
                         (4, 'tcp', [1], [2]),
                         (4, 'tcp', ['0', '10'], ['0', '10']), ]
         for rule_filter in rule_filters:
-            self._test_entry_to_delete(rule_filter, entry, 0)
+            self._test_entry_to_delete(rule_filter, entry, True)
 
     def test_udp_entry_match_rule(self):
         entry = (4, 'udp', 1, 2, '1.1.1.1', '2.2.2.2')
@@ -172,19 +155,26 @@ class ConntrackNetlinkTestCase(base.BaseTestCase):
                         (4, 'udp', [1], [2]),
                         (4, 'udp', ['0', '10'], ['0', '10']), ]
         for rule_filter in rule_filters:
-            self._test_entry_to_delete(rule_filter, entry, 0)
+            self._test_entry_to_delete(rule_filter, entry, True)
 
     def test_entry_unmatch_rule(self):
-        wrong_ipv = [(4, 'tcp', '1', '2', '1.1.1.1', '2.2.2.2'),
-                     (6, 'tcp', None, None), -1]
-        wrong_proto = [(4, 'tcp', '1', '2', '1.1.1.1', '2.2.2.2'),
-                       (4, 'udp', None, None), -1]
+        wrong_ipv = [(4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2'),
+                     (6, 'tcp', None, None), False]
+        wrong_proto = [(4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2'),
+                       (4, 'udp', None, None), False]
         not_in_sport_range = [(4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2'),
-                              (4, 'tcp', ['2', '100'], [2]), -1]
+                              (4, 'tcp', ['2', '100'], [2]), False]
         not_in_dport_range = [(4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2'),
-                              (4, 'tcp', [1], ['3', '100']), -1]
+                              (4, 'tcp', [1], ['3', '100']), False]
+        not_in_src_prefix = [(4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2'),
+                             (4, 'tcp', None, None, '10.0.0.0/8', None),
+                             False]
+        not_in_dst_prefix = [(4, 'tcp', 1, 2, '1.1.1.1', '2.2.2.2'),
+                             (4, 'tcp', None, None, None, '2.2.2.3/32'),
+                             False]
         for entry, rule_filter, expect in [
-            wrong_ipv, wrong_proto, not_in_sport_range, not_in_dport_range]:
+            wrong_ipv, wrong_proto, not_in_sport_range, not_in_dport_range,
+            not_in_src_prefix, not_in_dst_prefix]:
             self._test_entry_to_delete(rule_filter, entry, expect)
 
     def test_get_filter_from_rules(self):
@@ -227,13 +217,36 @@ class ConntrackNetlinkTestCase(base.BaseTestCase):
         TCP_ENTRY_OUT_RANGE = (4, 'tcp', 22, 100, '1.1.1.1', '2.2.2.2')
         UDP_ENTRY_IN_RANGE = (4, 'udp', 3, 4, '1.1.1.1', '2.2.2.2')
         UDP_ENTRY_OUT_RANGE = (4, 'udp', 100, 200, '1.1.1.1', '2.2.2.2')
-        self.list_entries.return_value = sorted(
+        entries = sorted(
                 [ICMP_ENTRY, TCP_ENTRY, UDP_ENTRY,
                  TCP_ENTRY_IN_RANGE, TCP_ENTRY_OUT_RANGE,
                  UDP_ENTRY_IN_RANGE, UDP_ENTRY_OUT_RANGE])
         expected_delete_entries = sorted(
                 [ICMP_ENTRY, TCP_ENTRY, UDP_ENTRY,
                  TCP_ENTRY_IN_RANGE, UDP_ENTRY_IN_RANGE])
-        actual_delete_entries = self.conntrack_driver._get_entries_to_delete(
-                rule_filters, self.list_entries())
+        matcher = conntrack_matcher.ConntrackMatcher(rule_filters)
+        actual_delete_entries = matcher.select(entries)
         self.assertEqual(expected_delete_entries, actual_delete_entries)
+
+    def test_delete_entries_batch(self):
+        nl_delete_entries_batch = mock.patch(
+            'neutron_fwaas.privileged.netlink_lib.delete_entries_batch',
+            return_value=[None, 2]).start()
+        counts = self.conntrack_driver.delete_entries_batch(
+            [('ns1', None), ('ns2', FW_RULES[:1])], 4)
+        self.assertEqual({'ns1': None, 'ns2': 2}, counts)
+        nl_delete_entries_batch.assert_called_once_with(
+            [('ns1', None), ('ns2', [(4, 'icmp', [], [], [], [])])], 4)
+        self.flush_entries.assert_not_called()
+        self.delete_entries.assert_not_called()
+
+    def test_delete_entries_batch_with_marks(self):
+        nl_delete_entries_batch = mock.patch(
+            'neutron_fwaas.privileged.netlink_lib.delete_entries_batch',
+            return_value=[2]).start()
+        marks = [(0x1, 0xff), (0x100, 0xff00)]
+        counts = self.conntrack_driver.delete_entries_batch(
+            [('ns1', FW_RULES[:1], marks)])
+        self.assertEqual({'ns1': 2}, counts)
+        nl_delete_entries_batch.assert_called_once_with(
+            [('ns1', [(4, 'icmp', [], [], [], [])], marks)], 1)
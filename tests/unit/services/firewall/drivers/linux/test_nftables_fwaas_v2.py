@@ -0,0 +1,209 @@
+# Copyright (c) 2018
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import copy
+
+import mock
+from neutron.tests import base
+
+from neutron_fwaas.services.firewall.drivers.linux import nftables_fwaas_v2
+
+
+FAKE_FW_ID = 'fake-fw-uuid'
+FAKE_NAMESPACE = 'qrouter-fake-uuid'
+FAKE_PORT_IDS = ('1_fake-port-uuid', '2_fake-port-uuid')
+FW_LEGACY = 'legacy'
+
+
+class NftablesFwaasTestCase(base.BaseTestCase):
+    def setUp(self):
+        super(NftablesFwaasTestCase, self).setUp()
+        mock.patch('neutron_fwaas.services.firewall.drivers.conntrack_base.'
+                   'load_and_init_conntrack_driver').start()
+        self.execute = mock.patch(
+            'neutron.agent.linux.utils.execute').start()
+        self.firewall = nftables_fwaas_v2.NftablesFwaasDriver()
+
+    def _fake_rules(self):
+        address_group = {'id': 'fake-ag-uuid',
+                         'ip_addresses': [
+                             {'ip_address': '10.0.0.0/24', 'ip_version': 4},
+                             {'ip_address': '2001:db8::/64',
+                              'ip_version': 6}]}
+        service_group = {'id': 'fake-sg-uuid',
+                         'ports': [{'protocol': 'tcp', 'port': '80'},
+                                   {'protocol': 'tcp', 'port': '8080:8090'},
+                                   {'protocol': 'udp', 'port': '53'}]}
+        return [{'enabled': True,
+                 'action': 'allow',
+                 'ip_version': 4,
+                 'protocol': 'tcp',
+                 'destination_port': '22',
+                 'source_ip_address': '10.24.4.2',
+                 'id': 'fake-fw-rule1'},
+                {'enabled': True,
+                 'action': 'deny',
+                 'ip_version': 4,
+                 'protocol': None,
+                 'source_address_groups': [address_group],
+                 'service_groups': [service_group],
+                 'id': 'fake-fw-rule2'},
+                {'enabled': True,
+                 'action': 'reject',
+                 'ip_version': 6,
+                 'protocol': 'ipv6-icmp',
+                 'id': 'fake-fw-rule3'},
+                {'enabled': False,
+                 'action': 'allow',
+                 'ip_version': 4,
+                 'protocol': 'udp',
+                 'id': 'fake-fw-rule4'}]
+
+    def _fake_firewall(self, rule_list, fwid=FAKE_FW_ID,
+                       admin_state_up=True):
+        return {'id': fwid,
+                'admin_state_up': admin_state_up,
+                'tenant_id': 'tenant-uuid',
+                'egress_rule_list': copy.deepcopy(rule_list),
+                'ingress_rule_list': []}
+
+    def _fake_apply_list(self, port_ids=FAKE_PORT_IDS):
+        router_info_inst = mock.Mock()
+        router_info_inst.router = {}
+        router_info_inst.iptables_manager.namespace = FAKE_NAMESPACE
+        return [(router_info_inst, port_ids)]
+
+    def _get_scripts(self):
+        return [call[1]['process_input'].splitlines()
+                for call in self.execute.call_args_list]
+
+    def test_create_firewall_group(self):
+        firewall = self._fake_firewall(self._fake_rules())
+        self.firewall.create_firewall_group(FW_LEGACY,
+                                            self._fake_apply_list(), firewall)
+        self.execute.assert_called_once_with(
+            ['ip', 'netns', 'exec', FAKE_NAMESPACE, 'nft', '-f', '-'],
+            process_input=mock.ANY, run_as_root=True)
+        script = self._get_scripts()[0]
+        self.assertEqual(['add table inet neutron_fwaas',
+                          'delete table inet neutron_fwaas',
+                          'table inet neutron_fwaas {'], script[:3])
+        for line in [
+                'elements = { "qr-1_fake-port", "qr-2_fake-port" }',
+                'elements = { "qr-1_fake-port" : jump o-%(fwid)s, '
+                '"qr-2_fake-port" : jump o-%(fwid)s }' % {'fwid': FAKE_FW_ID},
+                'set ag-fake-ag-uuid-v4 {',
+                'elements = { 10.0.0.0/24 }',
+                'oifname vmap @ingress-ports',
+                'iifname vmap @egress-ports',
+                'oifname @ports drop',
+                'iifname @ports drop']:
+            self.assertIn(line, script)
+        chain = script[script.index('chain o-%s {' % FAKE_FW_ID) + 1:-2]
+        self.assertEqual(
+            ['ct state invalid drop',
+             'ct state established,related accept',
+             'meta nfproto ipv4 ip saddr 10.24.4.2 tcp dport 22 accept',
+             'meta nfproto ipv4 ip saddr @ag-fake-ag-uuid-v4 '
+             'tcp dport { 80, 8080-8090 } drop',
+             'meta nfproto ipv4 ip saddr @ag-fake-ag-uuid-v4 '
+             'udp dport { 53 } drop',
+             'meta nfproto ipv6 meta l4proto ipv6-icmp reject'],
+            chain)
+        self.firewall.conntrack.delete_entries_batch.assert_called_once_with(
+            [(FAKE_NAMESPACE, None)], mock.ANY)
+
+    def test_service_matches_with_any_port_service(self):
+        service_group = {'id': 'fake-sg-uuid',
+                         'ports': [{'protocol': 'tcp', 'port': '80'},
+                                   {'protocol': 'tcp', 'port': None},
+                                   {'protocol': 'tcp', 'port': '443'},
+                                   {'protocol': 'udp', 'port': '53'}]}
+        rule = {'protocol': None, 'service_groups': [service_group]}
+        # a service without port matches any port of its protocol
+        self.assertEqual(['meta l4proto tcp', 'udp dport { 53 }'],
+                         self.firewall._get_service_matches(rule))
+
+    def test_apply_default_policy(self):
+        firewall = self._fake_firewall(self._fake_rules(),
+                                       admin_state_up=False)
+        self.firewall.create_firewall_group(FW_LEGACY,
+                                            self._fake_apply_list(), firewall)
+        script = self._get_scripts()[0]
+        self.assertIn('elements = { "qr-1_fake-port", "qr-2_fake-port" }',
+                      script)
+        self.assertNotIn('chain o-%s {' % FAKE_FW_ID, script)
+        self.firewall.conntrack.delete_entries_batch.assert_not_called()
+
+    def test_update_firewall_group_removes_changed_rules_conntrack(self):
+        rule_list = self._fake_rules()
+        firewall = self._fake_firewall(rule_list)
+        apply_list = self._fake_apply_list()
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        rule_list[0]['destination_port'] = '23'
+        del rule_list[2]
+        new_firewall = self._fake_firewall(rule_list)
+        self.firewall.update_firewall_group(FW_LEGACY, apply_list,
+                                            new_firewall)
+        self.firewall.conntrack.delete_entries_batch.assert_called_with(
+            [(FAKE_NAMESPACE, [firewall['egress_rule_list'][0],
+                               new_firewall['egress_rule_list'][0],
+                               firewall['egress_rule_list'][2]])],
+            mock.ANY)
+
+    def test_batch_apply_commits_namespace_once(self):
+        apply_list = self._fake_apply_list()
+        with self.firewall.batch_apply() as failed_fwids:
+            for fwid in ['fw1', 'fw2']:
+                self.firewall.create_firewall_group(
+                    FW_LEGACY, apply_list,
+                    self._fake_firewall(self._fake_rules(), fwid=fwid))
+            self.execute.assert_not_called()
+        self.assertEqual(set(), failed_fwids)
+        script = self._get_scripts()[0]
+        self.assertEqual(1, self.execute.call_count)
+        self.assertIn('chain o-fw1 {', script)
+        self.assertIn('chain o-fw2 {', script)
+
+    def test_batch_apply_commit_failure(self):
+        self.execute.side_effect = RuntimeError
+        with self.firewall.batch_apply() as failed_fwids:
+            self.firewall.create_firewall_group(
+                FW_LEGACY, self._fake_apply_list(),
+                self._fake_firewall(self._fake_rules()))
+        self.assertEqual({FAKE_FW_ID}, failed_fwids)
+        self.firewall.conntrack.delete_entries_batch.assert_not_called()
+
+    def test_delete_firewall_group(self):
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_rules())
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.firewall.delete_firewall_group(FW_LEGACY, apply_list, firewall)
+        self.assertEqual(['add table inet neutron_fwaas',
+                          'delete table inet neutron_fwaas'],
+                         self._get_scripts()[-1])
+        self.assertEqual({}, self.firewall._namespaces)
+        self.firewall.conntrack.release_namespace.assert_called_once_with(
+            apply_list[0][0].iptables_manager.namespace)
+
+    def test_release_namespace(self):
+        apply_list = self._fake_apply_list()
+        firewall = self._fake_firewall(self._fake_rules())
+        self.firewall.create_firewall_group(FW_LEGACY, apply_list, firewall)
+        namespace = apply_list[0][0].iptables_manager.namespace
+        self.firewall.release_namespace(namespace)
+        self.assertEqual({}, self.firewall._namespaces)
+        self.firewall.conntrack.release_namespace.assert_called_once_with(
+            namespace)
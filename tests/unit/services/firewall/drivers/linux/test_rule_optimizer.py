@@ -0,0 +1,113 @@
+# Copyright (c) 2018
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from neutron_fwaas.services.firewall.drivers.linux import rule_optimizer
+from neutron_fwaas.tests import base
+
+
+def _rule(rule_id, action='allow', protocol='tcp', **attrs):
+    rule = {'id': rule_id,
+            'enabled': True,
+            'ip_version': 4,
+            'action': action,
+            'protocol': protocol,
+            'source_ip_address': None,
+            'destination_ip_address': None,
+            'source_port': None,
+            'destination_port': None}
+    rule.update(attrs)
+    return rule
+
+
+class RuleOptimizerTestCase(base.BaseTestCase):
+
+    def _optimize(self, rules):
+        optimized, removed = rule_optimizer.optimize_rules(rules)
+        return [rule['id'] for rule in optimized], removed
+
+    def test_duplicate_rule(self):
+        rules = [_rule('r1', destination_port='22'),
+                 _rule('r2', action='deny', destination_port='22')]
+        self.assertEqual((['r1'], [('r2', 'duplicate of rule r1')]),
+                         self._optimize(rules))
+
+    def test_shadowed_rules(self):
+        rules = [_rule('r1', source_ip_address='10.0.0.0/8'),
+                 _rule('r2', action='deny', protocol=None),
+                 _rule('r3', source_ip_address='10.1.0.0/16',
+                       destination_port='80:90'),
+                 _rule('r4', protocol='udp', source_ip_address='10.1.1.1')]
+        self.assertEqual((['r1', 'r2'], [('r3', 'shadowed by rule r1'),
+                                         ('r4', 'shadowed by rule r2')]),
+                         self._optimize(rules))
+
+    def test_wider_rule_not_shadowed(self):
+        rules = [_rule('r1', destination_port='80'),
+                 _rule('r2', action='deny', destination_port='1:1024'),
+                 _rule('r3', action='deny', protocol='udp')]
+        self.assertEqual((['r1', 'r2', 'r3'], []), self._optimize(rules))
+
+    def test_ports_ignored_without_port_protocol(self):
+        rules = [_rule('r1', protocol=None, destination_port='80'),
+                 _rule('r2', destination_port='22')]
+        self.assertEqual((['r1'], [('r2', 'shadowed by rule r1')]),
+                         self._optimize(rules))
+
+    def test_merge_adjacent_cidrs(self):
+        rules = [_rule('r1', source_ip_address='10.0.0.0/24'),
+                 _rule('r2', source_ip_address='10.0.1.0/24'),
+                 _rule('r3', source_ip_address='10.0.2.0/23'),
+                 _rule('r4', source_ip_address='10.0.8.0/24')]
+        optimized, removed = rule_optimizer.optimize_rules(rules)
+        self.assertEqual(['10.0.0.0/22', '10.0.8.0/24'],
+                         [rule['source_ip_address'] for rule in optimized])
+        self.assertEqual([('r2', 'merged into rule r1'),
+                          ('r3', 'merged into rule r1')], removed)
+        # the rules given are not modified
+        self.assertEqual('10.0.0.0/24', rules[0]['source_ip_address'])
+
+    def test_merge_port_ranges(self):
+        rules = [_rule('r1', destination_port='80'),
+                 _rule('r2', destination_port='81:90'),
+                 _rule('r3', destination_port='85:100'),
+                 _rule('r4', destination_port='102')]
+        optimized, removed = rule_optimizer.optimize_rules(rules)
+        self.assertEqual(['80:100', '102'],
+                         [rule['destination_port'] for rule in optimized])
+        self.assertEqual(2, len(removed))
+
+    def test_no_merge(self):
+        rules = [_rule('r1', destination_port='80'),
+                 _rule('r2', action='deny', destination_port='81'),
+                 _rule('r3', destination_port='82', source_port='1000'),
+                 _rule('r4', source_ip_address='10.0.1.0/24',
+                       destination_port='82'),
+                 _rule('r5', source_ip_address='10.0.2.0/24',
+                       destination_port='82')]
+        self.assertEqual((['r1', 'r2', 'r3', 'r4', 'r5'], []),
+                         self._optimize(rules))
+
+    def test_group_rules(self):
+        address_group_rule = _rule(
+            'r2', source_address_groups=[{'id': 'ag'}])
+        service_group_rule = _rule(
+            'r3', protocol=None, service_groups=[{'id': 'sg'}])
+        rules = [_rule('r1', source_ip_address='10.0.0.0/8'),
+                 address_group_rule, service_group_rule,
+                 _rule('r4', action='deny', protocol=None),
+                 dict(address_group_rule, id='r5')]
+        self.assertEqual((['r1', 'r2', 'r3', 'r4'],
+                          [('r5', 'shadowed by rule r4')]),
+                         self._optimize(rules))
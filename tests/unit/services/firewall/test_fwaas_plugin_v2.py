@@ -14,6 +14,8 @@
 #  under the License.
 
 import mock
+from neutron.db.models import l3agent as l3agent_model
+from neutron.tests.common import helpers
 from neutron.tests import fake_notifier
 from neutron.tests.unit.extensions import test_l3 as test_l3_plugin
 from neutron_lib import constants as nl_constants
@@ -85,6 +87,9 @@ class TestFirewallAgentApi(base.BaseTestCase):
     def test_delete_firewall_group(self):
         self._call_test_helper('delete_firewall_group')
 
+    def test_update_firewall_group_rules(self):
+        self._call_test_helper('update_firewall_group_rules')
+
 
 class TestFirewallRouterPortBase(
         test_db_firewall.FirewallPluginV2DbTestCase):
@@ -238,6 +243,104 @@ class TestFirewallPluginBasev2(TestFirewallRouterPortBase,
     def _self_context(self):
         return context.Context('', self._tenant_id)
 
+    def test_get_firewall_groups_for_host(self):
+        agent = helpers.register_l3_agent('host1')
+        ctx = context.get_admin_context()
+        with self.router(name='router1', admin_state_up=True,
+                         tenant_id=self._tenant_id) as r, \
+                self.subnet() as s1:
+            router_id = r['router']['id']
+            with ctx.session.begin(subtransactions=True):
+                ctx.session.add(l3agent_model.RouterL3AgentBinding(
+                    router_id=router_id, l3_agent_id=agent.id))
+            body = self._router_interface_action(
+                'add',
+                router_id,
+                s1['subnet']['id'],
+                None)
+            port_id = body['port_id']
+            with self.firewall_policy() as fwp:
+                fwp_id = fwp['firewall_policy']['id']
+                with self.firewall_group(
+                        name='test',
+                        ingress_firewall_policy_id=fwp_id,
+                        ports=[port_id],
+                        admin_state_up=True) as fwg1:
+                    fwg_id = fwg1['firewall_group']['id']
+                    fwgs = self.callbacks.get_firewall_groups_for_host(
+                        ctx, host='host1', limit=10)
+                    self.assertEqual([fwg_id], [fwg['id'] for fwg in fwgs])
+                    self.assertEqual([port_id], fwgs[0]['add-port-ids'])
+                    self.assertEqual([], fwgs[0]['ingress_rule_list'])
+                    # next page
+                    self.assertEqual(
+                        [], self.callbacks.get_firewall_groups_for_host(
+                            ctx, host='host1', marker=fwg_id, limit=10))
+                    # the router isn't hosted by the agent of another host
+                    self.assertEqual(
+                        [], self.callbacks.get_firewall_groups_for_host(
+                            ctx, host='host2'))
+
+            self._router_interface_action(
+                'remove',
+                router_id,
+                s1['subnet']['id'],
+                None)
+
+    def test_get_firewall_group_for_host(self):
+        ctx = context.get_admin_context()
+        with self.firewall_policy() as fwp:
+            fwp_id = fwp['firewall_policy']['id']
+            with self.firewall_group(
+                    name='test',
+                    ingress_firewall_policy_id=fwp_id,
+                    admin_state_up=True) as fwg1:
+                fwg_id = fwg1['firewall_group']['id']
+                fwg = self.callbacks.get_firewall_group_for_host(
+                    ctx, host='host1', fwg_id=fwg_id)
+                self.assertEqual(fwg_id, fwg['id'])
+                self.assertEqual(fwp_id, fwg['ingress_firewall_policy_id'])
+                self.assertEqual([], fwg['ingress_rule_list'])
+                self.assertEqual([], fwg['add-port-ids'])
+        # the group was deleted
+        self.assertIsNone(self.callbacks.get_firewall_group_for_host(
+            ctx, host='host1', fwg_id=fwg_id))
+
+    def test_get_firewall_groups_for_project_with_host(self):
+        agent = helpers.register_l3_agent('host1')
+        ctx = context.get_admin_context()
+        with self.router(name='router1', admin_state_up=True,
+                         tenant_id=self._tenant_id) as r, \
+                self.subnet() as s1:
+            router_id = r['router']['id']
+            with ctx.session.begin(subtransactions=True):
+                ctx.session.add(l3agent_model.RouterL3AgentBinding(
+                    router_id=router_id, l3_agent_id=agent.id))
+            body = self._router_interface_action(
+                'add',
+                router_id,
+                s1['subnet']['id'],
+                None)
+            port_id = body['port_id']
+            with self.firewall_group(name='hosted', ports=[port_id]) as fwg1, \
+                    self.firewall_group(name='not-hosted'):
+                fwg_id = fwg1['firewall_group']['id']
+                fwgs = self.callbacks.get_firewall_groups_for_project(
+                    ctx, host='host1')
+                self.assertEqual([fwg_id], [fwg['id'] for fwg in fwgs])
+                self.assertEqual([port_id], fwgs[0]['add-port-ids'])
+                self.assertEqual([], fwgs[0]['del-port-ids'])
+                # without a host, the groups of all hosts are returned
+                fwgs = self.callbacks.get_firewall_groups_for_project(ctx)
+                self.assertIn(fwg_id, [fwg['id'] for fwg in fwgs])
+                self.assertGreater(len(fwgs), 1)
+
+            self._router_interface_action(
+                'remove',
+                router_id,
+                s1['subnet']['id'],
+                None)
+
     def test_create_firewall_group_ports_not_specified(self):
         """neutron firewall-create test-policy """
         with self.firewall_policy() as fwp:
@@ -604,6 +707,116 @@ class TestFirewallPluginBasev2(TestFirewallRouterPortBase,
                 s1['subnet']['id'],
                 None)
 
+    def test_update_firewall_rule_sends_rule_deltas(self):
+        cfg.CONF.set_override('send_rule_deltas', True, 'fwaas')
+        name = "new_firewall_rule1"
+        ctx = context.get_admin_context()
+        with self.router(name='router1', admin_state_up=True,
+                         tenant_id=self._tenant_id) as r, \
+                self.subnet() as s1:
+            body = self._router_interface_action(
+                'add',
+                r['router']['id'],
+                s1['subnet']['id'],
+                None)
+            port_id = body['port_id']
+            with self.firewall_rule() as fwr:
+                fwr_id = fwr['firewall_rule']['id']
+                with self.firewall_policy(firewall_rules=[fwr_id]) as fwp:
+                    fwp_id = fwp['firewall_policy']['id']
+                    with self.firewall_group(
+                            name='test',
+                            ingress_firewall_policy_id=fwp_id,
+                            ports=[port_id],
+                            admin_state_up=True) as fwg1:
+                        fwg_id = fwg1['firewall_group']['id']
+                        self.callbacks.set_firewall_group_status(
+                            ctx, fwg_id, nl_constants.ACTIVE)
+                        fwp_revision = self.plugin._get_policy_rule_list(
+                            ctx, fwp_id)[0]
+                        data = {'firewall_rule': {'name': name}}
+                        req = self.new_update_request('firewall_rules', data,
+                                                      fwr_id)
+                        with mock.patch.object(
+                                self.plugin.agent_rpc,
+                                'update_firewall_group_rules') as rpc_mock:
+                            req.get_response(self.ext_api)
+
+            self._router_interface_action(
+                'remove',
+                r['router']['id'],
+                s1['subnet']['id'],
+                None)
+
+        fwg_delta = rpc_mock.call_args[0][1]
+        self.assertEqual(fwg_id, fwg_delta['id'])
+        self.assertEqual(fwg_delta['revision_number'] - 1,
+                         fwg_delta['base_revision_number'])
+        self.assertEqual(fwp_revision + 1,
+                         fwg_delta['ingress_firewall_policy_revision_number'])
+        self.assertEqual([port_id], fwg_delta['add-port-ids'])
+        self.assertNotIn('ingress_rule_list', fwg_delta)
+        delta = fwg_delta['ingress_rule_list_delta']
+        self.assertEqual(fwp_revision, delta['base_revision_number'])
+        self.assertEqual([fwr_id], [rule['id'] for rule in delta['changed']])
+        self.assertEqual(name, delta['changed'][0]['name'])
+        self.assertEqual([], delta['added'])
+        self.assertEqual([], delta['removed'])
+
+    def test_update_firewall_rule_of_both_policies_sends_one_delta(self):
+        cfg.CONF.set_override('send_rule_deltas', True, 'fwaas')
+        ctx = context.get_admin_context()
+        with self.router(name='router1', admin_state_up=True,
+                         tenant_id=self._tenant_id) as r, \
+                self.subnet() as s1:
+            body = self._router_interface_action(
+                'add',
+                r['router']['id'],
+                s1['subnet']['id'],
+                None)
+            port_id = body['port_id']
+            with self.firewall_rule() as fwr:
+                fwr_id = fwr['firewall_rule']['id']
+                with self.firewall_policy(firewall_rules=[fwr_id]) as fwp1, \
+                        self.firewall_policy(name='firewall_policy2',
+                                             firewall_rules=[fwr_id]) as fwp2:
+                    fwp1_id = fwp1['firewall_policy']['id']
+                    fwp2_id = fwp2['firewall_policy']['id']
+                    with self.firewall_group(
+                            name='test',
+                            ingress_firewall_policy_id=fwp1_id,
+                            egress_firewall_policy_id=fwp2_id,
+                            ports=[port_id],
+                            admin_state_up=True) as fwg1:
+                        fwg_id = fwg1['firewall_group']['id']
+                        self.callbacks.set_firewall_group_status(
+                            ctx, fwg_id, nl_constants.ACTIVE)
+                        fwp_revisions = [
+                            self.plugin._get_policy_rule_list(ctx, fwp_id)[0]
+                            for fwp_id in (fwp1_id, fwp2_id)]
+                        data = {'firewall_rule': {'name': 'new_name'}}
+                        req = self.new_update_request('firewall_rules', data,
+                                                      fwr_id)
+                        with mock.patch.object(
+                                self.plugin.agent_rpc,
+                                'update_firewall_group_rules') as rpc_mock:
+                            req.get_response(self.ext_api)
+
+            self._router_interface_action(
+                'remove',
+                r['router']['id'],
+                s1['subnet']['id'],
+                None)
+
+        rpc_mock.assert_called_once_with(mock.ANY, mock.ANY)
+        fwg_delta = rpc_mock.call_args[0][1]
+        self.assertEqual(fwg_delta['revision_number'] - 1,
+                         fwg_delta['base_revision_number'])
+        deltas = [fwg_delta['%s_rule_list_delta' % direction]
+                  for direction in ('ingress', 'egress')]
+        self.assertEqual(fwp_revisions,
+                         [delta['base_revision_number'] for delta in deltas])
+
     def test_update_firewall_rule_on_pending_create_fwg(self):
         """update should fail"""
         name = "new_firewall_rule1"